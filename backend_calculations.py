@@ -1,11 +1,42 @@
 import math
+import time
+import logging
 import numpy as np
-import pandas as pd
 from collections import Counter
 from inverted_index_gcp import InvertedIndex
 
+logger = logging.getLogger(__name__)
 
-def sorting_results_using_ranking(index, tokens, comp):
+
+def top_k(scores, k=None, tie_break=None):
+    """
+    Returns the positions of the k highest scores, best first, without sorting the scores that are not returned.
+    Equal scores are ordered by `tie_break` ascending, or by position when it is not given.
+    :param scores: numpy array of scores
+    :param k: int, number of positions to return, None for all of them
+    :param tie_break: numpy array parallel to scores, secondary ascending sort key
+    :return: numpy array of positions
+    """
+    n = len(scores)
+    if k is None or k >= n:
+        candidates = np.arange(n)
+    elif k <= 0:
+        return np.empty(0, dtype=np.int64)
+    else:
+        # every score above the k-th best is in the top k, the remaining slots go to the scores equal to it with
+        # the lowest tie break, chosen without sorting the whole tied group (most title scores are ties)
+        kth_score = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        above = np.flatnonzero(scores > kth_score)
+        tied = np.flatnonzero(scores == kth_score)
+        n_tied = k - len(above)
+        if len(tied) > n_tied and tie_break is not None:
+            tied = tied[np.argpartition(tie_break[tied], n_tied - 1)[:n_tied]]
+        candidates = np.concatenate([above, tied[:n_tied]])
+    secondary = candidates if tie_break is None else tie_break[candidates]
+    return candidates[np.lexsort((secondary, -scores[candidates]))]
+
+
+def sorting_results_using_ranking(index, tokens, comp, k=None, postings=None):
     """
     The function returns all components in index sorted by the ranking scores. Tha ranking is calculated using binary
     similarity. Returns list of ALL (not just top 100) search results, ordered from best to worst where each element
@@ -13,20 +44,31 @@ def sorting_results_using_ranking(index, tokens, comp):
     :param comp: string, directory name for component in gcp
     :param index: InvertedIndex
     :param tokens: list of tokens of query to search
+    :param k: int, number of results to return, None for all of them
+    :param postings: optional dictionary of term -> (doc_ids, tfs) already read (see get_posting_arrays)
     :return: list
     """
-    index_scores_dict = {}
-    # Loop through each token in the input list of tokens
-    for token in tokens:
-        # Read the posting list for the current token from the index
-        pls = index.read_posting_list(token, comp)
-        # Loop through the posting list and add the score to the index_scores_dict
-        for doc_id, tf in pls:
-            index_scores_dict[doc_id] = index_scores_dict.get(doc_id, 0) + 1 / len(tokens)
+    doc_ids, scores = sorting_results_arrays(index, tokens, comp, k, postings)
+    return list(zip(doc_ids.tolist(), scores.tolist()))
+
+
+def sorting_results_arrays(index, tokens, comp, k=None, postings=None):
+    """
+    Same as sorting_results_using_ranking, returning the ranking as parallel arrays instead of a list of pairs.
+    :return: (doc_ids, scores) numpy arrays, ordered from best to worst
+    """
+    # Read the doc ids of the posting list of every token in the input list of tokens
+    read = (lambda token: postings[token]) if postings is not None else \
+        (lambda token: index.read_posting_arrays(token, comp))
+    doc_ids = [read(token)[0] for token in tokens]
+    doc_ids = np.concatenate(doc_ids) if len(doc_ids) != 0 else np.empty(0, dtype=np.int64)
+    # Every posting adds 1 / len(tokens) to the score of its document
+    unique_ids, first_seen, counts = np.unique(doc_ids, return_index=True, return_counts=True)
+    scores = counts / len(tokens) if len(tokens) != 0 else counts.astype(np.float64)
 
-    # Sort the index_scores_dict by score in descending order and return as a list of tuples
-    sorted_scores = sorted(index_scores_dict.items(), key=lambda pair: pair[1], reverse=True)
-    return sorted_scores
+    # Sort by score in descending order, ties keep the order in which the documents were first seen
+    order = top_k(scores, k, tie_break=first_seen)
+    return unique_ids[order], scores[order]
 
 
 def generate_query_tfidf_vector(query_to_search, index: InvertedIndex):
@@ -66,50 +108,51 @@ def generate_query_tfidf_vector(query_to_search, index: InvertedIndex):
     return query_vec
 
 
-def get_candidate_documents_and_scores(query_to_search, index, comp):
+def get_posting_arrays(index, terms, comp):
     """
-    Generate a dictionary representing a pool of candidate documents for a given query. This function will go through every token in query_to_search
-    and fetch the corresponding information (e.g., term frequency, document frequency, etc.') needed to calculate TF-IDF from the posting list.
-    Then it will populate the dictionary 'candidates.'
-    For calculation of IDF, use log with base 10.
-    tf will be normalized based on the length of the document.
+    Read the posting list of every distinct term once.
 
     Parameters:
     -----------
-    query_to_search: list of tokens (str). This list will be preprocessed in advance (e.g., lower case, filtering stopwords, etc.').
-                     Example: 'Hello, I love information retrieval' --->  ['hello','love','information','retrieval']
+    index: inverted index loaded from the corresponding files.
+    terms: list of tokens (str), may contain duplicates.
+    comp: string, directory name for component in gcp
 
-    index:           inverted index loaded from the corresponding files.
+    Returns:
+    -----------
+    dictionary of term -> (doc_ids, tfs) numpy arrays.
+    """
+    return {term: index.read_posting_arrays(term, comp) for term in dict.fromkeys(terms)}
+
+
+def accumulate_scores(doc_ids, scores):
+    """
+    Scatter-add scores into a per-document accumulator.
 
-    words,pls: iterator for working with posting.
+    Parameters:
+    -----------
+    doc_ids: list of numpy arrays of doc ids (e.g., one per query term).
+    scores: list of numpy arrays of scores, parallel to doc_ids.
 
     Returns:
     -----------
-    dictionary of candidates. In the following format:
-                                                               key: pair (doc_id,term)
-                                                               value: tfidf score.
-    """
-    # nearly same as the lecturer code
-    candidates = {}
-    for item in query_to_search:
-        if item in index.term_total.keys():
-            pls = index.read_posting_list(item, comp)
-            if len(pls) != 0:
-                normalized_tfidf = [(doc_id, (freq / index.DL[doc_id]) * math.log(len(index.DL) / index.df[item], 10))
-                                    for
-                                    doc_id, freq in pls]
-                for doc_id, tfidf in normalized_tfidf:
-                    if tfidf > 0.1:
-                        candidates[(doc_id, item)] = candidates.get((doc_id, item), 0) + tfidf
-    return candidates
-
-
-def generate_document_tfidf_matrix(query_to_search, index, comp):
-    """
-    Generate a DataFrame `doc_mat` of tfidf scores for a given query.
-    Rows will be the documents candidates for a given query
-    Columns will be the unique terms in the index.
-    The value for a given document and term will be its tfidf score.
+    (doc_ids, scores): numpy arrays of the distinct doc ids in ascending order and their summed scores.
+    """
+    if len(doc_ids) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    unique_ids, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+    return unique_ids, np.bincount(inverse, weights=np.concatenate(scores), minlength=len(unique_ids))
+
+
+def get_body_tfidf_scores(query_to_search, index, comp, postings=None):
+    """
+    Score the candidate documents of a query term-at-a-time. Every query term adds, for each document in its
+    posting list, its normalized tfidf (tf normalized by the document length, log base 10 idf) weighted by the
+    query tfidf vector.
+    When the index stores document norms (see InvertedIndex.compute_norms) the score is the true cosine: the
+    dot product over every posting divided by the norms of the query and of the document. Otherwise postings with
+    tfidf <= 0.1 are skipped and the sum is divided by the squared norm of the query vector, which gives the same
+    scores as the DataFrame based cosine similarity it replaced.
 
     Parameters:
     -----------
@@ -118,60 +161,288 @@ def generate_document_tfidf_matrix(query_to_search, index, comp):
 
     index:           inverted index loaded from the corresponding files.
 
+    comp:            string, directory name for component in gcp
 
-    words,pls: iterator for working with posting.
+    postings:        optional dictionary of term -> (doc_ids, tfs) already read (see get_posting_arrays).
 
     Returns:
     -----------
-    DataFrame of tfidf scores.
+    (doc_ids, scores): numpy arrays of the candidate doc ids in ascending order and their scores.
+    """
+    query_vec = generate_query_tfidf_vector(query_to_search, index)  # vectorized query with tfidf scores.
+    query_norm = np.linalg.norm(query_vec)
+    doc_ids_parts, scores_parts = [], []
+    for term, count in _query_term_counts(query_to_search, index):
+        if term not in index.term_total.keys():
+            continue
+        doc_ids, tfs = postings[term] if postings is not None else index.read_posting_arrays(term, comp)
+        if len(doc_ids) == 0:
+            continue
+        doc_ids, scores = _term_scores(index, doc_ids, tfs, _body_idf(index, term), count,
+                                       query_vec[query_to_search.index(term)])
+        doc_ids_parts.append(doc_ids)
+        scores_parts.append(scores)
+    doc_ids, scores = accumulate_scores(doc_ids_parts, scores_parts)
+    return doc_ids, scores / _score_divisor(index, query_norm)
+
+
+def _body_idf(index, term):
+    return math.log(len(index.DL) / index.df[term], 10)
+
+
+def _query_term_counts(query_to_search, index):
+    """ Distinct query terms and the number of times their score is added: once per occurrence of the term in the
+        query for the legacy score, once for the true cosine (the query tf is already in the query vector).
     """
-    # lecturer code
-    candidates_scores = get_candidate_documents_and_scores(query_to_search, index,
-                                                           comp)  # We do not need to utilize all document. Only the documents which have corresponding terms with the query.
-    unique_candidates = np.unique([doc_id for doc_id, freq in candidates_scores.keys()])
-    doc_mat = np.zeros((len(unique_candidates), len(query_to_search)))
-    doc_mat = pd.DataFrame(doc_mat)
+    counts = Counter(query_to_search)
+    return counts.items() if index.norms is None else ((term, 1) for term in counts)
+
 
-    doc_mat.index = unique_candidates
-    doc_mat.columns = query_to_search
+def _score_divisor(index, query_norm):
+    """ The legacy score divides by the squared query norm, the true cosine by the query norm (the document norm
+        is divided by per posting).
+    """
+    return query_norm * query_norm if index.norms is None else query_norm
 
-    for key in candidates_scores:
-        tfidf = candidates_scores[key]
-        doc_id, term = key
-        doc_mat.loc[doc_id][term] = tfidf
 
-    return doc_mat
+def _term_scores(index, doc_ids, tfs, idf, count, query_weight):
+    """ Contribution of one query term to the (unnormalized) cosine of the documents of its postings. """
+    normalized_tfidf = (tfs / index.doc_lengths(doc_ids)) * idf
+    if index.norms is not None:
+        # the document norm covers every term of the document, so the cosine keeps every posting
+        return doc_ids, count * normalized_tfidf * query_weight / index.doc_norms(doc_ids)
+    keep = normalized_tfidf > 0.1
+    # a term repeated in the query adds its tfidf once per occurrence
+    return doc_ids[keep], count * normalized_tfidf[keep] * query_weight
 
 
-def cosine_similarity(doc_mat, query_vec):
+def _kth_highest(scores, k):
+    """ Returns the k-th highest score, or 0 when there are fewer than k scores. """
+    if len(scores) < k:
+        return 0.0
+    return np.partition(scores, len(scores) - k)[len(scores) - k]
+
+
+# Scores are rounded to 5 digits, a document is only pruned when its upper bound is this much below the threshold,
+# so pruning never changes the rounded top k or its tie order.
+PRUNING_MARGIN = 1e-5
+
+
+def get_body_top_k_scores(query_to_search, index, comp, k=100, postings=None):
     """
-    Calculate the cosine similarity for each candidate document in D and a given query (e.g., Q).
-    Generate a dictionary of cosine similarity scores
-    key: doc_id
-    value: cosine similarity score
+    Same scores as get_body_tfidf_scores, using MaxScore dynamic pruning with the score bounds stored in the
+    index: only the documents that can still reach the top k are scored.
+    Terms are processed by decreasing score bound. Once the bounds of the remaining terms add up to less than the
+    k-th best accumulated score, no document that was not seen yet can enter the top k, and the remaining
+    (non-essential) terms only update the documents already accumulated. Before each of them, a document whose
+    score plus the block-max bounds of the remaining terms is below the k-th best score is dropped, and only the
+    posting blocks that may hold one of the documents left are read. Without norms, a term whose max tfidf is not
+    above the 0.1 cut-off is not read at all.
+    Indexes without score bounds fall back to get_body_tfidf_scores.
 
     Parameters:
     -----------
-    D: DataFrame of tfidf scores.
+    query_to_search: list of tokens (str).
+    index:           inverted index loaded from the corresponding files.
+    comp:            string, directory name for component in gcp
+    k:               int, number of top documents whose score has to be exact.
+    postings:        optional dictionary of term -> (doc_ids, tfs) already read (see get_posting_arrays).
 
-    Q: vectorized query with tfidf scores
+    Returns:
+    -----------
+    (doc_ids, scores): numpy arrays of doc ids in ascending order and their scores, a subset of the candidates
+    that contains the top k documents.
+    """
+    query_vec = generate_query_tfidf_vector(query_to_search, index)
+    query_norm = np.linalg.norm(query_vec)
+    if not index.has_score_bounds() or k is None or query_norm == 0:
+        return get_body_tfidf_scores(query_to_search, index, comp, postings)
+    # (term, idf, count, query weight, per-block last doc ids, per-block bounds, term bound), unnormalized scores
+    terms = []
+    for term, count in _query_term_counts(query_to_search, index):
+        bounds = index.score_bounds(term) if term in index.term_total.keys() else None
+        if bounds is None:
+            continue
+        max_tf_norm, block_last_doc, block_max = bounds
+        idf = _body_idf(index, term)
+        if index.norms is None and max_tf_norm * idf <= 0.1:
+            continue
+        query_weight = query_vec[query_to_search.index(term)]
+        terms.append((term, idf, count, query_weight, block_last_doc, block_max,
+                      count * max_tf_norm * idf * query_weight))
+    terms.sort(key=lambda t: -t[-1])
+    remaining = np.cumsum([t[-1] for t in terms][::-1])[::-1].tolist() + [0.0]
+    margin = PRUNING_MARGIN * _score_divisor(index, query_norm)
+    read = lambda term: postings[term] if postings is not None else index.read_posting_arrays(term, comp)
+
+    # essential terms: every posting is scored
+    doc_ids, scores = accumulate_scores([], [])
+    n_essential = 0
+    while n_essential < len(terms) and (len(doc_ids) < k or
+                                        remaining[n_essential] >= _kth_highest(scores, k) - margin):
+        term, idf, count, query_weight = terms[n_essential][:4]
+        term_doc_ids, term_scores = _term_scores(index, *read(term), idf, count, query_weight)
+        doc_ids, scores = accumulate_scores([doc_ids, term_doc_ids], [scores, term_scores])
+        n_essential += 1
+
+    # non-essential terms: only the accumulated documents are updated
+    rest = terms[n_essential:]
+    if len(rest) != 0 and len(doc_ids) != 0:
+        block_nos = np.array([np.searchsorted(t[4], doc_ids) for t in rest])
+        block_bounds = np.array([
+            np.where(b < len(t[4]), t[5][np.minimum(b, len(t[4]) - 1)], 0) * (t[2] * t[1] * t[3])
+            for t, b in zip(rest, block_nos)])
+        upper_rest = block_bounds.sum(axis=0)
+        for j, (term, idf, count, query_weight, block_last_doc, _, _) in enumerate(rest):
+            alive = scores + upper_rest >= _kth_highest(scores, k) - margin
+            doc_ids, scores, upper_rest = doc_ids[alive], scores[alive], upper_rest[alive]
+            block_nos, block_bounds = block_nos[:, alive], block_bounds[:, alive]
+            blocks = np.unique(block_nos[j][block_nos[j] < len(block_last_doc)])
+            if postings is not None:
+                term_doc_ids, term_tfs = postings[term]
+            else:
+                term_doc_ids, term_tfs = index.read_posting_blocks(term, comp, blocks)
+            if len(term_doc_ids) != 0:
+                pos = np.minimum(np.searchsorted(term_doc_ids, doc_ids), len(term_doc_ids) - 1)
+                found = np.flatnonzero(term_doc_ids[pos] == doc_ids)
+                matched_doc_ids, term_scores = _term_scores(index, term_doc_ids[pos[found]], term_tfs[pos[found]],
+                                                            idf, count, query_weight)
+                scores[found[np.searchsorted(doc_ids[found], matched_doc_ids)]] += term_scores
+            upper_rest = upper_rest - block_bounds[j]
+    return doc_ids, scores / _score_divisor(index, query_norm)
+
+
+# Number of postings of a champion list scored at a time by the fast mode.
+CHAMPION_SEGMENT_SIZE = 64
+
+
+def get_body_champion_scores(query_to_search, index, comp, k=100, postings=None):
+    """
+    Fast, approximate body scoring that only reads the champion lists of the query terms (their top documents by
+    normalized tfidf, stored in impact order in the term dictionary), so no posting file is read.
+    The lists are scored score-at-a-time: the next CHAMPION_SEGMENT_SIZE postings of the list with the highest
+    next contribution are added, and scoring stops as soon as the next contributions of all the lists add up to
+    less than the k-th best score, since no document that was not seen yet can enter the top k from there. The
+    documents seen that can still reach the top k then get the rest of their scores from the lists.
+    Indexes without champion lists fall back to get_body_top_k_scores.
+
+    Parameters:
+    -----------
+    query_to_search: list of tokens (str).
+    index:           inverted index loaded from the corresponding files.
+    comp:            string, directory name for component in gcp
+    k:               int, number of documents to retrieve.
+    postings:        unused, the champion lists are read from the term dictionary.
 
     Returns:
     -----------
-    dictionary of cosine similarity score as follows:
-                                                                key: document id (e.g., doc_id)
-                                                                value: cosine similarity score.
+    (doc_ids, scores): numpy arrays of the scored doc ids in ascending order and their (partial) scores.
     """
-    cos_sim_scores = {}
-    # Loop through each document in the index of the document matrix
-    for doc_id in doc_mat.index:
-        # Get the document vector for the current document
-        doc_vec = doc_mat.loc[doc_id].values
-        # Calculate the cosine similarity between the document vector and the query vector
-        cos_sim = np.dot(doc_vec, query_vec) / (np.linalg.norm(query_vec) * np.linalg.norm(query_vec))
-        # Add the cosine similarity score to the cos_sim_scores dictionary with the document ID as the key
-        cos_sim_scores[doc_id] = cos_sim
-    return cos_sim_scores
+    query_vec = generate_query_tfidf_vector(query_to_search, index)
+    query_norm = np.linalg.norm(query_vec)
+    if not index.has_champions() or k is None or query_norm == 0:
+        return get_body_top_k_scores(query_to_search, index, comp, k, postings)
+    lists = []
+    for term, count in _query_term_counts(query_to_search, index):
+        champions = index.champion_list(term) if term in index.term_total.keys() else None
+        if champions is None:
+            continue
+        # the cut-off keeps the impact order
+        lists.append(_term_scores(index, *champions, _body_idf(index, term), count,
+                                  query_vec[query_to_search.index(term)]))
+    cursors = [0] * len(lists)
+    doc_ids, scores = accumulate_scores([], [])
+    while True:
+        heads = [list_scores[cursor] if cursor < len(list_scores) else 0.0
+                 for (_, list_scores), cursor in zip(lists, cursors)]
+        if not any(heads) or (len(doc_ids) >= k and sum(heads) < _kth_highest(scores, k)):
+            break
+        i = int(np.argmax(heads))
+        segment = slice(cursors[i], cursors[i] + CHAMPION_SEGMENT_SIZE)
+        doc_ids, scores = accumulate_scores([doc_ids, lists[i][0][segment]], [scores, lists[i][1][segment]])
+        cursors[i] += CHAMPION_SEGMENT_SIZE
+    # the top k is not ranked by the partial scores of the lists stopped early
+    alive = np.flatnonzero(scores + sum(heads) >= _kth_highest(scores, k))
+    for (list_doc_ids, list_scores), cursor in zip(lists, cursors):
+        if cursor >= len(list_doc_ids) or len(alive) == 0:
+            continue
+        order = np.argsort(list_doc_ids[cursor:])
+        rest_doc_ids, rest_scores = list_doc_ids[cursor:][order], list_scores[cursor:][order]
+        pos = np.minimum(np.searchsorted(rest_doc_ids, doc_ids[alive]), len(rest_doc_ids) - 1)
+        found = rest_doc_ids[pos] == doc_ids[alive]
+        scores[alive[found]] += rest_scores[pos[found]]
+    return doc_ids, scores / _score_divisor(index, query_norm)
+
+
+def get_body_bm25_scores(query_to_search, index, comp, k=100, postings=None):
+    """
+    BM25 scores read from an impact index (see index_builder.build_impact_index), whose postings hold the BM25
+    score of the document for the term quantized to 8 bits. The score of a document is the sum of the impacts of
+    its postings for the query terms (once per occurrence of the term in the query), an exact integer sum, times
+    the score of one impact unit.
+
+    Parameters:
+    -----------
+    query_to_search: list of tokens (str).
+    index:           impact index loaded from the corresponding files.
+    comp:            string, directory name for component in gcp
+    k:               unused, every candidate is scored.
+    postings:        optional dictionary of term -> (doc_ids, impacts) already read (see get_posting_arrays).
+
+    Returns:
+    -----------
+    (doc_ids, scores): numpy arrays of the candidate doc ids in ascending order and their BM25 scores.
+    """
+    if index.impact_scale is None:
+        raise ValueError("BM25 scoring needs an index of quantized impacts")
+    doc_ids_parts, impacts_parts = [], []
+    for term, count in Counter(query_to_search).items():
+        doc_ids, impacts = postings[term] if postings is not None else index.read_posting_arrays(term, comp)
+        doc_ids_parts.append(doc_ids)
+        impacts_parts.append(count * impacts)
+    doc_ids, impacts = accumulate_scores(doc_ids_parts, impacts_parts)
+    return doc_ids, impacts * index.impact_scale
+
+
+# Body retrieval modes, each mode is a function (query_to_search, index, comp, k, postings=None) -> (doc_ids, scores)
+# The bm25 mode scores the impact index of the body instead of the body index.
+BODY_MODES = {"exhaustive": get_body_top_k_scores, "fast": get_body_champion_scores, "bm25": get_body_bm25_scores}
+
+
+def body_mode_report(queries, index, comp, mode="fast", n=100, baseline="exhaustive"):
+    """
+    Compares a body retrieval mode against a baseline mode (by default the fast mode against the exhaustive one).
+
+    Parameters:
+    -----------
+    queries: list of queries, each a list of tokens.
+    index:   inverted index loaded from the corresponding files.
+    comp:    string, directory name for component in gcp
+    mode, baseline: names of BODY_MODES.
+    n:       Integer, number of results compared.
+
+    Returns:
+    -----------
+    dictionary with, for each of the two modes, the mean, p50 and p95 latency in milliseconds, the mean overlap of
+    the top n of the mode with the top n of the baseline ("recall") and the share of queries whose top 10 is the
+    same ("same_top_10").
+    """
+    latencies = {mode: [], baseline: []}
+    recalls, same_top_10 = [], []
+    for query in queries:
+        results = {}
+        for m in (baseline, mode):
+            t_start = time.perf_counter()
+            results[m] = [doc_id for doc_id, _ in get_top_n_arrays(*BODY_MODES[m](query, index, comp, n), n)]
+            latencies[m].append((time.perf_counter() - t_start) * 1000)
+        expected = set(results[baseline])
+        recalls.append(len(expected.intersection(results[mode])) / len(expected) if expected else 1.0)
+        same_top_10.append(results[mode][:10] == results[baseline][:10])
+    report = {m: {"mean_ms": float(np.mean(times)), "p50_ms": float(np.percentile(times, 50)),
+                  "p95_ms": float(np.percentile(times, 95))} for m, times in latencies.items() if times}
+    report["recall"] = float(np.mean(recalls)) if recalls else None
+    report["same_top_10"] = float(np.mean(same_top_10)) if same_top_10 else None
+    return report
 
 
 def get_top_n(sim_dict, n=3):
@@ -191,12 +462,21 @@ def get_top_n(sim_dict, n=3):
     -----------
     a ranked list of pairs (doc_id, score) in the length of N.
     """
-    # lecturer code
-    return sorted([(doc_id, round(score, 5)) for doc_id, score in sim_dict.items()], key=lambda x: x[1], reverse=True)[
-           :n]
+    doc_ids = np.fromiter(sim_dict.keys(), dtype=np.int64, count=len(sim_dict))
+    scores = np.fromiter(sim_dict.values(), dtype=np.float64, count=len(sim_dict))
+    return get_top_n_arrays(doc_ids, scores, n)
 
 
-def get_top_n_score_for_queries(queries_to_search, index, comp, n=3):
+def get_top_n_arrays(doc_ids, scores, n=3):
+    """
+    Same as get_top_n, for parallel arrays of doc ids and similarity scores. Ties keep the order of the arrays.
+    """
+    scores = np.round(scores, 5)
+    order = top_k(scores, n)
+    return list(zip(doc_ids[order].tolist(), scores[order].tolist()))
+
+
+def get_top_n_score_for_queries(queries_to_search, index, comp, n=3, mode="exhaustive", postings=None):
     """
     Generate a dictionary that gathers for every query its topN score.
 
@@ -207,6 +487,8 @@ def get_top_n_score_for_queries(queries_to_search, index, comp, n=3):
                                                         value: list of tokens.
     index:           inverted index loaded from the corresponding files.
     N: Integer. How many documents to retrieve. This argument is passed to the topN function. By default, N = 3, for the topN function.
+    mode: name of the body retrieval mode, see BODY_MODES.
+    postings: optional dictionary of term -> posting arrays already read (see get_posting_arrays).
 
     Returns:
     -----------
@@ -214,70 +496,125 @@ def get_top_n_score_for_queries(queries_to_search, index, comp, n=3):
                                                         key: query_id
                                                         value: list of pairs in the following format:(doc_id, score).
     """
-    doc_mat = generate_document_tfidf_matrix(queries_to_search, index,
-                                             comp)  # DataFrame of tfidf scores (rows are documents candidate for a given query and columns are terms).
-    query_vec = generate_query_tfidf_vector(queries_to_search, index)  # vectorized query with tfidf scores.
-    sim_scores = cosine_similarity(doc_mat, query_vec)  # send both to get the cosine similarity dictionary.
-    return get_top_n(sim_scores, n)  # save best N sim_scores of the query we are iterating at.
+    doc_ids, scores = BODY_MODES[mode](queries_to_search, index, comp, n, postings)  # cosine similarity of the candidates.
+    return get_top_n_arrays(doc_ids, scores, n)  # save best N sim_scores of the query we are iterating at.
+
+
+# --- Score fusion --- #
+# Constant of reciprocal rank fusion, a document ranked r-th by a signal gets weight / (RRF_K + r) from it.
+RRF_K = 60
+
+
+def _max_normalized(values):
+    """ Divides by the maximum value (or 1 when there is none), documents without a value get 0. """
+    present = ~np.isnan(values)
+    max_value = values[present].max() if present.any() else 1
+    return np.where(present, values, 0) / (max_value if max_value > 0 else 1)
+
+
+def weighted_sum_fusion(signals, weights):
+    """
+    Sum of the max-normalized signals, each multiplied by its weight.
+    :param signals: dict of signal name -> numpy array of values per candidate, NaN where a candidate has none
+    :param weights: dict of signal name -> float
+    :return: numpy array of fused scores per candidate
+    """
+    fused = np.zeros(len(next(iter(signals.values()))))
+    for name, values in signals.items():
+        fused += weights[name] * _max_normalized(values)
+    return fused
+
+
+def reciprocal_rank_fusion(signals, weights):
+    """
+    Weighted reciprocal rank fusion: a candidate ranked r-th by a signal gets weight / (RRF_K + r) from it.
+    :param signals: dict of signal name -> numpy array of values per candidate, NaN where a candidate has none
+    :param weights: dict of signal name -> float
+    :return: numpy array of fused scores per candidate
+    """
+    fused = np.zeros(len(next(iter(signals.values()))))
+    for name, values in signals.items():
+        present = np.flatnonzero(~np.isnan(values))
+        ranks = np.empty(len(present))
+        ranks[np.argsort(-values[present], kind='stable')] = np.arange(1, len(present) + 1)
+        fused[present] += weights[name] / (RRF_K + ranks)
+    return fused
+
+
+FUSION_STRATEGIES = {"weighted_sum": weighted_sum_fusion, "rrf": reciprocal_rank_fusion}
+
+
+def fuse_results(fields, priors, weights, n=100, strategy="weighted_sum", timings=None):
+    """
+    Fuses per-field retrieval results and per-document priors into one ranking. The candidates are the
+    documents retrieved by any field, the scores of every signal are laid out as one array per signal over the
+    candidates and combined by the fusion strategy in a single vectorized pass. A candidate without a value for
+    a signal (not retrieved by a field, no PageRank...) gets nothing from that signal.
+    :param fields: dict of field name -> list of pairs (doc_id, score) or (doc_ids, scores) numpy arrays
+    :param priors: dict of prior name -> DocColumn (e.g. PageRank and page views)
+    :param weights: dict of signal name (field or prior) -> float
+    :param n: int, number of results to return
+    :param strategy: str, name of a strategy in FUSION_STRATEGIES
+    :param timings: optional dict, the time fusion took (in seconds) is stored under "fusion"
+    :return: list of pairs (doc_id, score), best first
+    """
+    t_start = time.perf_counter()
+    fields = {name: _as_arrays(results) for name, results in fields.items()}
+    candidate_ids = np.unique(np.concatenate([doc_ids for doc_ids, _ in fields.values()] +
+                                             [np.empty(0, dtype=np.int64)]))
+    res = []
+    if len(candidate_ids) != 0:
+        signals = {}
+        for name, (doc_ids, scores) in fields.items():
+            values = np.full(len(candidate_ids), np.nan)
+            values[np.searchsorted(candidate_ids, doc_ids)] = scores
+            signals[name] = values
+        for name, prior in priors.items():
+            signals[name] = prior.gather(candidate_ids).astype(np.float64)
+        fused = FUSION_STRATEGIES[strategy](signals, weights)
+        order = top_k(fused, n)
+        res = list(zip(candidate_ids[order].tolist(), fused[order].tolist()))
+    elapsed = time.perf_counter() - t_start
+    if timings is not None:
+        timings["fusion"] = elapsed
+    logger.debug("%s fusion of %d candidates took %.3f ms", strategy, len(candidate_ids), elapsed * 1000)
+    return res
+
+
+def _as_arrays(results):
+    if isinstance(results, tuple) and len(results) == 2 and isinstance(results[0], np.ndarray):
+        return results
+    doc_ids = np.fromiter((doc_id for doc_id, _ in results), dtype=np.int64, count=len(results))
+    scores = np.fromiter((score for _, score in results), dtype=np.float64, count=len(results))
+    return doc_ids, scores
 
 
 def merge_results(title_scores, body_scores, anchor_scores, page_rank, page_views, title_weight=0.45, text_weight=0.34,
-                  anchor_weight=0.04, pr_weight=0.12, pv_weight=0.05, n=3):
+                  anchor_weight=0.04, pr_weight=0.12, pv_weight=0.05, n=3, strategy="weighted_sum", timings=None):
     """
     This function merge and sort documents retrieved by its weighted score (e.g., title and body).
 
     Parameters: ----------- title_scores: a dictionary build upon the title index of queries and tuples representing
     scores as follows: key: query_id value: list of pairs in the following format:(doc_id,score)
 
+    page_rank, page_views: DocColumn of the document store, wiki_id -> PageRank / page views
+
     body_scores: a dictionary build upon the body/text index of queries and tuples representing scores as follows:
     key: query_id value: list of pairs in the following format:(doc_id,score) title_weight: float, for weighted
     average utilizing title and body scores text_weight: float, for weighted average utilizing title and body scores
     N: Integer. How many document to retrieve. This argument is passed to topN function. By default, N = 3,
     for the topN function.
 
+    strategy: name of the fusion strategy (see FUSION_STRATEGIES), timings: optional dict for the fusion time.
+
     Returns:
     -----------
     dictionary of queries and topN pairs as follows:
                                                         key: query_id
                                                         value: list of pairs in the following format:(doc_id,score).
     """
-    # Find the maximum score in the title, body, and anchor scores list
-    max_score_title = max(title_scores, key=lambda x: x[1])[1] if len(title_scores) != 0 else 1
-    max_score_body = max(body_scores, key=lambda x: x[1])[1] if len(body_scores) != 0 else 1
-    max_score_anchor = max(anchor_scores, key=lambda x: x[1])[1] if len(anchor_scores) != 0 else 1
-
-    # Get all candidate doc_ids
-    title_scores, body_scores, anchor_scores = dict(title_scores), dict(body_scores), dict(anchor_scores)
-    all_candidate_docs = set(title_scores.keys()) | set(body_scores.keys()) | set(anchor_scores.keys())
-
-    # Get the maximum page rank and page views for the relevant documents
-    relevant_page_ranks = []
-    relevant_page_views = []
-    for wiki_id in all_candidate_docs:
-        wiki_id = str(wiki_id)
-        relevant_page_ranks += [page_rank[wiki_id]] if wiki_id in page_rank else []
-        relevant_page_views += [page_views[wiki_id]] if wiki_id in page_views else []
-
-    max_page_ranks = max(relevant_page_ranks) if len(relevant_page_ranks) != 0 else 1
-    max_page_views = max(relevant_page_views) if len(relevant_page_views) != 0 else 1
-
-    # Create a dictionary to store the merged scores
-    merged_score_dict = {}
-
-    # Loop through all the candidate documents
-    for doc_id in all_candidate_docs:
-        # Calculate the scores for each metric
-        try:
-            page_rank_score = page_rank[str(doc_id)] * pr_weight / max_page_ranks
-            page_view_score = page_views[str(doc_id)] * pv_weight / max_page_views
-            title_score = title_weight * next((s for d, s in title_scores.items() if d == doc_id), 0) / max_score_title
-            body_score = text_weight * next((s for d, s in body_scores.items() if d == doc_id), 0) / max_score_body
-            anchor_score = anchor_weight * next((s for d, s in anchor_scores.items() if d == doc_id), 0) / max_score_anchor
-            merged_score = title_score + body_score + anchor_score + page_rank_score + page_view_score
-            merged_score_dict[doc_id] = merged_score
-        except KeyError:
-            continue
-
-    merged_scores = sorted([(doc_id, score) for doc_id, score in merged_score_dict.items()],
-                           key=lambda x: x[1], reverse=True)[:n]
-    return merged_scores
+    fields = {"title": title_scores, "body": body_scores, "anchor": anchor_scores}
+    priors = {"page_rank": page_rank, "page_views": page_views}
+    weights = {"title": title_weight, "body": text_weight, "anchor": anchor_weight, "page_rank": pr_weight,
+               "page_views": pv_weight}
+    return fuse_results(fields, priors, weights, n, strategy, timings)
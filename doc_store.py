@@ -0,0 +1,316 @@
+import json
+import logging
+import threading
+import time
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+from inverted_index_gcp import SortedArrayMap
+
+logger = logging.getLogger(__name__)
+
+# --- Missing values --- #
+# Value stored in a column for documents that have no entry for it, per column kind.
+MISSING_FLOAT = np.nan
+MISSING_INT = -1
+
+
+def _missing_value(dtype):
+    return MISSING_FLOAT if np.issubdtype(dtype, np.floating) else MISSING_INT
+
+
+# --- Column types --- #
+# Signed types, so MISSING_INT fits. Document lengths are int32 columns named dl_<component dir>.
+COLUMN_DTYPES = {'pagerank': np.float64, 'pageviews': np.int64}
+DL_DTYPE = np.int32
+
+
+# --- Lazily loaded arrays --- #
+class LazyArrays(Mapping):
+    """ Read-only dict of name -> array that loads each array on first access and logs how long it took. """
+
+    def __init__(self, names, loader, label):
+        self._names = list(names)
+        self._loader = loader
+        self._label = label
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        array = self._arrays.get(name)
+        if array is None:
+            if name not in self._names:
+                raise KeyError(name)
+            with self._lock:
+                array = self._arrays.get(name)
+                if array is None:
+                    t_start = time.time()
+                    array = self._arrays[name] = self._loader(name)
+                    logger.info("loaded %s/%s in %.3fs (%d bytes)", self._label, name, time.time() - t_start,
+                                array.nbytes)
+        return array
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def loaded(self):
+        """ Returns the arrays that were loaded so far. """
+        return dict(self._arrays)
+
+
+# --- DocColumn --- #
+class DocColumn(SortedArrayMap):
+    """ Read-only mapping of wiki_id -> value of one per-document column of a DocStore. The keys array is the
+        doc ids array shared by all the columns of the store, documents without a value are not in the mapping.
+    """
+
+    def __init__(self, doc_ids, values):
+        # `values` is the column array, or a callable returning it, so a lazily loaded column is only read on
+        # the first lookup.
+        self.keys_array = doc_ids
+        self._values = values
+        self._len = None
+
+    @property
+    def values_array(self):
+        if callable(self._values):
+            self._values = self._values()
+        return self._values
+
+    @property
+    def _missing(self):
+        return _missing_value(self.values_array.dtype)
+
+    def _present(self, values):
+        return ~np.isnan(values) if np.issubdtype(values.dtype, np.floating) else values != self._missing
+
+    def lookup(self, keys):
+        """
+        Vectorized lookup of an array of wiki ids that keeps the dtype of the column.
+        :param keys: array of int, wiki ids
+        :return: (values, found) arrays, one entry per id, the value of an id that is not found is meaningless
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.keys_array) == 0:
+            return np.zeros(len(keys), dtype=self.values_array.dtype), np.zeros(len(keys), dtype=bool)
+        pos, found = self._positions(keys)
+        values = self.values_array[pos]
+        return values, found & self._present(values)
+
+    def gather(self, keys, missing=np.nan):
+        """
+        Vectorized lookup of an array of wiki ids.
+        :param keys: array of int, wiki ids
+        :param missing: value returned for ids without a value in the column
+        :return: numpy array, one value per id
+        """
+        values, found = self.lookup(keys)
+        return np.where(found, values, missing)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        if len(self.keys_array) == 0:
+            return False
+        pos, found = self._positions(key)
+        return bool(found) and bool(self._present(self.values_array[pos:pos + 1])[0])
+
+    def __iter__(self):
+        return iter(self.keys_array[self._present(self.values_array)].tolist())
+
+    def __len__(self):
+        if self._len is None:
+            self._len = int(np.count_nonzero(self._present(self.values_array)))
+        return self._len
+
+
+# --- DocStore --- #
+class DocStore:
+    """ Per-document data of the whole corpus as NumPy arrays indexed by a dense document ordinal.
+        The ordinal of a wiki id is its position in the sorted `doc_ids` array, so mapping a batch of ids to
+        ordinals is a single vectorized binary search (see DocColumn.lookup).
+    """
+
+    def __init__(self, doc_ids, columns):
+        self.doc_ids = doc_ids
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def column(self, name):
+        """
+        Returns a dict-like view of a column.
+        :param name: str
+        :return: DocColumn
+        """
+        if name not in self.columns:
+            raise KeyError(name)
+        return DocColumn(self.doc_ids, lambda: self.columns[name])
+
+    def memory_usage(self):
+        """ Returns the number of bytes of the arrays loaded so far (memory-mapped arrays are shared page cache). """
+        columns = self.columns.loaded() if isinstance(self.columns, LazyArrays) else self.columns
+        return self.doc_ids.nbytes + sum(a.nbytes for a in columns.values())
+
+    @staticmethod
+    def build(columns, dtypes=None, doc_ids=None):
+        """
+        Builds a store from per-document dicts, e.g. the PageRank and page views JSON dicts (keyed by string
+        wiki ids) and the DL dicts of the indexes. The ordinals cover the union of all the dicts keys.
+        :param columns: dict of column name -> dict of wiki_id -> value
+        :param dtypes: dict of column name -> numpy dtype, float64 by default
+        :param doc_ids: array of int, more wiki ids to give ordinals to
+        :return: DocStore
+        """
+        dtypes = dtypes or {}
+        keys = {name: np.fromiter(map(int, d.keys()), dtype=np.int64, count=len(d)) for name, d in columns.items()}
+        all_keys = list(keys.values()) + ([np.asarray(doc_ids, dtype=np.int64)] if doc_ids is not None else [])
+        doc_ids = np.unique(np.concatenate(all_keys)) if all_keys else np.empty(0, dtype=np.int64)
+        arrays = {}
+        for name, d in columns.items():
+            dtype = np.dtype(dtypes.get(name, np.float64))
+            values = np.full(len(doc_ids), _missing_value(dtype), dtype=dtype)
+            values[np.searchsorted(doc_ids, keys[name])] = np.fromiter(d.values(), dtype=dtype, count=len(d))
+            arrays[name] = values
+        return DocStore(doc_ids, arrays)
+
+    def save(self, directory):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / 'doc_ids.npy', self.doc_ids)
+        for name, values in self.columns.items():
+            np.save(directory / f'{name}.npy', values)
+        # columns.json is written last, its presence marks a complete store.
+        with open(directory / 'columns.json', 'w') as f:
+            json.dump(list(self.columns), f)
+
+    @staticmethod
+    def exists(backend, base_dir):
+        return backend.exists(f"{base_dir}/columns.json")
+
+    @staticmethod
+    def load(backend, base_dir):
+        """
+        Loads a saved store from a storage backend. The arrays are memory-mapped (remote files are first
+        downloaded to the local index cache) and every column is only loaded on its first use.
+        :param backend: StorageBackend
+        :param base_dir: str, directory of the store in the backend
+        :return: DocStore
+        """
+        load = lambda name: np.load(backend.local_path(f"{base_dir}/{name}.npy"), mmap_mode='r')
+        names = json.loads(backend.read_file(f"{base_dir}/columns.json"))
+        t_start = time.time()
+        doc_ids = load('doc_ids')
+        logger.info("loaded %s/doc_ids in %.3fs (%d documents)", base_dir, time.time() - t_start, len(doc_ids))
+        return DocStore(doc_ids, LazyArrays(names, load, base_dir))
+
+
+def build_doc_store(page_rank, page_views, indexes, doc_ids=None):
+    """
+    Builds the corpus document store out of the PageRank and page views dicts and the document lengths of
+    the indexes.
+    :param page_rank: dict, wiki_id -> PageRank
+    :param page_views: dict, wiki_id -> page views
+    :param indexes: dict, component dir name -> InvertedIndex
+    :param doc_ids: array of int, more wiki ids to give ordinals to (e.g. every titled article)
+    :return: DocStore
+    """
+    columns = {'pagerank': page_rank, 'pageviews': page_views}
+    dtypes = dict(COLUMN_DTYPES)
+    for comp, index in indexes.items():
+        columns[f'dl_{comp}'] = index.DL
+        dtypes[f'dl_{comp}'] = DL_DTYPE
+    return DocStore.build(columns, dtypes, doc_ids)
+
+
+# --- TitleStore --- #
+class TitleStore:
+    """ Article titles as one UTF-8 blob plus an offsets array indexed by doc ordinal: the title of ordinal i is
+        blob[offsets[i]:offsets[i + 1]]. Loaded memory-mapped, so forked workers share the pages instead of
+        each holding a dict of millions of strings.
+    """
+
+    def __init__(self, doc_ids, offsets, blob):
+        self.doc_ids = doc_ids
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def get_many(self, doc_ids):
+        """
+        Batch lookup of titles.
+        :param doc_ids: sequence of int, wiki ids
+        :return: list of str, None for ids without a title
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(self.doc_ids) == 0:
+            return [None] * len(doc_ids)
+        ords = np.minimum(np.searchsorted(self.doc_ids, doc_ids), len(self.doc_ids) - 1)
+        found = self.doc_ids[ords] == doc_ids
+        starts, ends = self.offsets[ords].tolist(), self.offsets[ords + 1].tolist()
+        blob = self.blob
+        return [blob[start:end].tobytes().decode('utf8') if ok else None
+                for ok, start, end in zip(found.tolist(), starts, ends)]
+
+    def __getitem__(self, doc_id):
+        title = self.get_many([doc_id])[0]
+        if title is None:
+            raise KeyError(doc_id)
+        return title
+
+    def memory_usage(self):
+        return self.offsets.nbytes + self.blob.nbytes
+
+    @staticmethod
+    def build(titles, doc_ids=None):
+        """
+        Builds a title store out of a dict of wiki_id -> title (e.g. the titles JSON, keyed by string ids).
+        :param titles: dict
+        :param doc_ids: sorted array of int, the ordinals to align with (the doc ids of a DocStore), by default
+                        the keys of `titles`
+        :return: TitleStore
+        """
+        titles = {int(doc_id): title for doc_id, title in titles.items()}
+        if doc_ids is None:
+            doc_ids = np.array(sorted(titles), dtype=np.int64)
+        encoded = [titles.get(doc_id, '').encode('utf8') for doc_id in doc_ids.tolist()]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(t) for t in encoded])
+        return TitleStore(doc_ids, offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def save(self, directory):
+        """ Writes the title arrays next to the doc_ids.npy of the DocStore the titles are aligned with. """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / 'title_blob.npy', self.blob)
+        np.save(directory / 'title_offsets.npy', self.offsets)
+
+    @staticmethod
+    def exists(backend, base_dir):
+        return backend.exists(f"{base_dir}/title_offsets.npy")
+
+    @staticmethod
+    def load(backend, base_dir):
+        """
+        Loads a saved title store with memory-mapped arrays.
+        :param backend: StorageBackend
+        :param base_dir: str, directory of the document store in the backend
+        :return: TitleStore
+        """
+        load = lambda name: np.load(backend.local_path(f"{base_dir}/{name}.npy"), mmap_mode='r')
+        t_start = time.time()
+        titles = TitleStore(load('doc_ids'), load('title_offsets'), load('title_blob'))
+        logger.info("loaded %s/titles in %.3fs (%d titles, %d bytes)", base_dir, time.time() - t_start, len(titles),
+                    titles.memory_usage())
+        return titles
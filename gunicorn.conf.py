@@ -0,0 +1,39 @@
+""" Production server configuration, run with: gunicorn -c gunicorn.conf.py search_frontend:app
+
+    The app is imported once in the master process before the workers are forked, so the indexes, the document
+    store and the title store are loaded a single time and shared copy-on-write by all the workers (the
+    memory-mapped arrays are shared page cache). Each worker serves requests on a pool of threads.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8080")
+preload_app = True
+# The components are loaded before the workers are forked, they start ready.
+os.environ.setdefault("STARTUP_BACKGROUND", "0")
+
+# --- Workers --- #
+# Processes serving requests (one per core by default, the scoring is CPU bound) and threads per process.
+workers = int(os.environ.get("WEB_WORKERS", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+# Restart a worker after this many requests (0 never does), spread by a random jitter.
+max_requests = int(os.environ.get("WEB_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+# --- Timeouts --- #
+# Seconds a worker may be silent before it is killed and replaced.
+timeout = int(os.environ.get("WEB_TIMEOUT", 120))
+# Seconds the workers get to finish the requests in flight after a shutdown or reload signal.
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("WEB_KEEPALIVE", 5))
+
+accesslog = "-"
+
+
+def when_ready(server):
+    # Objects loaded so far are moved out of the garbage collector's generations, so collections in the workers
+    # do not write to the pages holding them, which would copy those pages into every worker.
+    gc.freeze()
+    server.log.info("application loaded, %d objects frozen", gc.get_freeze_count())
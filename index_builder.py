@@ -0,0 +1,159 @@
+import argparse
+import json
+import math
+from contextlib import closing
+from pathlib import Path
+
+import numpy as np
+
+from doc_store import TitleStore, build_doc_store
+from inverted_index_gcp import (BUCKET_NAME, POSTING_FORMAT_IMPACT, POSTING_FORMAT_RAW, POSTING_FORMAT_VARINT,
+                                InvertedIndex, MultiFileWriter, encode_postings, get_default_backend)
+
+# --- Default components: (directory, index name) --- #
+INDEXES = [("body", "body_index"), ("titles", "title_index"), ("anchor", "anchor_index")]
+
+
+# --- Posting format conversion --- #
+def convert_index(index, comp, base_dir, name, posting_format=POSTING_FORMAT_VARINT):
+    """
+    Rewrites the posting files of an existing index in another posting format. The posting files and
+    `name`.pkl are written to `base_dir` with file names relative to it, so the directory can be uploaded
+    (or pointed at with POSTINGS_ROOT) as a new index component.
+    Note that tfs above 65535 were already truncated in the legacy format and can not be recovered.
+    :param index: InvertedIndex, the index to convert
+    :param comp: string, directory name for component of the index to convert
+    :param base_dir: string, output directory
+    :param name: string, name of the converted index
+    :param posting_format: int, one of the POSTING_FORMAT_* versions
+    :return: InvertedIndex, the converted index
+    """
+    converted = InvertedIndex(posting_format)
+    _rewrite_postings(index, comp, converted, base_dir, name, lambda w, doc_ids, tfs: tfs)
+    return converted
+
+
+def _rewrite_postings(index, comp, converted, base_dir, name, values):
+    """ Writes every posting list of `index` to the posting files of `converted`, with the tfs replaced by
+        values(term, doc_ids, tfs), and the pickled globals of `converted`.
+    """
+    converted.DL = index.DL
+    converted.df = index.df
+    converted.term_total = index.term_total
+    Path(base_dir).mkdir(parents=True, exist_ok=True)
+    with closing(MultiFileWriter(base_dir, name)) as writer:
+        # iterate over posting lists in lexicographic order
+        for w in sorted(index.posting_locs.keys()):
+            doc_ids, tfs = index.read_posting_arrays(w, comp)
+            b = encode_postings(doc_ids, values(w, doc_ids, tfs), converted.posting_format)
+            locs = writer.write(b)
+            converted.posting_locs[w].extend((Path(f_name).name, offset) for f_name, offset in locs)
+            if converted.posting_format != POSTING_FORMAT_RAW:
+                converted.posting_bytes[w] = len(b)
+    converted._write_globals(base_dir, name)
+
+
+# --- Quantized BM25 impacts --- #
+def build_impact_index(index, comp, base_dir, name, k1=1.2, b=0.75):
+    """
+    Writes a copy of an index whose postings hold BM25 scores quantized to 8 bits (POSTING_FORMAT_IMPACT)
+    instead of tfs, so that scoring a query is summing integers. The scores are divided by the score of one
+    impact unit, `impact_scale`, which maps the highest possible score, the idf of the rarest term times
+    (k1 + 1), to 255. Every posting keeps an impact of at least 1.
+    :param index: InvertedIndex, the index to convert
+    :param comp: string, directory name for component of the index to convert
+    :param base_dir: string, output directory
+    :param name: string, name of the impact index
+    :param k1: float, BM25 tf saturation
+    :param b: float, BM25 document length normalization
+    :return: InvertedIndex, the impact index
+    """
+    n_docs = len(index.DL)
+    avg_dl = sum(index.DL.values()) / n_docs
+    idf = lambda df: math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+    converted = InvertedIndex(POSTING_FORMAT_IMPACT)
+    converted.impact_scale = idf(min(index.df.values())) * (k1 + 1) / 255
+    converted.impact_params = {'k1': k1, 'b': b}
+
+    def impacts(w, doc_ids, tfs):
+        norm = k1 * (1 - b + b * index.doc_lengths(doc_ids) / avg_dl)
+        scores = idf(index.df[w]) * tfs * (k1 + 1) / (tfs + norm)
+        return np.clip(np.rint(scores / converted.impact_scale), 1, 255)
+
+    _rewrite_postings(index, comp, converted, base_dir, name, impacts)
+    return converted
+
+
+# --- Document store --- #
+def write_doc_store(base_dir, indexes=INDEXES, bucket_name=BUCKET_NAME):
+    """
+    Builds the document store (dense doc ordinals with PageRank, page views and per-index document length
+    arrays) and the title store from the pr/pv/titles JSON components and the indexes, and writes them to
+    `base_dir`.
+    :param base_dir: string, output directory, uploaded as the "docs" component
+    :param indexes: list of (component dir, index name) pairs
+    :param bucket_name: string
+    :return: DocStore
+    """
+    backend = get_default_backend(bucket_name)
+    read_json = lambda component: json.loads(backend.read_file(f"{component}/{component}.json"))
+    titles = read_json("titles")
+    store = build_doc_store(read_json("pr"), read_json("pv"),
+                            {comp: InvertedIndex.read_index(bucket_name, comp, name) for comp, name in indexes},
+                            np.fromiter(map(int, titles.keys()), dtype=np.int64, count=len(titles)))
+    TitleStore.build(titles, store.doc_ids).save(base_dir)
+    store.save(base_dir)
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline tools for the search engine indexes.")
+    parser.add_argument("--bucket", default=BUCKET_NAME, help="bucket the indexes are read from")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="rewrite an index in another posting format")
+    convert.add_argument("comp", help="directory of the index component, e.g. body")
+    convert.add_argument("name", help="name of the index, e.g. body_index")
+    convert.add_argument("out_dir", help="directory to write the converted index to")
+    convert.add_argument("--format", type=int, default=POSTING_FORMAT_VARINT, dest="posting_format")
+
+    compact = commands.add_parser("compact", help="write the memory-mappable term dictionary of an index")
+    compact.add_argument("comp", help="directory of the index component, e.g. body")
+    compact.add_argument("name", help="name of the index, e.g. body_index")
+    compact.add_argument("out_dir", help="directory to write `name`_dict/ to, uploaded next to the posting files")
+    compact.add_argument("--bounds", action="store_true",
+                         help="also store the per-term and per-block score bounds used by dynamic pruning")
+    compact.add_argument("--champions", type=int, default=None, metavar="R",
+                         help="also store champion lists of the top R documents of every term (implies --bounds)")
+    compact.add_argument("--norms", action="store_true",
+                         help="also store the tf-idf vector norm of every document, for true cosine scores")
+
+    impacts = commands.add_parser("impacts", help="write a copy of an index with quantized BM25 impacts")
+    impacts.add_argument("comp", help="directory of the index component, e.g. body")
+    impacts.add_argument("name", help="name of the index, e.g. body_index")
+    impacts.add_argument("out_dir", help="directory to write the impact index to, e.g. body_bm25")
+    impacts.add_argument("out_name", help="name of the impact index, e.g. body_bm25_index")
+    impacts.add_argument("--k1", type=float, default=1.2)
+    impacts.add_argument("--b", type=float, default=0.75)
+
+    docs = commands.add_parser("docs", help="write the document store of the corpus")
+    docs.add_argument("out_dir", help="directory to write the store to, uploaded as the docs component")
+
+    args = parser.parse_args()
+    if args.command == "convert":
+        convert_index(InvertedIndex.read_index(args.bucket, args.comp, args.name), args.comp, args.out_dir,
+                      args.name, args.posting_format)
+    elif args.command == "compact":
+        if args.champions is not None and args.champions < 1:
+            parser.error("--champions R needs R >= 1")
+        scored = args.bounds or args.champions is not None or args.norms
+        index = InvertedIndex.read_index(args.bucket, args.comp, args.name)
+        if index.posting_format == POSTING_FORMAT_IMPACT and scored:
+            parser.error(f"{args.name} is an impact index, compact it without --bounds, --champions and --norms")
+        # champion lists are computed along with the score bounds, so they imply --bounds
+        index.write_compact(args.out_dir, args.name, args.comp if scored else None, args.champions, args.norms)
+    elif args.command == "impacts":
+        build_impact_index(InvertedIndex.read_index(args.bucket, args.comp, args.name), args.comp, args.out_dir,
+                           args.out_name, args.k1, args.b)
+    elif args.command == "docs":
+        write_doc_store(args.out_dir, bucket_name=args.bucket)
@@ -1,13 +1,26 @@
-import io
+import contextvars
+import json
+import math
+import mmap
 import os
-from collections import defaultdict, Counter
+import threading
+import time
+import weakref
+from collections import defaultdict, Counter, OrderedDict
+from collections.abc import Mapping
 import pickle
+import sys
+import tempfile
 import hashlib
+import heapq
 from pathlib import Path
-from itertools import count
+from itertools import count, islice
 from google.cloud import storage
 from contextlib import closing
 from operator import itemgetter
+import numpy as np
+
+import metrics
 
 # --- Global Variables --- #
 
@@ -21,6 +34,16 @@ BUCKET_NAME = "bucket2121"
 NUM_BUCKETS = 124
 TUPLE_SIZE = 6  # We're going to pack the doc_id and tf values in this many bytes.
 TF_MASK = 2 ** 16 - 1  # Masking the 16 low bits of an integer
+# Layout of one posting tuple on disk: a big-endian 4 bytes doc_id followed by a big-endian 2 bytes tf.
+POSTING_DTYPE = np.dtype([('doc_id', '>u4'), ('tf', '>u2')])
+
+# --- Local copies of index files --- #
+# Directory that files downloaded from a remote backend are kept in, so they can be memory-mapped.
+INDEX_CACHE_DIR = os.environ.get("INDEX_CACHE_DIR", ".index_cache")
+
+# --- Block cache params --- #
+# Upper bound (in bytes) on the posting blocks kept in memory by the process-wide block cache.
+BLOCK_CACHE_MAX_BYTES = int(os.environ.get("BLOCK_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
 
 
 # --- hash function --- #
@@ -63,43 +86,1082 @@ class MultiFileWriter:
         self._f.close()
 
 
+# --- Posting decoding --- #
+def decode_posting_arrays(b, n):
+    """
+    Decodes `n` packed posting tuples into parallel arrays, without a Python loop over the postings.
+    :param b: bytes-like, the raw posting list
+    :param n: int, number of postings (the df of the term)
+    :return: (doc_ids, tfs) as int64 numpy arrays
+    """
+    postings = np.frombuffer(b, dtype=POSTING_DTYPE, count=n)
+    return postings['doc_id'].astype(np.int64), postings['tf'].astype(np.int64)
+
+
+EMPTY_POSTINGS = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+
+# --- Posting formats --- #
+# The legacy format: fixed TUPLE_SIZE tuples without a header. Lists written in any other format start with a
+# one byte header holding the format version, and the reader picks the decoder from that byte.
+POSTING_FORMAT_RAW = 0
+# LEB128 varints of interleaved (doc_id gap, tf) pairs, doc ids sorted in ascending order.
+POSTING_FORMAT_VARINT = 1
+# Precomputed quantized scores: one uint8 impact per posting, followed by the LEB128 varints of the doc id gaps.
+# The impact takes the place of the tf, see InvertedIndex.impact_scale.
+POSTING_FORMAT_IMPACT = 2
+
+
+def _varint_lengths(values):
+    """ Returns the number of bytes of the LEB128 varint of each value. """
+    lens = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        lens += values >= np.uint64(1 << (7 * k))
+    return lens
+
+
+def _varint_encode(values):
+    """ Encodes non-negative integers as LEB128 varints (7 bits per byte, high bit set on all but the last). """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return b''
+    lens = _varint_lengths(values)
+    starts = np.cumsum(lens) - lens
+    value_of_byte = np.repeat(np.arange(len(values)), lens)
+    byte_no = np.arange(lens.sum()) - starts[value_of_byte]
+    out = (values[value_of_byte] >> (7 * byte_no).astype(np.uint64)) & np.uint64(0x7f)
+    out |= (byte_no < lens[value_of_byte] - 1).astype(np.uint64) << np.uint64(7)
+    return out.astype(np.uint8).tobytes()
+
+
+def _varint_decode(b, n_values):
+    """ Decodes the first `n_values` LEB128 varints of `b` into an uint64 array. """
+    raw = np.frombuffer(b, dtype=np.uint8)
+    ends = np.flatnonzero(raw < 0x80)[:n_values]
+    if len(ends) == 0:
+        return np.empty(0, dtype=np.uint64)
+    raw = raw[:ends[-1] + 1]
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    value_of_byte = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = ((np.arange(len(raw)) - starts[value_of_byte]) * 7).astype(np.uint64)
+    # the 7 bit groups of a value never overlap, so adding them up assembles the value
+    return np.add.reduceat((raw & 0x7f).astype(np.uint64) << shifts, starts)
+
+
+def _varint_values(doc_ids, tfs):
+    values = np.empty(2 * len(doc_ids), dtype=np.int64)
+    values[0::2] = np.diff(doc_ids, prepend=0)
+    values[1::2] = tfs
+    return values
+
+
+def encode_postings(doc_ids, tfs, posting_format=POSTING_FORMAT_VARINT):
+    """
+    Encodes a posting list, sorted by doc_id, in the given on-disk format.
+    :param doc_ids: sequence of int
+    :param tfs: sequence of int
+    :param posting_format: int, one of the POSTING_FORMAT_* versions
+    :return: bytes
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    tfs = np.asarray(tfs, dtype=np.int64)
+    if posting_format == POSTING_FORMAT_RAW:
+        postings = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+        postings['doc_id'] = doc_ids
+        postings['tf'] = tfs & TF_MASK
+        return postings.tobytes()
+    if posting_format == POSTING_FORMAT_VARINT:
+        return bytes([POSTING_FORMAT_VARINT]) + _varint_encode(_varint_values(doc_ids, tfs))
+    if posting_format == POSTING_FORMAT_IMPACT:
+        return (bytes([POSTING_FORMAT_IMPACT]) + tfs.astype(np.uint8).tobytes() +
+                _varint_encode(np.diff(doc_ids, prepend=0)))
+    raise ValueError(f"Unknown posting format: {posting_format}")
+
+
+def posting_offsets(doc_ids, tfs, posting_format):
+    """
+    Returns the byte offset of every posting inside the encoded posting list, followed by the size of the list.
+    :param doc_ids: sequence of int, sorted
+    :param tfs: sequence of int
+    :param posting_format: int, one of the POSTING_FORMAT_* versions
+    :return: int64 numpy array of len(doc_ids) + 1 offsets
+    """
+    if posting_format == POSTING_FORMAT_RAW:
+        return np.arange(len(doc_ids) + 1, dtype=np.int64) * TUPLE_SIZE
+    if posting_format == POSTING_FORMAT_IMPACT:
+        raise ValueError("Postings of the impact format can not be read block by block")
+    values = _varint_values(np.asarray(doc_ids, dtype=np.int64), np.asarray(tfs, dtype=np.int64))
+    pair_lens = _varint_lengths(values.astype(np.uint64)).reshape(-1, 2).sum(axis=1)
+    offsets = np.ones(len(doc_ids) + 1, dtype=np.int64)  # after the format header
+    offsets[1:] += np.cumsum(pair_lens)
+    return offsets
+
+
+def _decode_varint_postings(b, n):
+    values = _varint_decode(b, 2 * n)
+    return np.cumsum(values[0::2]).astype(np.int64), values[1::2].astype(np.int64)
+
+
+def _decode_impact_postings(b, n):
+    impacts = np.frombuffer(b, dtype=np.uint8, count=n).astype(np.int64)
+    return np.cumsum(_varint_decode(b[n:], n)).astype(np.int64), impacts
+
+
+POSTING_DECODERS = {POSTING_FORMAT_VARINT: _decode_varint_postings, POSTING_FORMAT_IMPACT: _decode_impact_postings}
+
+
+def decode_postings(b, n, posting_format=POSTING_FORMAT_RAW):
+    """
+    Decodes a posting list of `n` postings read from disk into parallel (doc_ids, tfs) arrays.
+    :param b: bytes-like, the raw posting list
+    :param n: int, number of postings (the df of the term)
+    :param posting_format: int, POSTING_FORMAT_RAW for headerless legacy lists, otherwise the version is read
+                           from the header of the list
+    :return: (doc_ids, tfs) as int64 numpy arrays
+    """
+    metrics.count(metrics.POSTINGS_DECODED, n)
+    with metrics.stage("decode"):
+        if posting_format == POSTING_FORMAT_RAW:
+            return decode_posting_arrays(b, n)
+        b = memoryview(b)
+        decoder = POSTING_DECODERS.get(b[0])
+        if decoder is None:
+            raise ValueError(f"Unknown posting format version in posting list header: {b[0]}")
+        return decoder(b[1:], n)
+
+
+def decode_posting_block(b, n, posting_format, base_doc_id=0):
+    """
+    Decodes `n` postings read from the middle of a posting list, starting at a posting boundary.
+    :param b: bytes-like, the encoded postings (without the list header)
+    :param n: int, number of postings
+    :param posting_format: int, the format of the posting list
+    :param base_doc_id: int, doc id of the posting before the block (0 for the first block), as the varint
+                        format stores doc id gaps
+    :return: (doc_ids, tfs) as int64 numpy arrays
+    """
+    metrics.count(metrics.POSTINGS_DECODED, n)
+    with metrics.stage("decode"):
+        if posting_format == POSTING_FORMAT_RAW:
+            return decode_posting_arrays(b, n)
+        doc_ids, tfs = POSTING_DECODERS[posting_format](b, n)
+        return doc_ids + base_doc_id, tfs
+
+
+# --- BlockCache --- #
+class BlockCache:
+    """ Thread-safe LRU cache of posting data, bounded by the total number of bytes it holds.
+
+        The cache is shared by every reader in the process, so hot posting data is downloaded once and then
+        served from memory to all the queries (and threads) that need it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._blocks = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def put(self, key, block):
+        with self._lock:
+            self._put(key, block)
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the block stored under `key`, calling `loader()` to fetch it on a miss.
+        Concurrent misses on the same key wait for a single load instead of downloading the block again.
+        :param key: hashable, block identifier
+        :param loader: callable returning the block bytes
+        :return: bytes
+        """
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return block
+            self.misses += 1
+            event = self._loading.get(key)
+            owner = event is None
+            if owner:
+                event = self._loading[key] = threading.Event()
+        if not owner:
+            event.wait()
+            # The lookup was already counted as a miss, read the loaded block without counting it again.
+            with self._lock:
+                block = self._blocks.get(key)
+                if block is not None:
+                    self._blocks.move_to_end(key)
+            return block if block is not None else loader()
+        try:
+            block = loader()
+            self.put(key, block)
+            return block
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+    def _put(self, key, block):
+        # Blocks larger than the whole cache are served but never stored.
+        if len(block) > self.max_bytes:
+            return
+        old = self._blocks.pop(key, None)
+        if old is not None:
+            self.current_bytes -= len(old)
+        self._blocks[key] = block
+        self.current_bytes += len(block)
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self._blocks.popitem(last=False)
+            self.current_bytes -= len(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.current_bytes = 0
+
+    def after_fork(self):
+        """ Called in a child process after a fork: the lock and the loads in flight belong to the parent. """
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def stats(self):
+        """
+        Returns the cache counters.
+        :return: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"blocks": len(self._blocks), "bytes": self.current_bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+BLOCK_CACHE = BlockCache(BLOCK_CACHE_MAX_BYTES)
+
+
+# --- PostingCache --- #
+# Every PostingCache of the process, whose locks are reset in forked children.
+_POSTING_CACHES = weakref.WeakSet()
+
+
+class FrequencySketch:
+    """ Count-min sketch estimating how often keys were accessed recently, the frequency filter of TinyLFU.
+        Counters saturate at MAX_COUNT, and every `sample_size` additions all of them are halved, so the estimates
+        follow the recent popularity of the keys instead of growing forever.
+    """
+    MAX_COUNT = 255
+
+    def __init__(self, width, depth=4, sample_size=None):
+        self.width = 1 << max(int(width) - 1, 1).bit_length()
+        self.depth = depth
+        self.sample_size = sample_size or 10 * self.width
+        self.additions = 0
+        self._table = np.zeros((depth, self.width), dtype=np.uint8)
+
+    def _cells(self, key):
+        rows = list(range(self.depth))
+        return rows, [hash((row, key)) & (self.width - 1) for row in rows]
+
+    def add(self, key, n=1):
+        # a counter cannot grow past MAX_COUNT, so larger increments would only bring the next halvings closer
+        n = min(n, self.MAX_COUNT)
+        rows, cols = self._cells(key)
+        counters = self._table[rows, cols]
+        self._table[rows, cols] = np.minimum(counters.astype(np.int64) + n, self.MAX_COUNT)
+        self.additions += n
+        if self.additions >= self.sample_size:
+            self._table >>= 1
+            self.additions //= 2
+
+    def estimate(self, key):
+        rows, cols = self._cells(key)
+        return int(self._table[rows, cols].min())
+
+
+class PostingCache:
+    """ Thread-safe LRU cache of decoded (doc_ids, tfs) posting arrays of one index, bounded by their bytes.
+
+        Admission is frequency-aware (TinyLFU): every lookup is counted in a FrequencySketch, and when making
+        room for a new posting list would evict others, it is only stored if it was accessed more often than
+        each of the lists it would evict. A burst of one-off rare terms then does not flush the hot terms.
+        The cached arrays are shared by all the readers and are read-only.
+    """
+
+    def __init__(self, max_bytes, sketch_width=65536):
+        self.max_bytes = max_bytes
+        self.sketch = FrequencySketch(sketch_width)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        _POSTING_CACHES.add(self)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+
+    def get(self, key):
+        """
+        Returns the cached posting arrays of a key and counts the access in the frequency sketch.
+        :param key: hashable, e.g. (component dir, term)
+        :return: (doc_ids, tfs), or None on a miss
+        """
+        with self._lock:
+            self.sketch.add(key)
+            postings = self._entries.get(key)
+            if postings is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return postings
+
+    def record(self, key, n=1):
+        """ Counts `n` accesses of a key without looking it up, e.g. the occurrences of a term in a query log. """
+        with self._lock:
+            self.sketch.add(key, n)
+
+    def put(self, key, postings):
+        """
+        Stores posting arrays, if the admission policy lets them in.
+        :param key: hashable
+        :param postings: (doc_ids, tfs) numpy arrays
+        :return: bool, whether the arrays are cached
+        """
+        size = sum(a.nbytes for a in postings)
+        with self._lock:
+            if key in self._entries:
+                return True
+            if size > self.max_bytes:
+                self.rejections += 1
+                return False
+            victims, freed = [], 0
+            if self.current_bytes + size > self.max_bytes:
+                frequency = self.sketch.estimate(key)
+                for victim, victim_postings in self._entries.items():
+                    if self.sketch.estimate(victim) >= frequency:
+                        self.rejections += 1
+                        return False
+                    victims.append(victim)
+                    freed += sum(a.nbytes for a in victim_postings)
+                    if self.current_bytes - freed + size <= self.max_bytes:
+                        break
+            for victim in victims:
+                del self._entries[victim]
+                self.evictions += 1
+            self.current_bytes -= freed
+            for a in postings:
+                a.flags.writeable = False
+            self._entries[key] = postings
+            self.current_bytes += size
+            return True
+
+    def fits(self, size):
+        """ Whether `size` more bytes can be stored without evicting anything. """
+        return self.current_bytes + size <= self.max_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def after_fork(self):
+        """ Called in a child process after a fork, the lock belongs to the parent. """
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """
+        Returns the cache counters.
+        :return: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"terms": len(self._entries), "bytes": self.current_bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "rejections": self.rejections, "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+# --- Storage backends --- #
+class StorageBackend:
+    """ Base class of the stores that index files are read from. Paths are relative to the backend root,
+        e.g. "body/12_003.bin". """
+
+    # whether reads from this backend should go through the block cache.
+    cacheable = True
+
+    def read_range(self, path, offset, n_bytes):
+        """
+        Reads exactly the bytes [offset, offset + n_bytes) of a file.
+        :param path: str, file path relative to the backend root
+        :param offset: int
+        :param n_bytes: int
+        :return: bytes
+        """
+        raise NotImplementedError
+
+    def read_file(self, path):
+        """
+        Reads a whole file.
+        :param path: str, file path relative to the backend root
+        :return: bytes
+        """
+        raise NotImplementedError
+
+    def exists(self, path):
+        """
+        Returns whether the file exists in the backend.
+        :param path: str
+        :return: bool
+        """
+        raise NotImplementedError
+
+    def version(self, path):
+        """
+        Returns a string that changes whenever the file is replaced, e.g. the generation of a storage object.
+        :param path: str
+        :return: str, safe to use in a file name
+        """
+        raise NotImplementedError
+
+    def local_path(self, path):
+        """
+        Returns a path on the local filesystem holding the file, downloading it to INDEX_CACHE_DIR on first use.
+        The local copy is named after the version of the file, so a file uploaded again is downloaded again
+        instead of mixing a stale copy with fresh files.
+        :param path: str
+        :return: Path
+        """
+        local = Path(INDEX_CACHE_DIR) / self.uri(path).replace("://", "/")
+        local = local.with_name(f"{local.stem}.{self.version(path)}{local.suffix}")
+        if not local.exists():
+            local.parent.mkdir(parents=True, exist_ok=True)
+            # Every download goes through its own temporary file, so threads fetching the same file do not
+            # write to the same one, and the copy appears complete or not at all.
+            with tempfile.NamedTemporaryFile(dir=local.parent, prefix=local.name, suffix=".part",
+                                             delete=False) as tmp:
+                try:
+                    tmp.write(self.read_file(path))
+                except BaseException:
+                    tmp.close()
+                    os.unlink(tmp.name)
+                    raise
+            os.replace(tmp.name, local)
+        return local
+
+    def close(self):
+        pass
+
+    def after_fork(self):
+        """ Called in a child process after a fork, to drop the state that can not be shared with the parent. """
+        pass
+
+    def uri(self, path):
+        """
+        Returns a string that identifies the file across backends, used as the block cache key.
+        :param path: str
+        :return: str
+        """
+        raise NotImplementedError
+
+
+class LocalBackend(StorageBackend):
+    """ Reads index files from a directory on the local filesystem. """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def read_range(self, path, offset, n_bytes):
+        with open(self.root / path, 'rb') as f:
+            f.seek(offset)
+            return f.read(n_bytes)
+
+    def read_file(self, path):
+        with open(self.root / path, 'rb') as f:
+            return f.read()
+
+    def exists(self, path):
+        return (self.root / path).exists()
+
+    def local_path(self, path):
+        return self.root / path
+
+    def uri(self, path):
+        return f"file://{self.root.resolve()}/{path}"
+
+
+class MmapBackend(LocalBackend):
+    """ Serves posting data from local files that are memory-mapped once and shared through the page cache.
+        Ranged reads return zero-copy `memoryview` slices of the mapping, so they bypass the block cache. """
+
+    cacheable = False
+
+    def __init__(self, root):
+        super().__init__(root)
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def _map(self, path):
+        m = self._maps.get(path)
+        if m is None:
+            with self._lock:
+                m = self._maps.get(path)
+                if m is None:
+                    with open(self.root / path, 'rb') as f:
+                        # an empty file can not be mapped
+                        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+                    m = self._maps[path] = memoryview(m)
+        return m
+
+    def read_range(self, path, offset, n_bytes):
+        return self._map(path)[offset:offset + n_bytes]
+
+    def after_fork(self):
+        # the mappings are inherited and shared with the parent, the lock is not
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            for m in self._maps.values():
+                try:
+                    obj = m.obj
+                    m.release()
+                    if isinstance(obj, mmap.mmap):
+                        obj.close()
+                except BufferError:
+                    # slices handed out to callers are still alive, the mapping is freed with them.
+                    pass
+            self._maps.clear()
+
+
+class GCSBackend(StorageBackend):
+    """ Reads index files from a google storage bucket, issuing ranged downloads for partial reads. """
+
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        # The storage client is created on first use and shared by all the threads of the process.
+        with self._lock:
+            if self._bucket is None:
+                self._bucket = storage.Client().bucket(self.bucket_name)
+            return self._bucket
+
+    def after_fork(self):
+        # The connections of the client of the parent process must not be reused, every process creates its own.
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    def read_range(self, path, offset, n_bytes):
+        if n_bytes <= 0:
+            return b''
+        # `end` is inclusive in the storage API.
+        return self.bucket.blob(path).download_as_bytes(start=offset, end=offset + n_bytes - 1)
+
+    def read_file(self, path):
+        return self.bucket.blob(path).download_as_bytes()
+
+    def exists(self, path):
+        return self.bucket.blob(path).exists()
+
+    def version(self, path):
+        blob = self.bucket.get_blob(path)
+        if blob is None:
+            raise FileNotFoundError(self.uri(path))
+        return str(blob.generation)
+
+    def uri(self, path):
+        return f"gs://{self.bucket_name}/{path}"
+
+
+class InMemoryBackend(StorageBackend):
+    """ Serves index files from a dict of path -> bytes, counting the reads it answers. Meant for tests and
+        for running small indexes fully in-process. """
+
+    def __init__(self, files=None):
+        self.files = dict(files or {})
+        self.reads = 0
+        self.bytes_read = 0
+
+    def read_range(self, path, offset, n_bytes):
+        b = self.files[path][offset:offset + n_bytes]
+        self.reads += 1
+        self.bytes_read += len(b)
+        return b
+
+    def read_file(self, path):
+        return self.read_range(path, 0, len(self.files[path]))
+
+    def exists(self, path):
+        return path in self.files
+
+    def version(self, path):
+        return hashlib.blake2b(self.files[path], digest_size=8).hexdigest()
+
+    def uri(self, path):
+        return f"mem://{id(self)}/{path}"
+
+
+# Setting POSTINGS_ROOT to a local directory that mirrors the bucket layout runs the engine offline, with the
+# posting files memory-mapped.
+POSTINGS_ROOT = os.environ.get("POSTINGS_ROOT")
+
+_DEFAULT_BACKENDS = {}
+_DEFAULT_BACKENDS_LOCK = threading.Lock()
+
+
+def get_default_backend(bucket_name=BUCKET_NAME):
+    """
+    Returns the shared backend used when no backend is given explicitly: the local POSTINGS_ROOT directory if
+    it is set, otherwise the google storage bucket.
+    :param bucket_name: str
+    :return: StorageBackend
+    """
+    key = POSTINGS_ROOT or bucket_name
+    with _DEFAULT_BACKENDS_LOCK:
+        if key not in _DEFAULT_BACKENDS:
+            _DEFAULT_BACKENDS[key] = MmapBackend(POSTINGS_ROOT) if POSTINGS_ROOT else GCSBackend(bucket_name)
+        return _DEFAULT_BACKENDS[key]
+
+
+def _after_fork():
+    global _DEFAULT_BACKENDS_LOCK
+    _DEFAULT_BACKENDS_LOCK = threading.Lock()
+    for backend in _DEFAULT_BACKENDS.values():
+        backend.after_fork()
+    BLOCK_CACHE.after_fork()
+    for cache in list(_POSTING_CACHES):
+        cache.after_fork()
+
+
+# Forked server workers (see gunicorn.conf.py) share the loaded indexes and cached postings, but not the storage
+# connections nor the locks, which could have been held by another thread of the parent when it forked.
+os.register_at_fork(after_in_child=_after_fork)
+
+
+# --- Deadlines --- #
+class DeadlineExceeded(TimeoutError):
+    """ Raised by the posting reads of a context whose deadline has passed (see set_deadline). """
+
+
+_DEADLINE = contextvars.ContextVar("deadline", default=None)
+
+
+def set_deadline(deadline):
+    """
+    Sets the time after which the posting reads of the current context raise DeadlineExceeded, so a task whose
+    result is no longer awaited stops at its next posting list instead of scoring the whole query.
+    :param deadline: float, a time.monotonic() time, or None for no deadline
+    """
+    _DEADLINE.set(deadline)
+
+
+def check_deadline():
+    deadline = _DEADLINE.get()
+    if deadline is not None and time.monotonic() > deadline:
+        raise DeadlineExceeded()
+
+
 # --- MultiFileReader --- #
 class MultiFileReader:
     """ Sequential binary reader of multiple files of up to BLOCK_SIZE each. """
 
-    def __init__(self):
-        self._open_files = {}
-        self.storage_client = storage.Client()
-        self.bucket = self.storage_client.bucket(BUCKET_NAME)
+    def __init__(self, backend=None, cache=None):
+        self.backend = get_default_backend() if backend is None else backend
+        self.cache = BLOCK_CACHE if cache is None else cache
+
+    def read(self, locs, n_bytes, base_dir, start=0):
+        """
+        Reads `n_bytes` of posting data starting `start` bytes after the first location in `locs`.
+        Returns a zero-copy memoryview when the data comes from a memory-mapped backend and sits in one block.
+        :return: bytes-like
+        """
+        with metrics.stage("fetch"):
+            b, n_fetched = self._read(locs, n_bytes, base_dir, start)
+        metrics.count(metrics.BLOCKS_READ, len(b))
+        metrics.count(metrics.BYTES_READ, n_fetched)
+        metrics.count(metrics.BYTES_CACHED, sum(len(block) for block in b) - n_fetched)
+        return b[0] if len(b) == 1 else b''.join(b)
 
-    def read(self, locs, n_bytes, base_dir):
+    def _read(self, locs, n_bytes, base_dir, start):
+        """ Returns the blocks of the range and the number of their bytes read from storage, the others were
+            served by the block cache. """
         b = []
+        n_fetched = 0
+
+        def fetch(path, offset, n_read):
+            nonlocal n_fetched
+            block = self.backend.read_range(path, offset, n_read)
+            n_fetched += len(block)
+            return block
+
         for f_name, offset in locs:
-            if f_name not in self._open_files:
-                blob = self.bucket.blob(f"{base_dir}/{f_name}")
-                self._open_files[f_name] = io.BytesIO(blob.download_as_string())
-            f = self._open_files[f_name]
-            f.seek(offset)
+            if start >= BLOCK_SIZE - offset:
+                # the range starts after this file
+                start -= BLOCK_SIZE - offset
+                continue
+            offset, start = offset + start, 0
             n_read = min(n_bytes, BLOCK_SIZE - offset)
-            b.append(f.read(n_read))
+            path = f"{base_dir}/{f_name}"
+            if self.backend.cacheable:
+                # Only the byte range of the posting list is fetched, and the range is what gets cached.
+                key = (self.backend.uri(path), offset, n_read)
+                b.append(self.cache.get_or_load(key, lambda: fetch(path, offset, n_read)))
+            else:
+                b.append(fetch(path, offset, n_read))
             n_bytes -= n_read
-        return b''.join(b)
+            if n_bytes <= 0:
+                break
+        return b, n_fetched
 
     def close(self):
-        for f in self._open_files.values():
-            f.close()
+        # Data lives in the shared cache, there is nothing to release per reader.
+        pass
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
         return False
 
 
+# --- Compact term dictionary --- #
+class SortedArrayMap(Mapping):
+    """ Read-only mapping of integer keys to values backed by a sorted keys array and a parallel values array. """
+
+    def __init__(self, keys, values):
+        self.keys_array = keys
+        self.values_array = values
+
+    def _positions(self, keys):
+        pos = np.searchsorted(self.keys_array, keys)
+        pos = np.minimum(pos, len(self.keys_array) - 1)
+        return pos, self.keys_array[pos] == keys
+
+    def gather(self, keys, missing=0):
+        """ Vectorized lookup of an array of keys, keys that are not in the map get `missing`. """
+        keys = np.asarray(keys)
+        if len(self.keys_array) == 0:
+            return np.full(len(keys), missing)
+        pos, found = self._positions(keys)
+        return np.where(found, self.values_array[pos], missing)
+
+    def __getitem__(self, key):
+        if len(self.keys_array) != 0:
+            pos, found = self._positions(key)
+            if found:
+                return self.values_array[pos].item()
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return len(self.keys_array) != 0 and bool(self._positions(key)[1])
+
+    def __iter__(self):
+        return iter(self.keys_array.tolist())
+
+    def __len__(self):
+        return len(self.keys_array)
+
+
+# --- Score bounds --- #
+# Number of postings summarised by one block-max entry. Blocks start at posting boundaries, so a block can be
+# read and decoded on its own.
+SCORE_BLOCK_SIZE = 128
+# Per-block arrays of a TermDictionary with score bounds, block_ptr[row] is the first block of a term.
+BLOCK_ARRAYS = ('block_ptr', 'block_last_doc', 'block_max', 'block_offset')
+# Above this many separate block ranges a posting list is read whole.
+MAX_BLOCK_READS = 64
+
+# --- Champion lists --- #
+# Per-term arrays of the champion lists of a TermDictionary, the top documents of every posting list by tf/DL
+# (its normalized tf-idf impact, the idf being the same for the whole list) in decreasing impact order.
+CHAMPION_ARRAYS = ('champion_ptr', 'champion_doc', 'champion_tf')
+
+
+def _round_up_float32(values):
+    """ Casts to float32 rounding up, so the result is still an upper bound of `values`. """
+    rounded = values.astype(np.float32)
+    return np.where(rounded < values, np.nextafter(rounded, np.float32(np.inf)), rounded)
+
+
+class TermDictionary:
+    """ Sorted, memory-mappable term dictionary. Terms are stored as one UTF-8 blob with an offsets array and
+        looked up by binary search. Per-term statistics are array columns, and posting locations are kept as
+        (file number, offset) arrays with a per-term pointer into them instead of lists of filename tuples.
+        A dictionary built with score bounds also has the max tf/DL of every term (the `max_tf_norm` column)
+        and of every SCORE_BLOCK_SIZE postings block (see BLOCK_ARRAYS), and can have champion lists (see
+        CHAMPION_ARRAYS).
+    """
+    COLUMN_DTYPES = {'df': np.uint32, 'term_total': np.int64, 'posting_bytes': np.int64, 'max_tf_norm': np.float32}
+
+    def __init__(self, term_offsets, term_blob, columns, loc_ptr, loc_file, loc_offset, files, blocks=None,
+                 champions=None):
+        self.term_offsets = term_offsets
+        self.term_blob = term_blob
+        self.columns = columns
+        self.loc_ptr = loc_ptr
+        self.loc_file = loc_file
+        self.loc_offset = loc_offset
+        self.files = files
+        self.blocks = blocks
+        self.champions = champions
+
+    def __len__(self):
+        return len(self.term_offsets) - 1
+
+    def term(self, row):
+        return self.term_blob[self.term_offsets[row]:self.term_offsets[row + 1]].tobytes().decode('utf8')
+
+    def terms(self):
+        return (self.term(row) for row in range(len(self)))
+
+    def row(self, term):
+        """
+        Binary search for the row of `term`.
+        :param term: str
+        :return: int, or None when the term is not in the dictionary
+        """
+        key = term.encode('utf8')
+        offsets, blob = self.term_offsets, self.term_blob
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if blob[offsets[mid]:offsets[mid + 1]].tobytes() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and blob[offsets[lo]:offsets[lo + 1]].tobytes() == key:
+            return lo
+        return None
+
+    def locs(self, row):
+        start, end = self.loc_ptr[row], self.loc_ptr[row + 1]
+        return [(self.files[f], int(offset)) for f, offset in zip(self.loc_file[start:end].tolist(),
+                                                                  self.loc_offset[start:end].tolist())]
+
+    def block_range(self, row):
+        """ Returns the (start, end) positions of the blocks of a term in the block arrays. """
+        ptr = self.blocks['block_ptr']
+        return int(ptr[row]), int(ptr[row + 1])
+
+    def champion_list(self, row):
+        """ Returns the (doc_ids, tfs) arrays of the champion list of a term, in decreasing impact order. """
+        ptr = self.champions['champion_ptr']
+        start, end = ptr[row], ptr[row + 1]
+        return (self.champions['champion_doc'][start:end].astype(np.int64),
+                self.champions['champion_tf'][start:end].astype(np.int64))
+
+    def memory_usage(self):
+        """ Returns the number of bytes of the dictionary arrays (memory-mapped arrays are shared page cache). """
+        return sum(a.nbytes for a in self._arrays().values())
+
+    @staticmethod
+    def build(index, comp=None, champion_size=None):
+        """
+        Builds the dictionary of a dict-based InvertedIndex.
+        :param index: InvertedIndex
+        :param comp: string, directory name for component of the index, when given every posting list is read
+                     from it to compute the score bounds
+        :param champion_size: int, when given (with `comp`) the champion lists keep that many documents per term
+        :return: TermDictionary
+        """
+        terms = sorted(index.df.keys())
+        encoded = [t.encode('utf8') for t in terms]
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum([len(t) for t in encoded])
+        term_blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        dtypes = TermDictionary.COLUMN_DTYPES
+        columns = {'df': np.array([index.df[t] for t in terms], dtype=dtypes['df']),
+                   'term_total': np.array([index.term_total.get(t, 0) for t in terms], dtype=dtypes['term_total'])}
+        if index.posting_format != POSTING_FORMAT_RAW:
+            columns['posting_bytes'] = np.array([index.posting_bytes[t] for t in terms], dtype=dtypes['posting_bytes'])
+        blocks = champions = None
+        if comp is not None:
+            columns['max_tf_norm'], blocks, champions = TermDictionary._score_bounds(index, terms, comp,
+                                                                                     champion_size)
+        files, file_no = [], {}
+        loc_ptr, loc_file, loc_offset = [0], [], []
+        for t in terms:
+            for f_name, offset in index.posting_locs.get(t, []):
+                if f_name not in file_no:
+                    file_no[f_name] = len(files)
+                    files.append(f_name)
+                loc_file.append(file_no[f_name])
+                loc_offset.append(offset)
+            loc_ptr.append(len(loc_file))
+        file_dtype = np.uint16 if len(files) <= np.iinfo(np.uint16).max else np.uint32
+        return TermDictionary(term_offsets, term_blob, columns, np.array(loc_ptr, dtype=np.int64),
+                              np.array(loc_file, dtype=file_dtype), np.array(loc_offset, dtype=np.uint32), files,
+                              blocks, champions)
+
+    @staticmethod
+    def _score_bounds(index, terms, comp, champion_size=None):
+        """ Reads every posting list and computes the max tf/DL per term and per block of postings, and the
+            champion lists when `champion_size` is given.
+        """
+        max_tf_norm = np.zeros(len(terms))
+        block_ptr, last_docs, maxima, offsets = [0], [], [], []
+        champion_ptr, champion_docs, champion_tfs = [0], [], []
+        for row, t in enumerate(terms):
+            doc_ids, tfs = index.read_posting_arrays(t, comp)
+            tf_norm = tfs / index.doc_lengths(doc_ids)
+            if index.norms is not None:
+                # bounds and impacts of the cosine scores, which divide by the document vector norm
+                tf_norm /= index.doc_norms(doc_ids)
+            if champion_size is not None:
+                top = TermDictionary._champions(doc_ids, tf_norm, champion_size)
+                champion_docs.append(doc_ids[top])
+                champion_tfs.append(tfs[top])
+                champion_ptr.append(champion_ptr[-1] + len(top))
+            if len(doc_ids) != 0:
+                starts = np.arange(0, len(doc_ids), SCORE_BLOCK_SIZE)
+                maxima.append(np.maximum.reduceat(tf_norm, starts))
+                last_docs.append(doc_ids[np.minimum(starts + SCORE_BLOCK_SIZE, len(doc_ids)) - 1])
+                offsets.append(posting_offsets(doc_ids, tfs, index.posting_format)[starts])
+                max_tf_norm[row] = maxima[-1].max()
+            block_ptr.append(block_ptr[-1] + (len(maxima[-1]) if len(doc_ids) != 0 else 0))
+        concat = lambda parts, dtype: np.concatenate(parts).astype(dtype) if parts else np.empty(0, dtype=dtype)
+        blocks = {'block_ptr': np.array(block_ptr, dtype=np.int64),
+                  'block_last_doc': concat(last_docs, np.uint32),
+                  'block_max': _round_up_float32(concat(maxima, np.float64)),
+                  'block_offset': concat(offsets, np.int64)}
+        champions = None
+        if champion_size is not None:
+            champions = {'champion_ptr': np.array(champion_ptr, dtype=np.int64),
+                         'champion_doc': concat(champion_docs, np.uint32),
+                         'champion_tf': concat(champion_tfs, np.uint32)}
+        return _round_up_float32(max_tf_norm), blocks, champions
+
+    @staticmethod
+    def _champions(doc_ids, impacts, size):
+        """ Positions of the `size` highest impacts, in decreasing impact order (ties by doc id). """
+        top = np.arange(len(impacts))
+        if size < len(impacts):
+            top = np.argpartition(-impacts, size - 1)[:size]
+        return top[np.lexsort((doc_ids[top], -impacts[top]))]
+
+    def _arrays(self):
+        arrays = {'term_offsets': self.term_offsets, 'term_blob': self.term_blob, 'loc_ptr': self.loc_ptr,
+                  'loc_file': self.loc_file, 'loc_offset': self.loc_offset}
+        arrays.update(self.columns)
+        arrays.update(self.blocks or {})
+        arrays.update(self.champions or {})
+        return arrays
+
+    def save(self, directory):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name, a in self._arrays().items():
+            np.save(directory / f'{name}.npy', a)
+        with open(directory / 'files.json', 'w') as f:
+            json.dump({'files': self.files, 'columns': list(self.columns), 'blocks': self.blocks is not None,
+                       'champions': self.champions is not None}, f)
+
+    @staticmethod
+    def load(directory, path_of=None):
+        """
+        Loads a saved dictionary with all its arrays memory-mapped.
+        :param directory: str, the directory the dictionary was saved to
+        :param path_of: optional function returning the local path of a file of the dictionary given its name,
+                        when the files are not all in `directory`
+        :return: TermDictionary
+        """
+        if path_of is None:
+            path_of = lambda file_name: Path(directory) / file_name
+        with open(path_of('files.json')) as f:
+            meta = json.load(f)
+        load = lambda name: np.load(path_of(f'{name}.npy'), mmap_mode='r')
+        blocks = {name: load(name) for name in BLOCK_ARRAYS} if meta.get('blocks') else None
+        champions = {name: load(name) for name in CHAMPION_ARRAYS} if meta.get('champions') else None
+        columns = {c: load(c) for c in meta['columns']}
+        for c, a in columns.items():
+            expected = TermDictionary.COLUMN_DTYPES.get(c)
+            if expected is not None and a.dtype != expected:
+                raise ValueError(f"Column {c} of the term dictionary in {directory} has dtype {a.dtype}, "
+                                 f"expected {np.dtype(expected)}")
+        return TermDictionary(load('term_offsets'), load('term_blob'), columns,
+                              load('loc_ptr'), load('loc_file'), load('loc_offset'), meta['files'], blocks,
+                              champions)
+
+    @staticmethod
+    def files_of(columns, blocks=False, champions=False):
+        names = ['term_offsets', 'term_blob', 'loc_ptr', 'loc_file', 'loc_offset', *columns]
+        if blocks:
+            names.extend(BLOCK_ARRAYS)
+        if champions:
+            names.extend(CHAMPION_ARRAYS)
+        return [f'{name}.npy' for name in names] + ['files.json']
+
+
+class _TermMapping(Mapping):
+    """ Read-only dict-like view of a TermDictionary, so the index can be used wherever its dicts were. """
+
+    def __init__(self, terms, get):
+        self._terms = terms
+        self._get = get
+
+    def __getitem__(self, term):
+        row = self._terms.row(term)
+        if row is None:
+            raise KeyError(term)
+        return self._get(row)
+
+    def __contains__(self, term):
+        return self._terms.row(term) is not None
+
+    def __iter__(self):
+        return self._terms.terms()
+
+    def __len__(self):
+        return len(self._terms)
+
+
+def _deep_size(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(_deep_size(item) for item in obj)
+    return size
+
+
+# Number of items of a dict whose size is measured to estimate the size of the whole dict.
+SIZE_SAMPLE = 1000
+
+
+def _estimate_dict_size(d):
+    """ Estimates the number of bytes of a dict with its keys and values (strings, numbers and lists or tuples of
+        them) from the size of its first SIZE_SAMPLE items. Objects shared between items are counted once per item.
+    """
+    sample = list(islice(d.items(), SIZE_SAMPLE))
+    if not sample:
+        return sys.getsizeof(d)
+    item_size = sum(_deep_size(key) + _deep_size(value) for key, value in sample) / len(sample)
+    return sys.getsizeof(d) + int(item_size * len(d))
+
+
 class InvertedIndex:
-    def __init__(self):
+    def __init__(self, posting_format=POSTING_FORMAT_RAW):
         """ Initializes the inverted index and add documents to it (if provided).
         Parameters:
         -----------
           docs: dict mapping doc_id to list of tokens
+          posting_format: on-disk format of the posting lists written by this index
         """
         self.DL = {}
         # stores document frequency per term
@@ -112,51 +1174,286 @@ class InvertedIndex:
         # mapping a term to posting file locations, which is a list of
         # (file_name, offset) pairs.
         self.posting_locs = defaultdict(list)
+        self.posting_format = posting_format
+        # size in bytes of each posting list, needed by the variable length formats.
+        self.posting_bytes = {}
+
+    # Class attributes are the defaults for indexes pickled before the attributes existed.
+    # storage backend the posting files are read from, None means the default backend.
+    backend = None
+    posting_format = POSTING_FORMAT_RAW
+    posting_bytes = None
+    # the TermDictionary backing df, term_total and posting_locs of a compact index.
+    term_dict = None
+    # wiki_id -> norm of the tf-idf vector of the document, when the index stores them.
+    norms = None
+    # score of one impact unit of a POSTING_FORMAT_IMPACT index, and the parameters its scores were computed with.
+    impact_scale = None
+    impact_params = None
+    # PostingCache of the decoded posting lists, None reads every list from storage.
+    posting_cache = None
+
+    @staticmethod
+    def read_index(bucket_name, base_dir, name, backend=None):
+        if backend is None:
+            backend = get_default_backend(bucket_name)
+        res = pickle.loads(backend.read_file(f"{base_dir}/{name}.pkl"))
+        res.backend = backend
+        return res
 
+    @staticmethod
+    def has_compact_index(bucket_name, base_dir, name, backend=None):
+        if backend is None:
+            backend = get_default_backend(bucket_name)
+        return backend.exists(f"{base_dir}/{name}_dict/index.json")
 
     @staticmethod
-    def read_index(bucket_name, base_dir, name):
-        os.system(f"gsutil cp gs://{bucket_name}/{base_dir}/{name}.pkl .")
-        with open(f'{name}.pkl', 'rb') as f:
-            res = pickle.load(f)
-            return res
+    def read_compact_index(bucket_name, base_dir, name, backend=None):
+        """ Loads an index written by `write_compact`. The term dictionary and document lengths are
+            memory-mapped arrays, exposed through read-only dict-like views of the usual attributes.
+        """
+        if backend is None:
+            backend = get_default_backend(bucket_name)
+        dict_dir = f"{base_dir}/{name}_dict"
+        meta = json.loads(backend.read_file(f"{dict_dir}/index.json"))
+        files = TermDictionary.files_of(meta['columns'], meta.get('blocks', False), meta.get('champions', False))
+        files += ['doc_ids.npy', 'doc_lengths.npy']
+        local_paths = {f: backend.local_path(f"{dict_dir}/{f}") for f in files}
+        terms = TermDictionary.load(dict_dir, local_paths.get)
 
+        res = InvertedIndex(meta['posting_format'])
+        res.term_dict = terms
+        res.df = _TermMapping(terms, lambda row: int(terms.columns['df'][row]))
+        res.term_total = _TermMapping(terms, lambda row: int(terms.columns['term_total'][row]))
+        res.posting_locs = _TermMapping(terms, terms.locs)
+        if 'posting_bytes' in terms.columns:
+            res.posting_bytes = _TermMapping(terms, lambda row: int(terms.columns['posting_bytes'][row]))
+        res.DL = SortedArrayMap(np.load(local_paths['doc_ids.npy'], mmap_mode='r'),
+                                np.load(local_paths['doc_lengths.npy'], mmap_mode='r'))
+        if meta.get('norms'):
+            res.norms = SortedArrayMap(res.DL.keys_array,
+                                       np.load(backend.local_path(f"{dict_dir}/doc_norms.npy"), mmap_mode='r'))
+        res.impact_scale = meta.get('impact_scale')
+        res.impact_params = meta.get('impact_params')
+        res.backend = backend
+        return res
+
+    def write_compact(self, base_dir, name, comp=None, champion_size=None, norms=False):
+        """ Write the global term stats and document lengths as the memory-mappable arrays of
+            `name`_dict/ (see TermDictionary), next to the posting files. When `comp` is given the posting
+            lists are read from it to also write the score bounds used by dynamic pruning, the champion
+            lists of `champion_size` documents per term when it is given, and the document norms when
+            `norms` is set (the bounds and champion lists are then those of the cosine scores).
+            The postings of an impact index hold scores instead of tfs, so it only gets the term dictionary.
+        """
+        if comp is not None and self.posting_format == POSTING_FORMAT_IMPACT:
+            raise ValueError("Score bounds, champion lists and norms are computed from tfs, "
+                             "an impact index can only be compacted without them")
+        dict_dir = Path(base_dir) / f'{name}_dict'
+        if norms:
+            self.norms = self.compute_norms(comp)
+        terms = TermDictionary.build(self, comp, champion_size)
+        terms.save(dict_dir)
+        doc_ids = np.array(sorted(self.DL.keys()), dtype=np.int64)
+        np.save(dict_dir / 'doc_ids.npy', doc_ids)
+        np.save(dict_dir / 'doc_lengths.npy', np.array([self.DL[d] for d in doc_ids.tolist()], dtype=np.uint32))
+        if norms:
+            np.save(dict_dir / 'doc_norms.npy', self.norms.gather(doc_ids, missing=0).astype(np.float32))
+        # index.json is written last, its presence marks a complete dictionary.
+        with open(dict_dir / 'index.json', 'w') as f:
+            json.dump({'posting_format': self.posting_format, 'columns': list(terms.columns),
+                       'blocks': terms.blocks is not None, 'champions': terms.champions is not None,
+                       'norms': norms, 'impact_scale': self.impact_scale, 'impact_params': self.impact_params}, f)
+
+    def compute_norms(self, comp):
+        """
+        Reads every posting list and computes the norm of the tf-idf vector of every document, with the
+        weights the body is scored with: tf normalized by the document length times the log base 10 idf.
+        :param comp: string, directory name for component of the index
+        :return: SortedArrayMap, wiki_id -> norm
+        """
+        doc_ids = np.array(sorted(self.DL.keys()), dtype=np.int64)
+        squares = np.zeros(len(doc_ids))
+        for term in self.df.keys():
+            term_doc_ids, tfs = self.read_posting_arrays(term, comp)
+            weights = (tfs / self.doc_lengths(term_doc_ids)) * math.log(len(self.DL) / self.df[term], 10)
+            np.add.at(squares, np.searchsorted(doc_ids, term_doc_ids), weights * weights)
+        return SortedArrayMap(doc_ids, np.sqrt(squares))
+
+
+    def read_posting_arrays(self, term, comp):
+        """ Reads the posting list of `term` and returns it as parallel (doc_ids, tfs) numpy arrays.
+            Terms that are not in the index get empty arrays. With a posting cache, the arrays are read-only.
+        """
+        check_deadline()
+        if term not in self.posting_locs.keys():
+            return EMPTY_POSTINGS
+        cache = self.posting_cache
+        if cache is None:
+            return self._read_posting_arrays(term, comp)
+        postings = cache.get((comp, term))
+        if postings is None:
+            postings = self._read_posting_arrays(term, comp)
+            cache.put((comp, term), postings)
+        return postings
+
+    def _read_posting_arrays(self, term, comp):
+        with closing(MultiFileReader(self.backend)) as reader:
+            # read a certain number of bytes into variable b
+            b = reader.read(self.posting_locs[term], self.posting_size(term), comp)
+        return decode_postings(b, self.df[term], self.posting_format)
+
+    def memory_usage(self):
+        """
+        Returns the number of bytes of the arrays of a compact index (memory-mapped arrays are shared page cache),
+        or an estimate of the size of the dicts of an index whose globals are pickled, and of its cached posting
+        lists.
+        :return: int
+        """
+        if self.term_dict is None:
+            res = sum(_estimate_dict_size(d) for d in (self.df, self.term_total, self.posting_locs,
+                                                       self.posting_bytes or {}))
+        else:
+            res = self.term_dict.memory_usage()
+        if isinstance(self.DL, SortedArrayMap):
+            res += self.DL.keys_array.nbytes + self.DL.values_array.nbytes
+        else:
+            res += _estimate_dict_size(self.DL)
+        if self.norms is not None:
+            res += self.norms.values_array.nbytes
+        if self.posting_cache is not None:
+            res += self.posting_cache.current_bytes
+        return res
+
+    def top_df_terms(self, n):
+        """ Returns the `n` terms with the highest df, the longest and most expensive posting lists. """
+        if self.term_dict is not None:
+            df = self.term_dict.columns['df']
+            rows = np.argsort(-df.astype(np.int64), kind='stable')[:n]
+            return [self.term_dict.term(row) for row in rows.tolist()]
+        return [term for term, _ in heapq.nlargest(n, self.df.items(), key=itemgetter(1))]
+
+    def warm_up(self, comp, terms):
+        """
+        Loads posting lists into the posting cache, e.g. at startup, so the first queries are not all served
+        from storage.
+        :param comp: string, directory name for component of the index
+        :param terms: list of (term, count) pairs, most valuable first, where count is how many times the term
+                      was seen (e.g. in a log of past queries) and is added to the admission frequency of the term
+        :return: int, the number of posting lists loaded
+        """
+        cache = self.posting_cache
+        terms = [(term, n) for term, n in terms if term in self.posting_locs.keys()]
+        for term, n in terms:
+            cache.record((comp, term), n)
+        loaded = 0
+        for term, _ in terms:
+            # The terms are sorted by value, so the warm-up stops at the first list that does not fit (or is not
+            # admitted) instead of reading the rest only for the admission policy to reject them. The decoded
+            # arrays take two int64 per posting.
+            if not cache.fits(2 * np.dtype(np.int64).itemsize * self.df[term]) or \
+                    not cache.put((comp, term), self._read_posting_arrays(term, comp)):
+                break
+            loaded += 1
+        return loaded
+
+    def has_score_bounds(self):
+        """ Whether the index stores the per-term and per-block score bounds used by dynamic pruning. """
+        return self.term_dict is not None and self.term_dict.blocks is not None
+
+    def score_bounds(self, term):
+        """
+        Returns the score bounds of `term` (see TermDictionary), the index must have score bounds.
+        :return: (max tf/DL of the term, doc id of the last posting of every block, max tf/DL of every block),
+                 None when the term is not in the index
+        """
+        row = self.term_dict.row(term)
+        if row is None:
+            return None
+        start, end = self.term_dict.block_range(row)
+        blocks = self.term_dict.blocks
+        return (float(self.term_dict.columns['max_tf_norm'][row]), blocks['block_last_doc'][start:end],
+                blocks['block_max'][start:end])
+
+    def has_champions(self):
+        """ Whether the index stores champion lists. """
+        return self.term_dict is not None and self.term_dict.champions is not None
+
+    def champion_list(self, term):
+        """
+        Returns the champion list of `term`, the index must have champion lists.
+        :return: (doc_ids, tfs) numpy arrays in decreasing tf/DL order, None when the term is not in the index
+        """
+        check_deadline()
+        row = self.term_dict.row(term)
+        return None if row is None else self.term_dict.champion_list(row)
+
+    def read_posting_blocks(self, term, comp, blocks):
+        """
+        Reads only some blocks of the posting list of `term`, the index must have score bounds. Runs of
+        consecutive blocks are read as one byte range, and the whole list is read when most of its blocks
+        (or more than MAX_BLOCK_READS ranges) are requested.
+        :param term: str
+        :param comp: string, directory name for component of the index
+        :param blocks: sorted numpy array of distinct block numbers of the term
+        :return: (doc_ids, tfs) numpy arrays holding at least the postings of the requested blocks
+        """
+        check_deadline()
+        if self.posting_cache is not None and len(blocks) != 0:
+            postings = self.posting_cache.get((comp, term))
+            if postings is not None:
+                return postings
+        row = self.term_dict.row(term)
+        start, end = self.term_dict.block_range(row)
+        n_blocks = end - start
+        run_starts = np.flatnonzero(np.diff(blocks, prepend=-2) != 1)
+        if len(blocks) == 0 or 2 * len(blocks) > n_blocks or len(run_starts) > MAX_BLOCK_READS:
+            return self.read_posting_arrays(term, comp) if len(blocks) != 0 else EMPTY_POSTINGS
+        last_doc = self.term_dict.blocks['block_last_doc'][start:end]
+        offsets = self.term_dict.blocks['block_offset'][start:end]
+        df, size, locs = self.df[term], self.posting_size(term), self.posting_locs[term]
+        run_ends = np.append(run_starts[1:], len(blocks)) - 1
+        doc_ids, tfs = [], []
+        with closing(MultiFileReader(self.backend)) as reader:
+            for first, last in zip(blocks[run_starts].tolist(), blocks[run_ends].tolist()):
+                byte_start = int(offsets[first])
+                byte_end = int(offsets[last + 1]) if last + 1 < n_blocks else size
+                b = reader.read(locs, byte_end - byte_start, comp, start=byte_start)
+                n = min((last + 1) * SCORE_BLOCK_SIZE, df) - first * SCORE_BLOCK_SIZE
+                base_doc_id = int(last_doc[first - 1]) if first > 0 else 0
+                block_doc_ids, block_tfs = decode_posting_block(b, n, self.posting_format, base_doc_id)
+                doc_ids.append(block_doc_ids)
+                tfs.append(block_tfs)
+        return np.concatenate(doc_ids), np.concatenate(tfs)
+
+    def posting_size(self, term):
+        """ Returns the number of bytes the posting list of `term` takes on disk. """
+        if self.posting_format == POSTING_FORMAT_RAW:
+            return self.df[term] * TUPLE_SIZE
+        return self.posting_bytes[term]
 
     def read_posting_list(self, term, comp):
-        posting_list = []
-        with closing(MultiFileReader()) as reader:
-            if term in self.posting_locs.keys() and self.df.keys():
-                locs = self.posting_locs[term]
-                # read a certain number of bytes into variable b
-                b = reader.read(locs, self.df[term] * TUPLE_SIZE, comp)
-                # convert the bytes read into `b` to a proper posting list.
-                for i in range(self.df[term]):
-                    doc_id = int.from_bytes(b[i * TUPLE_SIZE:i * TUPLE_SIZE + 4], 'big')
-                    tf = int.from_bytes(b[i * TUPLE_SIZE + 4:(i + 1) * TUPLE_SIZE], 'big')
-                    posting_list.append((doc_id, tf))
-                return posting_list
-        return []
+        """ Returns the posting list of `term` as a list of (doc_id, tf) tuples. """
+        doc_ids, tfs = self.read_posting_arrays(term, comp)
+        return list(zip(doc_ids.tolist(), tfs.tolist()))
 
     def posting_lists_iter(self, query, comp):
         """ A generator that reads one posting list from disk and yields
             a (word:str, [(doc_id:int, tf:int), ...]) tuple.
         """
-        reader = MultiFileReader()
-        try:
-            for w in query:
-                if w in self.posting_locs.keys():
-                    locs = self.posting_locs[w]
-                    # read a certain number of bytes into variable b
-                    b = reader.read(locs, self.df[w] * TUPLE_SIZE, comp)
-                    posting_list = []
-                    # convert the bytes read into `b` to a proper posting list.
-                    for i in range(self.df[w]):
-                        doc_id = int.from_bytes(b[i * TUPLE_SIZE:i * TUPLE_SIZE + 4], 'big')
-                        tf = int.from_bytes(b[i * TUPLE_SIZE + 4:(i + 1) * TUPLE_SIZE], 'big')
-                        posting_list.append((doc_id, tf))
-                    yield w, posting_list
-        finally:
-            reader.close()
+        for w in query:
+            if w in self.posting_locs.keys():
+                yield w, self.read_posting_list(w, comp)
+
+    def doc_lengths(self, doc_ids):
+        """ Returns the lengths of the given documents as a numpy array. """
+        if isinstance(self.DL, SortedArrayMap):
+            return self.DL.gather(doc_ids).astype(np.float64)
+        return np.fromiter((self.DL[doc_id] for doc_id in doc_ids.tolist()), dtype=np.float64, count=len(doc_ids))
+
+    def doc_norms(self, doc_ids):
+        """ Returns the tf-idf vector norms of the given documents as a numpy array, the index must have norms. """
+        return self.norms.gather(doc_ids, missing=1).astype(np.float64)
 
     def write(self, base_dir, name):
         """ Write the in-memory index to disk and populate the `posting_locs`
@@ -184,12 +1481,13 @@ class InvertedIndex:
         if sort:
             pl = sorted(pl, key=itemgetter(0))
         # convert to bytes
-        b = b''.join([(int(doc_id) << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
-                      for doc_id, tf in pl])
+        b = encode_postings([doc_id for doc_id, _ in pl], [tf for _, tf in pl], self.posting_format)
         # write to file(s)
         locs = writer.write(b)
         # save file locations to index
         self.posting_locs[w].extend(locs)
+        if self.posting_format != POSTING_FORMAT_RAW:
+            self.posting_bytes[w] = len(b)
 
     def __getstate__(self):
         """ Modify how the object is pickled by removing the internal posting lists
@@ -198,6 +1496,8 @@ class InvertedIndex:
         # TODO check
         state = self.__dict__.copy()
         del state['_posting_list']
+        state.pop('backend', None)
+        state.pop('posting_cache', None)
         return state
 
 
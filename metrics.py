@@ -0,0 +1,220 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# --- Histogram buckets --- #
+# Upper bounds (in seconds) of the latency histogram buckets, from half a millisecond to the search timeout.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# --- Metric types --- #
+class Counter:
+    """ Thread-safe monotonic counter, with one value per combination of label values. """
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labels, key), value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """ Thread-safe histogram of observed values (cumulative buckets, sum and count), per combination of label
+        values.
+    """
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, the +Inf bucket, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        res = []
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts[:-1]):
+                cumulative += n
+                res.append((f"{self.name}_bucket", _format_labels(self.labels, key, [("le", bound)]), cumulative))
+            res.append((f"{self.name}_sum", _format_labels(self.labels, key), counts[-1]))
+            res.append((f"{self.name}_count", _format_labels(self.labels, key), cumulative))
+        return res
+
+
+class Collected:
+    """ Metric whose values are read when the metrics are exported, e.g. the counters kept by a cache.
+        `collect()` returns a list of (dict of label name -> value, value) pairs.
+    """
+
+    def __init__(self, name, help, type, collect):
+        self.name = name
+        self.help = help
+        self.type = type
+        self._collect = collect
+
+    def samples(self):
+        res = []
+        for labels, value in self._collect():
+            res.append((self.name, _format_labels(list(labels), list(labels.values())), value))
+        return res
+
+
+# --- Registry --- #
+class Registry:
+    """ The metrics of the process, exported in the Prometheus text format. """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def collected(self, name, help, type, collect):
+        return self.register(Collected(name, help, type, collect))
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        :return: str
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Search metrics --- #
+STAGE_SECONDS = REGISTRY.histogram("search_stage_seconds", "Latency of the stages of the search requests, "
+                                                           "stages nest (scoring includes posting reads)", ["stage"])
+REQUEST_SECONDS = REGISTRY.histogram("http_request_seconds", "Latency of the requests by endpoint",
+                                     ["endpoint", "status"])
+BYTES_READ = REGISTRY.counter("posting_bytes_read_total", "Bytes of posting data read from storage")
+BYTES_CACHED = REGISTRY.counter("posting_bytes_cached_total", "Bytes of posting data served by the block cache")
+BLOCKS_READ = REGISTRY.counter("posting_blocks_read_total", "Byte ranges of posting files read (one per file of a "
+                                                            "posting list range)")
+POSTINGS_DECODED = REGISTRY.counter("postings_decoded_total", "Postings decoded into arrays")
+
+
+# --- Per-request traces --- #
+class Trace:
+    """ Latency of every stage and totals of the counters of one request. The trace is shared by the threads
+        working on the request (see stage and count), through the context variable copied into their tasks.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            total, calls = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, calls + 1)
+
+    def add_count(self, name, amount):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def to_dict(self):
+        """
+        Returns the stage latencies in milliseconds, with their number of calls, and the counter totals.
+        :return: dict
+        """
+        with self._lock:
+            return {"stages": {name: {"ms": round(total * 1000, 3), "calls": calls}
+                               for name, (total, calls) in self.stages.items()},
+                    "counts": dict(self.counts)}
+
+
+_TRACE = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace(enabled):
+    """
+    Starts the trace of a request in the current context, or clears the trace of a previous request served by
+    the same thread.
+    :param enabled: bool, whether the request asked for a trace
+    :return: Trace, or None when not enabled
+    """
+    trace = Trace() if enabled else None
+    _TRACE.set(trace)
+    return trace
+
+
+@contextmanager
+def stage(name):
+    """ Measures the latency of the code in the `with` block as a stage of the search requests. """
+    t_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t_start
+        STAGE_SECONDS.observe(seconds, stage=name)
+        trace = _TRACE.get()
+        if trace is not None:
+            trace.add_stage(name, seconds)
+
+
+def count(counter, amount=1):
+    """ Increments a counter without labels and the same count of the current trace. """
+    counter.inc(amount)
+    trace = _TRACE.get()
+    if trace is not None:
+        trace.add_count(counter.name, amount)
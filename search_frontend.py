@@ -1,16 +1,30 @@
 import re
 import time
+import logging
+import multiprocessing
+import contextvars
+import resource
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import os
 import nltk
 import json
-from flask import Flask, request, jsonify
+import numpy as np
+from flask import Flask, g, request, jsonify
 from nltk.stem.porter import PorterStemmer
 from nltk.corpus import stopwords
 from backend_calculations import *
+from inverted_index_gcp import BLOCK_CACHE, DeadlineExceeded, PostingCache, get_default_backend, set_deadline
+from doc_store import MISSING_FLOAT, MISSING_INT, DocStore, TitleStore, build_doc_store
+from metrics import REGISTRY, REQUEST_SECONDS, stage, start_trace
 
 nltk.download('stopwords')
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 # --- Global variables --- #
 BUCKET_NAME = "bucket2121"
 
@@ -22,11 +36,13 @@ STOP_WORDS = frozenset(stopwords.words('english')).union(["category", "reference
                                                           "many", "however", "would", "became"])
 # --- Inverted index directories --- #
 BODY_DIR = "body"
+BODY_BM25_DIR = "body_bm25"
 TITLE_DIR = "titles"
 ANCHOR_DIR = "anchor"
 
 # --- Inverted index files --- #
 BODY_IND_FILE = "body_index"
+BODY_BM25_IND_FILE = "body_bm25_index"
 TITLE_IND_FILE = "title_index"
 ANCHOR_IND_FILE = "anchor_index"
 
@@ -35,31 +51,399 @@ TITLE_JSON = "titles"
 PAGE_RANK_JSON = "pr"
 PAGE_VIEWS_JSON = "pv"
 
+# --- Document store directory --- #
+DOC_STORE_DIR = "docs"
+
+# --- Concurrent field retrieval --- #
+# Threads shared by all requests to retrieve the fields of a query concurrently (the work is mostly I/O).
+SEARCH_THREADS = int(os.environ.get("SEARCH_THREADS", 12))
+# Seconds a request waits for its fields, a field that is not done by then is left out of the ranking and stops at
+# its next posting list read, which frees its thread.
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", 10))
+FIELD_POOL = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="field")
+
+# --- Batch search --- #
+# Largest number of queries accepted by one batch request, the postings of all its terms are held in memory.
+BATCH_MAX_QUERIES = int(os.environ.get("BATCH_MAX_QUERIES", 1000))
+
+# --- Result cache params --- #
+# Bounds of the cache of serialized search results: number of entries (0 disables it), bytes and seconds to live.
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 10000))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 3600))
+
+# --- Title and anchor results params --- #
+# Results with more matches than this are streamed in rank order, STREAM_CHUNK_SIZE results at a time, instead of
+# being serialized whole (and are not cached).
+STREAM_MIN_RESULTS = int(os.environ.get("STREAM_MIN_RESULTS", 10000))
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 5000))
+# Largest page of the paginated results (the `limit` parameter).
+PAGE_MAX_LIMIT = int(os.environ.get("PAGE_MAX_LIMIT", 10000))
+
+# --- Posting cache params --- #
+# Bytes of decoded posting lists cached per index (0 disables the caches).
+POSTING_CACHE_MAX_BYTES = int(os.environ.get("POSTING_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Startup warm-up of the posting caches: a file of past queries (one per line) whose terms are loaded first,
+# then the WARMUP_TOP_DF terms with the highest df of every index.
+WARMUP_QUERIES = os.environ.get("WARMUP_QUERIES")
+WARMUP_TOP_DF = int(os.environ.get("WARMUP_TOP_DF", 0))
+
+# --- Startup params --- #
+# Whether the indexes and stores are loaded in a background thread, so the server binds its port and answers
+# /healthz while loading (and /readyz once they are loaded). With 0 they are loaded before the import returns,
+# which gunicorn.conf.py does so the master process loads them before forking the workers.
+STARTUP_BACKGROUND = os.environ.get("STARTUP_BACKGROUND", "1") == "1"
+# Threads loading the independent startup components in parallel.
+STARTUP_THREADS = int(os.environ.get("STARTUP_THREADS", 8))
+
+
+# --- Result cache --- #
+class ResultCache:
+    """ Thread-safe LRU cache of serialized search results keyed by (endpoint, mode, tokens), bounded by a number
+        of entries and by the bytes of the results, whose entries expire after a TTL.
+        Invalidating the cache (e.g. after an index was reloaded) empties it and starts a new generation, results
+        computed during an older generation are not stored.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = 0
+        self.current_bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached payload of a key, or None when it is not cached or expired.
+        :param key: tuple
+        :return: bytes
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._pop(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, payload, generation):
+        """
+        Caches a payload, unless the cache was invalidated since `generation`, when the payload was computed.
+        :param key: tuple
+        :param payload: bytes
+        :param generation: int, the generation of the cache before the payload was computed
+        """
+        with self._lock:
+            if generation != self.generation or self.max_entries <= 0 or len(payload) > self.max_bytes:
+                return
+            self._pop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, payload)
+            self.current_bytes += len(payload)
+            while len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute, complete=None):
+        """
+        Returns the cached payload of a key, computing and caching it on a miss.
+        :param key: tuple
+        :param compute: function returning the payload
+        :param complete: optional function called after `compute`, the payload is not cached when it returns False
+        :return: (payload, whether it was cached)
+        """
+        generation = self.generation
+        payload = self.get(key)
+        if payload is not None:
+            return payload, True
+        payload = compute()
+        if complete is None or complete():
+            self.put(key, payload, generation)
+        return payload, False
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= len(entry[1])
+
+    def invalidate(self):
+        """ Drops every cached result, to be called whenever an index or the document store is reloaded. """
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.generation += 1
+
+    def after_fork(self):
+        """ Called in a child process after a fork, the lock belongs to the parent. """
+        self._lock = threading.Lock()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "bytes": self.current_bytes, "max_entries": self.max_entries,
+                    "max_bytes": self.max_bytes, "ttl": self.ttl, "generation": self.generation, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+os.register_at_fork(after_in_child=RESULT_CACHE.after_fork)
+
+# --- Cache invalidation --- #
+# Number of POST /cache_invalidate requests, in shared memory created before the pre-fork server forks its
+# workers: every worker clears its own caches when the count moved past the last one it saw.
+CACHE_INVALIDATIONS = multiprocessing.Value('q', 0)
+_seen_invalidations = 0
+
+
+def invalidate_caches():
+    """ Drops the cached results, the decoded posting lists and the posting blocks of this process. """
+    RESULT_CACHE.invalidate()
+    BLOCK_CACHE.clear()
+    for index, _ in posting_indexes():
+        if index.posting_cache is not None:
+            index.posting_cache.clear()
+
+
+def sync_cache_invalidations():
+    """ Applies to this process the invalidations requested from any worker. """
+    global _seen_invalidations
+    invalidations = CACHE_INVALIDATIONS.value
+    if invalidations != _seen_invalidations:
+        _seen_invalidations = invalidations
+        invalidate_caches()
+
+
+# --- Startup state --- #
+class Startup:
+    """ Progress of the loading of the startup components: the load time and memory of every loaded component,
+        whether all of them are loaded, and the error that stopped the loading if any.
+    """
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.components = {}
+        self.seconds = None
+        self.error = None
+
+    def status(self):
+        """
+        Returns the startup state, with the peak resident memory of the process.
+        :return: dict
+        """
+        return {"ready": self.ready.is_set(), "error": self.error, "seconds": self.seconds,
+                "components": dict(self.components),
+                "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+STARTUP = Startup()
+
 
 # --- Helper Functions --- #
 def import_index(base_dir, file):
     """
-    Reads the index from the bucket using "read_index" method
-    from class InvertedIndex
+    Reads the index from the bucket, using the memory-mapped compact term dictionary when the index has one
+    and the pickled "read_index" globals otherwise
     :param base_dir: str
     :param file: str
     :return: InvertedIndex
     """
+    if InvertedIndex.has_compact_index(BUCKET_NAME, base_dir, file):
+        return InvertedIndex.read_compact_index(BUCKET_NAME, base_dir, file)
     return InvertedIndex.read_index(BUCKET_NAME, base_dir, file)
 
 
+def import_optional_index(base_dir, file):
+    """
+    Reads an index that does not have to be deployed, like the BM25 impact index of the body
+    :param base_dir: str
+    :param file: str
+    :return: InvertedIndex, or None when the bucket has no such index
+    """
+    if InvertedIndex.has_compact_index(BUCKET_NAME, base_dir, file) or \
+            get_default_backend(BUCKET_NAME).exists(f"{base_dir}/{file}.pkl"):
+        return import_index(base_dir, file)
+    logger.info("no %s index in %s/", file, base_dir)
+    return None
+
+
+def body_index(mode):
+    """
+    Returns the body index a body retrieval mode scores
+    :param mode: str, one of BODY_MODES
+    :return: (InvertedIndex, directory), None when the index of the mode is not deployed
+    """
+    if mode == "bm25":
+        return (BODY_BM25_INVERTED_INDEX, BODY_BM25_DIR) if BODY_BM25_INVERTED_INDEX is not None else None
+    return BODY_INVERTED_INDEX, BODY_DIR
+
+
 def read_json_file(component):
     """
-    Reads the json file from the bucket using "json" library
+    Reads the json file from the storage backend using "json" library
     :param component: str
     :return: json
     """
-    os.system(f"gsutil cp gs://{BUCKET_NAME}/{component}/{component}.json .")
-    with open(f"{component}.json") as f:
-        res = json.load(f)
+    return json.loads(get_default_backend(BUCKET_NAME).read_file(f"{component}/{component}.json"))
+
+
+def timed_load(component, loader, *args):
+    """
+    Calls the loader of a startup component and logs how long it took
+    :param component: str, name for the log
+    :param loader: function
+    :return: the loaded component
+    """
+    t_start = time.time()
+    res = loader(*args)
+    seconds = time.time() - t_start
+    memory = res.memory_usage() if hasattr(res, "memory_usage") else None
+    STARTUP.components[component] = {"seconds": round(seconds, 3), "bytes": memory}
+    if memory is None:
+        logger.info("loaded %s in %.3fs", component, seconds)
+    else:
+        logger.info("loaded %s in %.3fs (%d bytes)", component, seconds, memory)
     return res
 
 
+def read_doc_store(indexes):
+    """
+    Reads the per-document arrays (PageRank, page views and document lengths) written by
+    "index_builder.py docs", or builds them from the JSON files when the store was not written yet
+    :param indexes: dict, component dir name -> InvertedIndex, the document lengths of the built store
+    :return: DocStore
+    """
+    backend = get_default_backend(BUCKET_NAME)
+    if DocStore.exists(backend, DOC_STORE_DIR):
+        return DocStore.load(backend, DOC_STORE_DIR)
+    logger.warning("no binary document store in %s/, building it from the JSON files", DOC_STORE_DIR)
+    return build_doc_store(read_json_file(PAGE_RANK_JSON), read_json_file(PAGE_VIEWS_JSON), indexes)
+
+
+def read_title_store():
+    """
+    Reads the memory-mapped title store written by "index_builder.py docs", or builds it from the titles
+    JSON file when the store was not written yet
+    :return: TitleStore
+    """
+    backend = get_default_backend(BUCKET_NAME)
+    if TitleStore.exists(backend, DOC_STORE_DIR):
+        return TitleStore.load(backend, DOC_STORE_DIR)
+    logger.warning("no binary title store in %s/, building it from the JSON file", DOC_STORE_DIR)
+    return TitleStore.build(read_json_file(TITLE_JSON))
+
+
+def posting_indexes():
+    """
+    Returns the deployed indexes with their directories
+    :return: list of (InvertedIndex, directory)
+    """
+    indexes = [(BODY_INVERTED_INDEX, BODY_DIR), (BODY_BM25_INVERTED_INDEX, BODY_BM25_DIR),
+               (TITLE_INVERTED_INDEX, TITLE_DIR), (ANCHOR_INVERTED_INDEX, ANCHOR_DIR)]
+    return [(index, comp) for index, comp in indexes if index is not None]
+
+
+def read_query_terms(queries_file=WARMUP_QUERIES):
+    """
+    Counts the terms of the past queries the posting caches are warmed up with
+    :param queries_file: str, path of a file with one query per line, or None
+    :return: Counter, term -> number of occurrences
+    """
+    query_terms = Counter()
+    if queries_file:
+        with open(queries_file, encoding='utf8') as f:
+            for line in f:
+                query_terms.update(tokenize(line))
+    return query_terms
+
+
+def warm_up_posting_cache(index, comp, query_terms, top_df=WARMUP_TOP_DF):
+    """
+    Gives an index a posting cache and loads into it the terms of the past queries, most frequent first,
+    followed by the `top_df` terms with the highest df of the index
+    :param index: InvertedIndex
+    :param comp: str, directory of the index
+    :param query_terms: Counter, see read_query_terms
+    :param top_df: int
+    """
+    if POSTING_CACHE_MAX_BYTES <= 0:
+        return
+    index.posting_cache = PostingCache(POSTING_CACHE_MAX_BYTES)
+    terms = query_terms.most_common()
+    terms += [(term, 1) for term in index.top_df_terms(top_df) if term not in query_terms] if top_df else []
+    if terms:
+        t_start = time.time()
+        loaded = index.warm_up(comp, terms)
+        logger.info("warmed up %d posting lists of %s/ in %.3fs (%d bytes)", loaded, comp, time.time() - t_start,
+                    index.posting_cache.current_bytes)
+
+
+def load_components():
+    """
+    Loads the indexes, the document store and the title store, the independent ones in parallel, warms up the
+    posting caches and marks the server ready. The components are published together once all are loaded, so
+    calling it again reloads them without serving a mix of old and new ones, and empties the result cache.
+    """
+    global BODY_INVERTED_INDEX, BODY_BM25_INVERTED_INDEX, TITLE_INVERTED_INDEX, ANCHOR_INVERTED_INDEX, \
+        DOC_STORE, PAGE_RANK, PAGE_VIEWS, TITLES
+    t_start = time.time()
+    with ThreadPoolExecutor(max_workers=STARTUP_THREADS, thread_name_prefix="startup") as pool:
+        body = pool.submit(timed_load, BODY_IND_FILE, import_index, BODY_DIR, BODY_IND_FILE)
+        body_bm25 = pool.submit(timed_load, BODY_BM25_IND_FILE, import_optional_index, BODY_BM25_DIR,
+                                BODY_BM25_IND_FILE)
+        title = pool.submit(timed_load, TITLE_IND_FILE, import_index, TITLE_DIR, TITLE_IND_FILE)
+        anchor = pool.submit(timed_load, ANCHOR_IND_FILE, import_index, ANCHOR_DIR, ANCHOR_IND_FILE)
+        titles = pool.submit(timed_load, "title store", read_title_store)
+        query_terms = pool.submit(read_query_terms)
+        indexes = {BODY_DIR: body.result(), TITLE_DIR: title.result(), ANCHOR_DIR: anchor.result()}
+
+        # the document store is built from the document lengths of the indexes when it was not written yet
+        doc_store = timed_load("document store", read_doc_store, indexes)
+        for comp, index in indexes.items():
+            index.DL = doc_store.column(f"dl_{comp}")
+
+        indexes[BODY_BM25_DIR] = body_bm25.result()
+        warm_ups = [pool.submit(warm_up_posting_cache, index, comp, query_terms.result())
+                    for comp, index in indexes.items() if index is not None]
+        for warm_up in warm_ups:
+            warm_up.result()
+        TITLES = titles.result()
+    BODY_INVERTED_INDEX, TITLE_INVERTED_INDEX, ANCHOR_INVERTED_INDEX = indexes[BODY_DIR], indexes[TITLE_DIR], \
+        indexes[ANCHOR_DIR]
+    BODY_BM25_INVERTED_INDEX = indexes[BODY_BM25_DIR]
+    DOC_STORE, PAGE_RANK, PAGE_VIEWS = doc_store, doc_store.column("pagerank"), doc_store.column("pageviews")
+    RESULT_CACHE.invalidate()
+    STARTUP.seconds = round(time.time() - t_start, 3)
+    STARTUP.ready.set()
+    logger.info("startup components loaded in %.3fs", STARTUP.seconds)
+
+
+def start():
+    """ Loads the startup components, in a background thread when STARTUP_BACKGROUND is set. A failure is logged
+        and reported by /healthz and /readyz.
+    """
+    def run():
+        try:
+            load_components()
+        except Exception as e:
+            logger.exception("loading the startup components failed")
+            STARTUP.error = repr(e)
+            if not STARTUP_BACKGROUND:
+                raise
+
+    if STARTUP_BACKGROUND:
+        threading.Thread(target=run, name="startup", daemon=True).start()
+    else:
+        run()
+
+
 def tokenize(text, filter_flag=False):
     """
     This function aims in tokenize a text into a list of tokens. Moreover, it filters stopwords.
@@ -72,20 +456,322 @@ def tokenize(text, filter_flag=False):
     -----------
     list of tokens (e.g., list of tokens).
     """
-    list_of_tokens = [token.group() for token in RE_WORD.finditer(text.lower()) if
-                      token.group() not in STOP_WORDS]
-    if filter_flag:
-        list_of_tokens = [PS.stem(token) for token in list_of_tokens]
+    with stage("tokenize"):
+        list_of_tokens = [token.group() for token in RE_WORD.finditer(text.lower()) if
+                          token.group() not in STOP_WORDS]
+        if filter_flag:
+            list_of_tokens = [PS.stem(token) for token in list_of_tokens]
     return list_of_tokens
 
 
+def timed_call(func, *args):
+    """
+    Calls a function and measures how long it took
+    :return: (result of the function, seconds)
+    """
+    t_start = time.perf_counter()
+    res = func(*args)
+    return res, time.perf_counter() - t_start
+
+
+def retrieve_fields(retrievals, timings, timeout=SEARCH_TIMEOUT):
+    """
+    Runs the retrieval of every field concurrently on the field thread pool
+    :param retrievals: dict, field name -> (function, args)
+    :param timings: dict, the latency of every finished field (in seconds) is stored under its name
+    :param timeout: float, seconds to wait for the fields
+    :return: dict, field name -> result, an empty list for the fields that did not finish in time
+    """
+    deadline = time.monotonic() + timeout
+    futures = {}
+    for field, (func, args) in retrievals.items():
+        # every task runs in a copy of the request context, so its stages are added to the trace of the request,
+        # with the deadline after which its posting reads fail
+        context = contextvars.copy_context()
+        context.run(set_deadline, deadline)
+        futures[field] = FIELD_POOL.submit(context.run, timed_call, func, *args)
+    wait(futures.values(), timeout=timeout)
+    results = {}
+    for field, future in futures.items():
+        if future.done() and not isinstance(future.exception(), DeadlineExceeded):
+            results[field], timings[field] = future.result()
+        else:
+            # a task that already started stops at its next posting read
+            future.cancel()
+            logger.warning("%s retrieval did not finish in %.1fs, ranking without it", field, timeout)
+            results[field] = []
+    return results
+
+
+def body_results(tokens, mode, postings=None):
+    """ Top 100 (wiki_id, score) pairs of the body for a tokenized query """
+    with stage("score_body"):
+        return get_top_n_score_for_queries(tokens, *body_index(mode), 100, mode, postings)
+
+
+def title_results(tokens, k=None, postings=None):
+    """ (wiki_id, score) pairs of the titles for a tokenized query, the best k or all of them """
+    with stage("score_title"):
+        return sorting_results_using_ranking(TITLE_INVERTED_INDEX, tokens, TITLE_DIR, k, postings)
+
+
+def anchor_results(tokens, k=None, postings=None):
+    """ (wiki_id, score) pairs of the anchor texts for a tokenized query, the best k or all of them """
+    with stage("score_anchor"):
+        return sorting_results_using_ranking(ANCHOR_INVERTED_INDEX, tokens, ANCHOR_DIR, k, postings)
+
+
+def title_ranking(tokens, k=None):
+    """ (wiki_ids, scores) arrays of the titles for a tokenized query, the best k or all of them """
+    with stage("score_title"):
+        return sorting_results_arrays(TITLE_INVERTED_INDEX, tokens, TITLE_DIR, k)
+
+
+def anchor_ranking(tokens, k=None):
+    """ (wiki_ids, scores) arrays of the anchor texts for a tokenized query, the best k or all of them """
+    with stage("score_anchor"):
+        return sorting_results_arrays(ANCHOR_INVERTED_INDEX, tokens, ANCHOR_DIR, k)
+
+
+def search_results(tokens, mode, timings, postings=None):
+    """
+    The fused ranking of a tokenized query: the top 100 of body, titles and anchors merged with PageRank and
+    page views. Without postings the fields are retrieved concurrently.
+    :param tokens: list of str
+    :param mode: str, body retrieval mode
+    :param timings: dict, latencies (in seconds) of the fields and of the fusion
+    :param postings: optional dict, field name -> postings already read for the field (see get_posting_arrays)
+    :return: list of pairs (wiki_id, score)
+    """
+    postings = postings or {}
+    retrievals = {"body": (body_results, (tokens, mode, postings.get("body"))),
+                  "title": (title_results, (tokens, 100, postings.get("title"))),
+                  "anchor": (anchor_results, (tokens, 100, postings.get("anchor")))}
+    if postings:
+        # the postings are in memory, the scoring is left to the calling thread
+        results = {}
+        for field, (func, args) in retrievals.items():
+            results[field], timings[field] = timed_call(func, *args)
+    else:
+        results = retrieve_fields(retrievals, timings)
+    with stage("merge_results"):
+        return merge_results(results["title"], results["body"], results["anchor"], PAGE_RANK, PAGE_VIEWS, n=100,
+                             timings=timings)
+
+
+def read_batch_postings(fields, token_lists):
+    """
+    Reads the posting lists of the distinct terms of a batch of queries once per field, the fields concurrently
+    :param fields: dict, field name -> (InvertedIndex, directory)
+    :param token_lists: list of tokenized queries
+    :return: dict, field name -> dict of term -> posting arrays
+    """
+    terms = list(dict.fromkeys(token for tokens in token_lists for token in tokens))
+    futures = {field: FIELD_POOL.submit(get_posting_arrays, index, terms, comp)
+               for field, (index, comp) in fields.items()}
+    return {field: future.result() for field, future in futures.items()}
+
+
+def to_json(res):
+    """ Serializes a result as compact JSON bytes, like jsonify """
+    return app.json.dumps(res, separators=(",", ":")).encode('utf8')
+
+
+def json_response(payload):
+    """ Response of a serialized JSON payload """
+    return app.response_class(payload, mimetype="application/json")
+
+
+def cached_results(endpoint, mode, tokens, compute, complete=None):
+    """
+    Returns the serialized results of a tokenized query from the result cache, computing them on a miss
+    :param endpoint: str
+    :param mode: str, body retrieval mode (None for the endpoints without modes)
+    :param tokens: list of str
+    :param compute: function returning the results
+    :param complete: optional function telling whether the computed results can be cached
+    :return: (payload bytes, whether it was cached)
+    """
+    return RESULT_CACHE.get_or_compute((endpoint, mode, tuple(tokens)), lambda: to_json(compute()), complete)
+
+
+def cached_batch_results(endpoint, mode, token_lists, fields, compute):
+    """
+    Serialized results of a batch of tokenized queries. The cached results are reused and the posting lists of
+    the terms of the other queries are read once per field (see read_batch_postings) to compute them
+    :param endpoint: str, the endpoint of a single query whose cache entries are shared
+    :param mode: str, body retrieval mode (None for the endpoints without modes)
+    :param token_lists: list of tokenized queries
+    :param fields: dict, field name -> (InvertedIndex, directory) of the postings to read
+    :param compute: function (tokens, dict of field name -> postings) returning the results of a query
+    :return: bytes, the JSON list of the results of the queries in input order
+    """
+    generation = RESULT_CACHE.generation
+    keys = [(endpoint, mode, tuple(tokens)) for tokens in token_lists]
+    payloads = [RESULT_CACHE.get(key) for key in keys]
+    missed = [i for i, payload in enumerate(payloads) if payload is None]
+    if missed:
+        postings = read_batch_postings(fields, [token_lists[i] for i in missed])
+        for i in missed:
+            payloads[i] = to_json(compute(token_lists[i], postings))
+            RESULT_CACHE.put(keys[i], payloads[i], generation)
+    return b"[" + b",".join(payloads) + b"]"
+
+
+def read_batch_queries():
+    """
+    Reads the JSON list of queries of a batch request and tokenizes them
+    :return: list of tokenized queries, or None when the payload is not a list of at most BATCH_MAX_QUERIES strings
+    """
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list) or len(queries) > BATCH_MAX_QUERIES or \
+            not all(isinstance(query, str) for query in queries):
+        return None
+    return [tokenize(query) for query in queries]
+
+
+def server_timing(timings):
+    """
+    Formats latencies as a Server-Timing header value
+    :param timings: dict, name -> seconds
+    :return: str
+    """
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def read_wiki_ids():
+    """
+    Reads the wiki ids of a lookup request: a JSON list of ids, or with Content-Type application/octet-stream
+    a body of little-endian int64 ids
+    :return: int64 numpy array, or None when the payload is not a list of ids (JSON integers, not floats or
+             booleans, that fit in int64)
+    """
+    if request.mimetype == "application/octet-stream":
+        data = request.get_data()
+        return np.frombuffer(data, dtype='<i8') if len(data) % 8 == 0 else None
+    wiki_ids = request.get_json(silent=True)
+    if not isinstance(wiki_ids, list) or \
+            not all(isinstance(wiki_id, int) and not isinstance(wiki_id, bool) for wiki_id in wiki_ids):
+        return None
+    try:
+        return np.array(wiki_ids, dtype=np.int64)
+    except OverflowError:
+        return None
+
+
+def column_values_response(column):
+    """
+    Response with the value of a document store column for every wiki id of the request, in input order.
+    By default a JSON list with null for the ids without a value. With format=binary (or when the client only
+    accepts application/octet-stream) the little-endian array of the values, float64 with NaN or int64 with -1
+    for the missing ones, whose dtype and missing value are in the X-Value-Type and X-Missing-Value headers.
+    :param column: DocColumn
+    :return: Response
+    """
+    wiki_ids = read_wiki_ids()
+    if wiki_ids is None:
+        return jsonify({"error": "expected a JSON list of wiki ids or a binary array of int64 ids"}), 400
+    values, found = column.lookup(wiki_ids)
+    binary = request.args.get("format") == "binary" or request.accept_mimetypes.best_match(
+        ["application/json", "application/octet-stream"]) == "application/octet-stream"
+    if binary:
+        floating = np.issubdtype(values.dtype, np.floating)
+        missing = MISSING_FLOAT if floating else MISSING_INT
+        values = np.where(found, values, missing).astype('<f8' if floating else '<i8')
+        response = app.response_class(values.tobytes(), mimetype="application/octet-stream")
+        response.headers["X-Value-Type"] = values.dtype.str
+        response.headers["X-Missing-Value"] = str(missing)
+        return response
+    res = values.tolist()
+    for i in np.flatnonzero(~found).tolist():
+        res[i] = None
+    return jsonify(res)
+
+
 def get_title(scores):
     """
     Returns the title for every wiki_id
     :param scores: list of pairs (wiki_id, score).
     :return: list, (wiki_id, title)
     """
-    return [(x[0], TITLES[str(x[0])]) for x in scores]
+    return lookup_titles([x[0] for x in scores])
+
+
+def lookup_titles(wiki_ids):
+    """
+    Returns the title for every wiki_id
+    :param wiki_ids: list of int
+    :return: list, (wiki_id, title)
+    """
+    with stage("get_title"):
+        return list(zip(wiki_ids, TITLES.get_many(wiki_ids)))
+
+
+def titled_json_chunks(wiki_ids, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Serializes ranked wiki ids with their titles as a JSON list of (wiki_id, title) pairs, looking up the titles
+    of one chunk of ids at a time
+    :param wiki_ids: numpy array of int, in rank order
+    :param chunk_size: int
+    :return: generator of bytes
+    """
+    yield b"["
+    for start in range(0, len(wiki_ids), chunk_size):
+        chunk = wiki_ids[start:start + chunk_size].tolist()
+        yield (b"," if start else b"") + to_json(lookup_titles(chunk))[1:-1]
+    yield b"]"
+
+
+def read_page():
+    """
+    Reads the pagination parameters of a request: `limit`, the number of results of the page, and `cursor`, the
+    `next_cursor` of the previous page (the page starts at the best result without it)
+    :return: (offset, limit), None for a request without `limit`, or "invalid"
+    """
+    limit, cursor = request.args.get('limit'), request.args.get('cursor', '0')
+    if limit is None:
+        return None
+    if not limit.isdigit() or not cursor.isdigit() or not 0 < int(limit) <= PAGE_MAX_LIMIT:
+        return "invalid"
+    return int(cursor), int(limit)
+
+
+def ranked_titles_response(endpoint, tokens, rank):
+    """
+    Response with the (wiki_id, title) results of a title or anchor query in rank order. All the results are
+    returned as a JSON list, small lists from the result cache and large ones streamed. With a `limit`, one page
+    of results is returned as {"results": [...], "next_cursor": ...}, computing only the ranking of the results
+    up to that page.
+    :param endpoint: str
+    :param tokens: list of str
+    :param rank: function (tokens, k) returning the (wiki_ids, scores) arrays of the best k results, or all of them
+    :return: Response
+    """
+    page = read_page()
+    if page == "invalid":
+        return jsonify({"error": f"limit must be 1 to {PAGE_MAX_LIMIT} and cursor a next_cursor"}), 400
+    if page is not None:
+        offset, limit = page
+
+        def compute():
+            wiki_ids = rank(tokens, offset + limit + 1)[0]
+            page_ids = wiki_ids[offset:offset + limit].tolist()
+            return {"results": lookup_titles(page_ids),
+                    "next_cursor": str(offset + limit) if len(wiki_ids) > offset + limit else None}
+
+        payload, _ = RESULT_CACHE.get_or_compute((f"{endpoint}_page", page, tuple(tokens)), lambda: to_json(compute()))
+        return json_response(payload)
+    key = (endpoint, None, tuple(tokens))
+    payload = RESULT_CACHE.get(key)
+    if payload is not None:
+        return json_response(payload)
+    generation = RESULT_CACHE.generation
+    wiki_ids = rank(tokens)[0]
+    if len(wiki_ids) > STREAM_MIN_RESULTS:
+        return app.response_class(titled_json_chunks(wiki_ids), mimetype="application/json")
+    payload = b"".join(titled_json_chunks(wiki_ids))
+    RESULT_CACHE.put(key, payload, generation)
+    return json_response(payload)
 
 
 # --- MyFlaskApp Class --- #
@@ -100,23 +786,98 @@ app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 
 # --- Initializations --- #
 
-# --- initialize the index for body,title,anchor --- #
+# --- the indexes for body, title and anchor, the document store (pagerank, pageviews and document lengths) --- #
+# --- and the title store, set by load_components --- #
+
+BODY_INVERTED_INDEX: InvertedIndex = None
+
+BODY_BM25_INVERTED_INDEX: InvertedIndex = None
+
+TITLE_INVERTED_INDEX: InvertedIndex = None
+
+ANCHOR_INVERTED_INDEX: InvertedIndex = None
+
+DOC_STORE: DocStore = None
 
-BODY_INVERTED_INDEX: InvertedIndex = import_index(BODY_DIR, BODY_IND_FILE)
+PAGE_RANK = None
+
+PAGE_VIEWS = None
+
+TITLES: TitleStore = None
+
+start()
+
+
+@app.before_request
+def start_request():
+    """ Starts timing the request, and its trace when it has a truthy X-Trace header. """
+    g.t_start = time.perf_counter()
+    g.trace = start_trace(request.headers.get("X-Trace", "0").lower() not in ("", "0", "false"))
+
+
+@app.before_request
+def check_invalidations():
+    sync_cache_invalidations()
+
+
+@app.before_request
+def require_ready():
+    """ Answers 503 to every request but the health checks and metrics until the startup components are loaded. """
+    if not STARTUP.ready.is_set() and request.endpoint not in ("healthz", "readyz", "metrics"):
+        return jsonify({"error": "the indexes are still loading"}), 503
+
+
+@app.after_request
+def finish_request(response):
+    """ Records the latency of the request, and returns the trace of a traced request in the X-Trace header. """
+    REQUEST_SECONDS.observe(time.perf_counter() - g.t_start, endpoint=request.endpoint or "unknown",
+                            status=response.status_code)
+    if g.trace is not None:
+        response.headers["X-Trace"] = json.dumps(g.trace.to_dict(), separators=(",", ":"))
+    return response
+
+
+def cache_metrics(field):
+    """
+    Values of a field of the cache statistics, for the /metrics endpoint
+    :param field: str, key of the stats() dicts of the caches
+    :return: list of ({"cache": name}, value)
+    """
+    caches = {"results": RESULT_CACHE, "blocks": BLOCK_CACHE}
+    caches.update((f"postings_{comp}", index.posting_cache) for index, comp in posting_indexes()
+                  if index.posting_cache is not None)
+    return [({"cache": name}, cache.stats()[field]) for name, cache in caches.items()]
 
-TITLE_INVERTED_INDEX: InvertedIndex = import_index(TITLE_DIR, TITLE_IND_FILE)
 
-ANCHOR_INVERTED_INDEX: InvertedIndex = import_index(ANCHOR_DIR, ANCHOR_IND_FILE)
+REGISTRY.collected("cache_hits_total", "Lookups answered by a cache", "counter", lambda: cache_metrics("hits"))
+REGISTRY.collected("cache_misses_total", "Lookups missed by a cache", "counter", lambda: cache_metrics("misses"))
+REGISTRY.collected("cache_evictions_total", "Entries evicted from a cache", "counter",
+                   lambda: cache_metrics("evictions"))
+REGISTRY.collected("cache_bytes", "Bytes held by a cache", "gauge", lambda: cache_metrics("bytes"))
 
-# --- read the json file for pagerank ,pageviews, titles --- #
 
-PAGE_RANK = read_json_file(PAGE_RANK_JSON)
+@app.route("/metrics")
+def metrics():
+    """ Returns the latency histograms, I/O counters and cache counters of the process, in the Prometheus text
+        format.
+    """
+    return app.response_class(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 
-PAGE_VIEWS = read_json_file(PAGE_VIEWS_JSON)
+@app.route("/healthz")
+def healthz():
+    """ Liveness check: fails only when loading the startup components failed, the process should be restarted. """
+    if STARTUP.error is not None:
+        return jsonify({"status": "failed", "error": STARTUP.error}), 500
+    return jsonify({"status": "ok"})
 
 
-TITLES = read_json_file(TITLE_JSON)
+@app.route("/readyz")
+def readyz():
+    """ Readiness check: succeeds once the indexes and stores are loaded. Returns the load time and memory of
+        every component loaded so far.
+    """
+    return jsonify(STARTUP.status()), 200 if STARTUP.ready.is_set() else 503
 
 
 @app.route("/search")
@@ -132,6 +893,7 @@ def search():
          http://YOUR_SERVER_DOMAIN/search?query=hello+world
         where YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        Add &mode=fast to rank the body by its champion lists only, or &mode=bm25 to rank it by BM25.
     Returns:
     --------
         list of up to 100 search results, ordered from best to worst where each
@@ -139,26 +901,27 @@ def search():
     """
     res = []
     query = request.args.get('query', '')
+    mode = request.args.get('mode', 'exhaustive')
+    if mode not in BODY_MODES or body_index(mode) is None:
+        return jsonify({"error": f"unknown or unavailable mode: {mode}"}), 400
     if len(query) == 0:
         return jsonify(res)
     # BEGIN SOLUTION
-
-    # Body
+    t_start = time.perf_counter()
+    timings = {}
     tokens = tokenize(query)
-    body_results = get_top_n_score_for_queries(tokens, BODY_INVERTED_INDEX, BODY_DIR, 100)
 
-    # Titles
-    tokens_stems = tokenize(query)
-    titles_results = sorting_results_using_ranking(TITLE_INVERTED_INDEX, tokens_stems, TITLE_DIR)[:100]
-
-    # Anchors
-    anchors_results = sorting_results_using_ranking(ANCHOR_INVERTED_INDEX, tokens, ANCHOR_DIR)[:100]
-
-    # All candidates:
-    res = merge_results(titles_results, body_results, anchors_results, PAGE_RANK, PAGE_VIEWS, n=100)
-    res = get_title(res)
+    # Body, titles and anchors are retrieved concurrently, then all the candidates are merged
+    # results missing a field that timed out are not cached
+    payload, cached = cached_results("search", mode, tokens, lambda: get_title(search_results(tokens, mode, timings)),
+                                     lambda: all(field in timings for field in ("body", "title", "anchor")))
+    timings["total"] = time.perf_counter() - t_start
+    if not cached:
+        logger.info("search %r: %s", query, server_timing(timings))
     # END SOLUTION
-    return jsonify(res)
+    response = json_response(payload)
+    response.headers["Server-Timing"] = ("cache;desc=hit, " if cached else "") + server_timing(timings)
+    return response
 
 
 # --- Search in body function --- #
@@ -173,6 +936,7 @@ def search_body():
          http://YOUR_SERVER_DOMAIN/search_body?query=hello+world
         where YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        Add &mode=fast to rank by the champion lists only, or &mode=bm25 to rank by BM25.
     Returns:
     --------
         list of up to 100 search results, ordered from best to worst where each
@@ -180,16 +944,17 @@ def search_body():
     """
     res = []
     query = request.args.get('query', '')
+    mode = request.args.get('mode', 'exhaustive')
+    if mode not in BODY_MODES or body_index(mode) is None:
+        return jsonify({"error": f"unknown or unavailable mode: {mode}"}), 400
     if len(query) == 0:
         return jsonify(res)
     # BEGIN SOLUTION
     tokens = tokenize(query)
-    # Get top 100 results sorted by TF-IDF score using cosine similarity.
-    top_n_results = get_top_n_score_for_queries(tokens, BODY_INVERTED_INDEX, BODY_DIR, 100)
-    # Reformatting results to include titles.
-    res = get_title(top_n_results)
+    # Get top 100 results sorted by TF-IDF score using cosine similarity, reformatted to include titles.
+    payload, _ = cached_results("search_body", mode, tokens, lambda: get_title(body_results(tokens, mode)))
     # END SOLUTION
-    return jsonify(res)
+    return json_response(payload)
 
 
 # --- Search in title function --- #
@@ -209,21 +974,22 @@ def search_title():
          http://YOUR_SERVER_DOMAIN/search_title?query=hello+world
         where YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        Add &limit=N to get one page of N results, and &cursor=<next_cursor of the page> for the next ones.
     Returns:
     --------
         list of ALL (not just top 100) search results, ordered from best to
-        worst where each element is a tuple (wiki_id, title).
+        worst where each element is a tuple (wiki_id, title), streamed when
+        there are many. With a limit, {"results": the results of the page,
+        "next_cursor": cursor of the next page, null after the last one}.
     """
     res = []
     query = request.args.get('query', '')
-    if len(query) == 0:
+    if len(query) == 0 and 'limit' not in request.args:
         return jsonify(res)
     # BEGIN SOLUTION
-    tokens = tokenize(query)
-    res = sorting_results_using_ranking(TITLE_INVERTED_INDEX, tokens, TITLE_DIR)
-    res = get_title(res)
+    res = ranked_titles_response("search_title", tokenize(query), title_ranking)
     # END SOLUTION
-    return jsonify(res)
+    return res
 
 
 @app.route("/search_anchor")
@@ -242,21 +1008,152 @@ def search_anchor():
          http://YOUR_SERVER_DOMAIN/search_anchor?query=hello+world
         where YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        Add &limit=N to get one page of N results, and &cursor=<next_cursor of the page> for the next ones.
     Returns:
     --------
         list of ALL (not just top 100) search results, ordered from best to
-        worst where each element is a tuple (wiki_id, title).
+        worst where each element is a tuple (wiki_id, title), streamed when
+        there are many. With a limit, {"results": the results of the page,
+        "next_cursor": cursor of the next page, null after the last one}.
     """
     res = []
     query = request.args.get('query', '')
-    if len(query) == 0:
+    if len(query) == 0 and 'limit' not in request.args:
         return jsonify(res)
     # BEGIN SOLUTION
-    tokens = tokenize(query)
-    res = sorting_results_using_ranking(ANCHOR_INVERTED_INDEX, tokens, ANCHOR_DIR)
-    res = get_title(res)
+    res = ranked_titles_response("search_anchor", tokenize(query), anchor_ranking)
     # END SOLUTION
-    return jsonify(res)
+    return res
+
+
+# --- Batch search functions --- #
+@app.route("/search_batch", methods=['POST'])
+def search_batch():
+    """ Returns the /search results of a batch of queries. The posting list of every distinct term of the batch
+        is read once per field and shared by all the queries.
+
+        Test this by issuing a POST request to a URL like:
+          http://YOUR_SERVER_DOMAIN/search_batch
+        with a json payload of the list of queries. In python do:
+          import requests
+          requests.post('http://YOUR_SERVER_DOMAIN/search_batch', json=["hello world", "best marvel movie"])
+        Add ?mode=fast or ?mode=bm25 to the URL for the body retrieval modes of /search.
+    Returns:
+    --------
+        list with, for every query in input order, the list of up to 100 (wiki_id, title) results.
+    """
+    mode = request.args.get('mode', 'exhaustive')
+    if mode not in BODY_MODES or body_index(mode) is None:
+        return jsonify({"error": f"unknown or unavailable mode: {mode}"}), 400
+    token_lists = read_batch_queries()
+    if token_lists is None:
+        return jsonify({"error": f"expected a json list of at most {BATCH_MAX_QUERIES} queries"}), 400
+    t_start = time.perf_counter()
+    fields = {"title": (TITLE_INVERTED_INDEX, TITLE_DIR), "anchor": (ANCHOR_INVERTED_INDEX, ANCHOR_DIR)}
+    if mode != "fast":
+        # the fast mode reads the champion lists of the term dictionary, not the postings
+        fields["body"] = body_index(mode)
+    payload = cached_batch_results(
+        "search", mode, token_lists, fields,
+        lambda tokens, postings: get_title(search_results(tokens, mode, {}, {"body": None, **postings})))
+    logger.info("search batch of %d queries in %.3fs", len(token_lists), time.perf_counter() - t_start)
+    return json_response(payload)
+
+
+@app.route("/search_body_batch", methods=['POST'])
+def search_body_batch():
+    """ Returns the /search_body results of a batch of queries (a json list of strings, see /search_batch),
+        reading the posting list of every distinct term once.
+    Returns:
+    --------
+        list with, for every query in input order, the list of up to 100 (wiki_id, title) results.
+    """
+    mode = request.args.get('mode', 'exhaustive')
+    if mode not in BODY_MODES or body_index(mode) is None:
+        return jsonify({"error": f"unknown or unavailable mode: {mode}"}), 400
+    token_lists = read_batch_queries()
+    if token_lists is None:
+        return jsonify({"error": f"expected a json list of at most {BATCH_MAX_QUERIES} queries"}), 400
+    fields = {"body": body_index(mode)} if mode != "fast" else {}
+    return json_response(cached_batch_results(
+        "search_body", mode, token_lists, fields,
+        lambda tokens, postings: get_title(body_results(tokens, mode, postings.get("body")))))
+
+
+@app.route("/search_title_batch", methods=['POST'])
+def search_title_batch():
+    """ Returns the /search_title results of a batch of queries (a json list of strings, see /search_batch),
+        reading the posting list of every distinct term once.
+    Returns:
+    --------
+        list with, for every query in input order, the list of ALL (wiki_id, title) results.
+    """
+    token_lists = read_batch_queries()
+    if token_lists is None:
+        return jsonify({"error": f"expected a json list of at most {BATCH_MAX_QUERIES} queries"}), 400
+    return json_response(cached_batch_results(
+        "search_title", None, token_lists, {"title": (TITLE_INVERTED_INDEX, TITLE_DIR)},
+        lambda tokens, postings: get_title(title_results(tokens, postings=postings["title"]))))
+
+
+@app.route("/search_anchor_batch", methods=['POST'])
+def search_anchor_batch():
+    """ Returns the /search_anchor results of a batch of queries (a json list of strings, see /search_batch),
+        reading the posting list of every distinct term once.
+    Returns:
+    --------
+        list with, for every query in input order, the list of ALL (wiki_id, title) results.
+    """
+    token_lists = read_batch_queries()
+    if token_lists is None:
+        return jsonify({"error": f"expected a json list of at most {BATCH_MAX_QUERIES} queries"}), 400
+    return json_response(cached_batch_results(
+        "search_anchor", None, token_lists, {"anchor": (ANCHOR_INVERTED_INDEX, ANCHOR_DIR)},
+        lambda tokens, postings: get_title(anchor_results(tokens, postings=postings["anchor"]))))
+
+
+# --- Body mode report --- #
+@app.route("/body_mode_report", methods=['POST'])
+def body_mode_report_route():
+    """ Compares the body ranking of a mode against a baseline mode on a json list of queries (see
+        backend_calculations.body_mode_report). Both modes rank the body index, the mode and the baseline are
+        given with the `mode` (default fast) and `baseline` (default exhaustive) arguments, and the number of
+        results compared with `n` (default 100).
+    Returns:
+    --------
+        dictionary with the latencies of both modes, the mean top n overlap ("recall") and the share of queries
+        with the same top 10 ("same_top_10").
+    """
+    mode, baseline = request.args.get('mode', 'fast'), request.args.get('baseline', 'exhaustive')
+    n = request.args.get('n', '100')
+    if any(m not in BODY_MODES or m == "bm25" for m in (mode, baseline)):
+        return jsonify({"error": "mode and baseline must be modes ranking the body index: exhaustive or fast"}), 400
+    if not n.isdigit() or int(n) == 0:
+        return jsonify({"error": "n must be a positive integer"}), 400
+    token_lists = read_batch_queries()
+    if token_lists is None:
+        return jsonify({"error": f"expected a json list of at most {BATCH_MAX_QUERIES} queries"}), 400
+    return jsonify(body_mode_report(token_lists, BODY_INVERTED_INDEX, BODY_DIR, mode, int(n), baseline))
+
+
+# --- Cache functions --- #
+@app.route("/cache_stats")
+def cache_stats():
+    """ Returns the statistics of the result cache, the decoded posting caches and the posting block cache. """
+    postings = {comp: index.posting_cache.stats() for index, comp in posting_indexes()
+                if index.posting_cache is not None}
+    return jsonify({"results": RESULT_CACHE.stats(), "postings": postings, "blocks": BLOCK_CACHE.stats()})
+
+
+@app.route("/cache_invalidate", methods=['POST'])
+def cache_invalidate():
+    """ Drops the cached results, decoded posting lists and posting blocks, e.g. after the index files were
+        replaced, in every worker of the server (each one on its next request).
+    """
+    with CACHE_INVALIDATIONS.get_lock():
+        CACHE_INVALIDATIONS.value += 1
+    sync_cache_invalidations()
+    return jsonify(RESULT_CACHE.stats())
 
 
 @app.route("/get_pagerank", methods=['POST'])
@@ -270,23 +1167,18 @@ def get_pagerank():
           requests.post('http://YOUR_SERVER_DOMAIN/get_pagerank', json=[1,5,8])
         As before YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        The ids can also be posted as a binary array, see column_values_response.
     Returns:
     --------
         list of floats:
-          list of PageRank scores that correspond to the provided article IDs.
+          list of PageRank scores that correspond to the provided article IDs,
+          one per ID in the same order, null for IDs without a PageRank.
     """
-    res = []
-    wiki_ids = request.get_json()
-    if len(wiki_ids) == 0:
-        return jsonify(res)
     # BEGIN SOLUTION
-    # Get the page rank from pr dictionary by given wiki_id.
-    for wiki_id in wiki_ids:
-        wiki_id = str(wiki_id)
-        if wiki_id in PAGE_RANK:
-            res.append(PAGE_RANK[wiki_id])
+    # Look up the page rank of all the given wiki_ids at once.
+    res = column_values_response(PAGE_RANK)
     # END SOLUTION
-    return jsonify(res)
+    return res
 
 
 @app.route("/get_pageview", methods=['POST'])
@@ -301,24 +1193,19 @@ def get_pageview():
           requests.post('http://YOUR_SERVER_DOMAIN/get_pageview', json=[1,5,8])
         As before YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        The ids can also be posted as a binary array, see column_values_response.
     Returns:
     --------
         list of ints:
           list of page view numbers from August 2021 that correspond to the
-          provided list article IDs.
+          provided list article IDs, one per ID in the same order, null for IDs
+          without page views.
     """
-    res = []
-    wiki_ids = request.get_json()
-    if len(wiki_ids) == 0:
-        return jsonify(res)
-    # Get the page views from pv dictionary by given wiki_id.
+    # Look up the page views of all the given wiki_ids at once.
     # BEGIN SOLUTION
-    for wiki_id in wiki_ids:
-        wiki_id = str(wiki_id)
-        if wiki_id in PAGE_VIEWS:
-            res.append(PAGE_VIEWS[wiki_id])
+    res = column_values_response(PAGE_VIEWS)
     # END SOLUTION
-    return jsonify(res)
+    return res
 
 
 
@@ -0,0 +1,84 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import inverted_index_gcp  # noqa: E402
+from inverted_index_gcp import BLOCK_CACHE, POSTING_FORMAT_RAW, InMemoryBackend, InvertedIndex  # noqa: E402
+
+COMP = "body"
+NAME = "body_index"
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(tmp_path, monkeypatch):
+    """ Downloads of the in-memory files go to the test directory, and no test sees the blocks cached by
+        another one (the cache keys hold the id of the backend, which can be reused).
+    """
+    monkeypatch.setattr(inverted_index_gcp, "INDEX_CACHE_DIR", str(tmp_path / "index_cache"))
+    BLOCK_CACHE.clear()
+    yield
+    BLOCK_CACHE.clear()
+
+
+def random_postings(seed, n_docs=5000, dfs=(3, 40, 300, 1500, 4000, 4900)):
+    """
+    Returns random posting lists and document lengths: one term per df in `dfs` (and a second one with the
+    same df), with tfs up to 40 and document lengths from 5 to 3000.
+    :return: (dict of term -> list of (doc_id, tf) sorted by doc_id, dict of doc_id -> length)
+    """
+    rng = np.random.default_rng(seed)
+    doc_ids = np.arange(1, n_docs + 1)
+    postings = {}
+    for i, df in enumerate(dfs * 2):
+        docs = np.sort(rng.choice(doc_ids, df, replace=False))
+        postings[f"t{i}"] = list(zip(docs.tolist(), rng.integers(1, 41, df).tolist()))
+    doc_lengths = dict(zip(doc_ids.tolist(), rng.integers(5, 3001, n_docs).tolist()))
+    return postings, doc_lengths
+
+
+def write_index(directory, name, postings, doc_lengths, posting_format=POSTING_FORMAT_RAW):
+    """
+    Writes the posting files and the pickled globals of an index of the given postings to `directory`.
+    :param postings: dict of term -> list of (doc_id, tf) sorted by doc_id
+    :param doc_lengths: dict of doc_id -> length
+    :return: InvertedIndex, the written index (without a backend)
+    """
+    index = InvertedIndex(posting_format)
+    index.DL = dict(doc_lengths)
+    for term, pl in postings.items():
+        index._posting_list[term] = list(pl)
+        index.df[term] = len(pl)
+        index.term_total[term] = sum(tf for _, tf in pl)
+    index.write(directory, name)
+    # the writer records the paths it wrote to, the readers expect names relative to the component
+    for term, locs in index.posting_locs.items():
+        index.posting_locs[term] = [(Path(f_name).name, offset) for f_name, offset in locs]
+    index._write_globals(directory, name)
+    return index
+
+
+@pytest.fixture
+def make_index(tmp_path):
+    """
+    Writes an index of the given postings in `posting_format`, compacts it with score bounds, and returns
+    the compact index read back through an InMemoryBackend holding all its files.
+    """
+
+    def make(postings, doc_lengths, posting_format, **compact_args):
+        directory = tmp_path / f"index_{posting_format}"
+        directory.mkdir()
+        index = write_index(directory, NAME, postings, doc_lengths, posting_format)
+        index.backend = _backend_of(directory)
+        index.write_compact(directory, NAME, COMP, **compact_args)
+        return InvertedIndex.read_compact_index(None, COMP, NAME, _backend_of(directory))
+
+    return make
+
+
+def _backend_of(directory):
+    return InMemoryBackend({f"{COMP}/{p.relative_to(directory).as_posix()}": p.read_bytes()
+                            for p in directory.rglob("*") if p.is_file()})
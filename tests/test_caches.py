@@ -0,0 +1,116 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from inverted_index_gcp import BlockCache, FrequencySketch, PostingCache
+
+
+def _postings(n):
+    return np.arange(n, dtype=np.int64), np.ones(n, dtype=np.int64)
+
+
+# --- Block cache --- #
+def test_concurrent_misses_share_one_load():
+    cache = BlockCache(1000)
+    started, release = threading.Event(), threading.Event()
+    loads = []
+
+    def loader():
+        loads.append(1)
+        started.set()
+        release.wait(5)
+        return b"x" * 10
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("k", loader))) for _ in range(8)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # let every thread reach the cache before the load finishes
+    deadline = time.monotonic() + 5
+    while cache.misses < len(threads) and time.monotonic() < deadline:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert loads == [1] and results == [b"x" * 10] * 8
+    # every lookup of a block that was not cached yet is a miss, including the ones that waited
+    assert cache.stats()["misses"] == 8 and cache.stats()["hits"] == 0
+    assert cache.get_or_load("k", loader) == b"x" * 10 and loads == [1] and cache.stats()["hits"] == 1
+
+
+def test_blocks_are_evicted_least_recently_used_first():
+    cache = BlockCache(25)
+    for key in "abc":
+        cache.put(key, key.encode() * 10)
+    assert cache.get("a") is None and cache.current_bytes == 20 and cache.evictions == 1
+    assert cache.get("b") is not None
+    cache.put("d", b"d" * 10)
+    assert cache.get("c") is None and cache.get("b") is not None and cache.get("d") is not None
+    assert cache.stats()["evictions"] == 2
+
+
+def test_blocks_larger_than_the_cache_are_served_but_not_stored():
+    cache = BlockCache(5)
+    assert cache.get_or_load("big", lambda: b"y" * 10) == b"y" * 10
+    assert cache.current_bytes == 0 and cache.get("big") is None
+
+
+def test_failed_load_lets_the_next_lookup_retry():
+    cache = BlockCache(100)
+
+    def failing():
+        raise OSError("unavailable")
+
+    with pytest.raises(OSError):
+        cache.get_or_load("k", failing)
+    assert cache.get_or_load("k", lambda: b"z") == b"z" and cache.get("k") == b"z"
+
+
+# --- Frequency sketch and TinyLFU admission --- #
+def test_sketch_counts_saturate_and_age():
+    sketch = FrequencySketch(64, sample_size=1000)
+    for _ in range(5):
+        sketch.add("hot")
+    sketch.add("rare")
+    assert sketch.estimate("hot") >= 5 and sketch.estimate("hot") > sketch.estimate("rare") >= 1
+    sketch.add("hot", 300)
+    assert sketch.estimate("hot") == FrequencySketch.MAX_COUNT
+    for i in range(1000):
+        sketch.add(("filler", i))
+    assert sketch.estimate("hot") < FrequencySketch.MAX_COUNT
+
+
+def test_large_increment_saturates_without_halving_every_addition():
+    sketch = FrequencySketch(64, sample_size=1000)
+    sketch.add("hot", 10 ** 9)
+    assert sketch.estimate("hot") == FrequencySketch.MAX_COUNT
+    for _ in range(3):
+        sketch.add("other")
+    assert sketch.estimate("hot") == FrequencySketch.MAX_COUNT and sketch.estimate("other") >= 3
+
+
+def test_frequent_lists_are_not_evicted_by_rare_ones():
+    size = sum(a.nbytes for a in _postings(100))
+    cache = PostingCache(2 * size, sketch_width=256)
+    for key in ["a", "b"]:
+        for _ in range(5):
+            cache.get(key)
+        assert cache.put(key, _postings(100))
+    cache.get("rare")
+    assert not cache.put("rare", _postings(100))
+    assert cache.rejections == 1 and cache.get("a") is not None and cache.get("b") is not None
+    cache.record("popular", 20)
+    assert cache.put("popular", _postings(100))
+    assert cache.evictions == 1 and cache.current_bytes <= cache.max_bytes
+    assert not cache.put("huge", _postings(1000))
+
+
+def test_cached_arrays_are_read_only():
+    cache = PostingCache(10 ** 6)
+    cache.put("a", _postings(10))
+    doc_ids, tfs = cache.get("a")
+    assert not doc_ids.flags.writeable and not tfs.flags.writeable
@@ -0,0 +1,37 @@
+import numpy as np
+
+from doc_store import MISSING_INT, DocStore, build_doc_store
+from inverted_index_gcp import InMemoryBackend, InvertedIndex
+
+
+def _store():
+    index = InvertedIndex()
+    index.DL = {3: 10, 7: 20}
+    return build_doc_store({"3": 0.5, "12": 0.25}, {"7": 40, "12": 9}, {"body": index}, doc_ids=[20])
+
+
+def test_columns_are_aligned_on_the_union_of_the_ids():
+    store = _store()
+    assert store.doc_ids.tolist() == [3, 7, 12, 20]
+    assert store.columns['pagerank'].dtype == np.float64 and store.columns['pageviews'].dtype == np.int64
+    assert store.columns['dl_body'].tolist() == [10, 20, MISSING_INT, MISSING_INT]
+
+
+def test_lookup_keeps_the_input_order_and_flags_missing_values():
+    pageviews = _store().column('pageviews')
+    values, found = pageviews.lookup([12, 3, 99, 7])
+    assert found.tolist() == [True, False, False, True]
+    assert values[found].tolist() == [9, 40]
+    assert dict(pageviews) == {7: 40, 12: 9} and 3 not in pageviews
+    pagerank = _store().column('pagerank')
+    np.testing.assert_array_equal(pagerank.gather([12, 7], missing=0.0), [0.25, 0.0])
+
+
+def test_saved_store_loads_lazily(tmp_path):
+    _store().save(tmp_path)
+    backend = InMemoryBackend({f"docs/{p.name}": p.read_bytes() for p in tmp_path.iterdir()})
+    store = DocStore.load(backend, "docs")
+    assert store.columns.loaded() == {}
+    values, found = store.column('pagerank').lookup([3, 7])
+    assert values[0] == 0.5 and found.tolist() == [True, False]
+    assert list(store.columns.loaded()) == ['pagerank']
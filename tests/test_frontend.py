@@ -0,0 +1,253 @@
+import importlib
+import json
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip("flask")
+from nltk.corpus import stopwords  # noqa: E402
+
+import inverted_index_gcp  # noqa: E402
+from conftest import write_index  # noqa: E402
+from inverted_index_gcp import MmapBackend  # noqa: E402
+
+N_DOCS = 300
+CHAMPION_SIZE = 20
+TERMS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot"]
+
+
+def _postings(rng, max_df):
+    postings = {}
+    for term in TERMS:
+        docs = np.sort(rng.choice(np.arange(1, N_DOCS + 1), rng.integers(1, max_df + 1), replace=False))
+        postings[term] = list(zip(docs.tolist(), rng.integers(1, 30, len(docs)).tolist()))
+    return postings
+
+
+@pytest.fixture(scope="module")
+def frontend(tmp_path_factory):
+    """ The search frontend serving a small random corpus from a local bucket directory (see POSTINGS_ROOT). """
+    try:
+        stopwords.words('english')
+    except LookupError:
+        pytest.skip("the NLTK stopwords corpus is not installed")
+    rng = np.random.default_rng(0)
+    bucket = tmp_path_factory.mktemp("bucket")
+    doc_lengths = dict(zip(range(1, N_DOCS + 1), rng.integers(5, 500, N_DOCS).tolist()))
+    for comp, name, max_df in [("body", "body_index", 250), ("titles", "title_index", 40),
+                               ("anchor", "anchor_index", 100)]:
+        (bucket / comp).mkdir()
+        index = write_index(bucket / comp, name, _postings(rng, max_df), doc_lengths)
+        if comp == "body":
+            # the champion lists of the fast mode
+            index.backend = MmapBackend(str(bucket))
+            index.write_compact(bucket / comp, name, comp, champion_size=CHAMPION_SIZE)
+    for comp, values in [("pr", {str(d): float(rng.random()) for d in range(1, N_DOCS + 1)}),
+                         ("pv", {str(d): int(rng.integers(0, 1000)) for d in range(1, N_DOCS + 1)}),
+                         ("titles", {str(d): f"Article {d}" for d in range(1, N_DOCS + 1)})]:
+        (bucket / comp).mkdir(exist_ok=True)
+        (bucket / comp / f"{comp}.json").write_text(json.dumps(values))
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(inverted_index_gcp, "POSTINGS_ROOT", str(bucket))
+        fe = importlib.import_module("search_frontend")
+        assert fe.STARTUP.ready.wait(30), fe.STARTUP.error
+    yield fe
+
+
+@pytest.fixture
+def client(frontend):
+    return frontend.app.test_client()
+
+
+# --- Bulk lookups --- #
+@pytest.mark.parametrize("endpoint, column", [("/get_pagerank", "PAGE_RANK"), ("/get_pageview", "PAGE_VIEWS")])
+def test_lookups_answer_in_input_order(frontend, client, endpoint, column):
+    values = getattr(frontend, column)
+    response = client.post(endpoint, json=[3, N_DOCS + 7, 1, 3])
+    assert response.status_code == 200
+    assert response.get_json() == [values[3], None, values[1], values[3]]
+
+
+def test_binary_lookups(frontend, client):
+    ids = np.array([2, N_DOCS + 1], dtype='<i8')
+    response = client.post("/get_pageview?format=binary", data=ids.tobytes(),
+                           content_type="application/octet-stream")
+    assert response.headers["X-Value-Type"] == "<i8"
+    assert np.frombuffer(response.data, dtype='<i8').tolist() == [frontend.PAGE_VIEWS[2], -1]
+
+
+@pytest.mark.parametrize("body", [[1.7, True], [True], [1.0], ["3"], [[1]], [2 ** 70], {"ids": [1]}])
+def test_lookups_reject_anything_but_integer_ids(client, body):
+    assert client.post("/get_pagerank", json=body).status_code == 400
+
+
+# --- Field retrieval --- #
+def test_late_field_is_left_out_and_frees_its_thread(frontend):
+    stopped = threading.Event()
+
+    def slow_field():
+        try:
+            while True:
+                frontend.BODY_INVERTED_INDEX.read_posting_arrays("alpha", frontend.BODY_DIR)
+                time.sleep(0.01)
+        finally:
+            stopped.set()
+
+    timings = {}
+    results = frontend.retrieve_fields({"body": (slow_field, ()), "title": (lambda: [(1, 1.0)], ())}, timings,
+                                       timeout=0.2)
+    assert results == {"body": [], "title": [(1, 1.0)]} and list(timings) == ["title"]
+    assert stopped.wait(1)
+
+
+def test_search_merges_the_fields_retrieved_concurrently(frontend, client):
+    client.post("/cache_invalidate")
+    response = client.get("/search?query=alpha+echo")
+    results = response.get_json()
+    assert 0 < len(results) <= 100 and all(title == f"Article {doc_id}" for doc_id, title in results)
+    timings = dict(part.split(";dur=") for part in response.headers["Server-Timing"].split(", "))
+    assert {"body", "title", "anchor", "fusion", "total"} <= set(timings)
+    assert client.get("/search?query=").get_json() == []
+
+
+# --- Result cache --- #
+def test_results_expire_after_the_ttl(frontend):
+    cache = frontend.ResultCache(10, 1000, ttl=0.05)
+    cache.put("k", b"[1]", cache.generation)
+    assert cache.get("k") == b"[1]"
+    time.sleep(0.06)
+    assert cache.get("k") is None
+    assert cache.stats()["expirations"] == 1 and cache.stats()["entries"] == 0 and cache.current_bytes == 0
+
+
+def test_results_are_bounded_by_their_bytes(frontend):
+    cache = frontend.ResultCache(10, 25, ttl=60)
+    for key in "abc":
+        cache.put(key, key.encode() * 10, cache.generation)
+    assert cache.get("a") is None and cache.get("b") is not None and cache.current_bytes == 20
+    cache.put("big", b"x" * 26, cache.generation)
+    assert cache.get("big") is None and cache.evictions == 1
+
+
+def test_results_computed_before_an_invalidation_are_not_cached(frontend):
+    cache = frontend.ResultCache(10, 1000, ttl=60)
+    generation = cache.generation
+    cache.put("old", b"[1]", generation)
+    cache.invalidate()
+    assert cache.get("old") is None
+    cache.put("late", b"[2]", generation)
+    assert cache.get("late") is None
+    payload, cached = cache.get_or_compute("new", lambda: b"[3]")
+    assert (payload, cached) == (b"[3]", False) and cache.get_or_compute("new", lambda: b"[4]") == (b"[3]", True)
+
+
+def test_search_results_are_served_from_the_cache_until_invalidated(client):
+    client.post("/cache_invalidate")
+    first = client.get("/search_body?query=alpha+bravo")
+    assert first.status_code == 200 and len(first.get_json()) > 0
+    assert client.get("/search_body?query=alpha+bravo").get_json() == first.get_json()
+    assert client.get("/cache_stats").get_json()["results"]["hits"] >= 1
+    generation = client.get("/cache_stats").get_json()["results"]["generation"]
+    stats = client.post("/cache_invalidate").get_json()
+    assert stats["generation"] == generation + 1 and stats["entries"] == 0
+    response = client.get("/search?query=alpha+bravo")
+    assert "cache;desc=hit" not in response.headers["Server-Timing"]
+    assert "cache;desc=hit" in client.get("/search?query=alpha+bravo").headers["Server-Timing"]
+
+
+# --- Body retrieval modes --- #
+def test_fast_mode_ranks_by_the_champion_lists(frontend, client):
+    assert frontend.BODY_INVERTED_INDEX.has_champions()
+    exhaustive = client.get("/search_body?query=charlie").get_json()
+    fast = client.get("/search_body?query=charlie&mode=fast").get_json()
+    # a one term query ranks by the champion order, whose top documents are the same
+    assert fast[:10] == exhaustive[:10] and len(fast) <= CHAMPION_SIZE
+    assert len(client.get("/search?query=charlie+delta&mode=fast").get_json()) > 0
+    assert client.get("/search_body?query=charlie&mode=bm25").status_code == 400
+    assert client.get("/search_body?query=charlie&mode=other").status_code == 400
+
+
+def test_body_mode_report(client):
+    report = client.post("/body_mode_report?n=10", json=["alpha bravo", "charlie", "echo foxtrot delta"]).get_json()
+    assert 0 <= report["recall"] <= 1 and 0 <= report["same_top_10"] <= 1
+    assert client.post("/body_mode_report?mode=bm25", json=["alpha"]).status_code == 400
+    assert client.post("/body_mode_report?n=0", json=["alpha"]).status_code == 400
+    assert client.post("/body_mode_report", json={"query": "alpha"}).status_code == 400
+
+
+# --- Batch search --- #
+@pytest.mark.parametrize("endpoint", ["/search", "/search_body", "/search_title", "/search_anchor"])
+def test_batch_results_match_the_single_queries(client, endpoint):
+    queries = ["alpha", "bravo delta", "", "alpha"]
+    client.post("/cache_invalidate")
+    batch = client.post(f"{endpoint}_batch", json=queries)
+    assert batch.status_code == 200
+    client.post("/cache_invalidate")
+    assert batch.get_json() == [client.get(endpoint, query_string={"query": q}).get_json() for q in queries]
+
+
+def test_batch_rejects_anything_but_a_list_of_queries(frontend, client):
+    for body in [{"queries": ["alpha"]}, ["alpha", 3], ["alpha"] * (frontend.BATCH_MAX_QUERIES + 1)]:
+        assert client.post("/search_batch", json=body).status_code == 400
+    assert client.post("/search_body_batch?mode=other", json=["alpha"]).status_code == 400
+
+
+# --- Health checks --- #
+def test_health_checks_once_loaded(client):
+    assert client.get("/healthz").get_json() == {"status": "ok"}
+    response = client.get("/readyz")
+    status = response.get_json()
+    assert response.status_code == 200 and status["ready"] and status["error"] is None
+    assert {"body_index", "title_index", "anchor_index"} <= set(status["components"])
+    assert all(component["bytes"] is None or component["bytes"] > 0 for component in status["components"].values())
+
+
+def test_requests_wait_for_the_startup_components(frontend, client, monkeypatch):
+    monkeypatch.setattr(frontend, "STARTUP", frontend.Startup())
+    assert client.get("/search_body?query=alpha").status_code == 503
+    assert client.get("/readyz").status_code == 503 and client.get("/healthz").status_code == 200
+    frontend.STARTUP.error = "no index"
+    assert client.get("/healthz").status_code == 500
+
+
+# --- Pagination and streaming --- #
+@pytest.mark.parametrize("endpoint", ["/search_title", "/search_anchor"])
+def test_pages_follow_the_full_ranking(client, endpoint):
+    full = client.get(endpoint, query_string={"query": "alpha bravo charlie"}).get_json()
+    pages, cursor = [], None
+    while True:
+        args = {"query": "alpha bravo charlie", "limit": 7, **({"cursor": cursor} if cursor else {})}
+        page = client.get(endpoint, query_string=args).get_json()
+        pages += page["results"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert pages == full and len(full) > 7
+
+
+def test_invalid_pages_are_rejected(frontend, client):
+    for args in [{"limit": 0}, {"limit": "x"}, {"limit": 5, "cursor": "-1"}, {"limit": frontend.PAGE_MAX_LIMIT + 1}]:
+        assert client.get("/search_title", query_string={"query": "alpha", **args}).status_code == 400
+
+
+def test_long_rankings_are_streamed(frontend, client, monkeypatch):
+    expected = client.get("/search_anchor?query=alpha+bravo").get_json()
+    client.post("/cache_invalidate")
+    monkeypatch.setattr(frontend, "STREAM_MIN_RESULTS", 5)
+    response = client.get("/search_anchor?query=alpha+bravo")
+    assert response.is_streamed and response.get_json() == expected
+    assert client.get("/cache_stats").get_json()["results"]["entries"] == 0
+
+
+# --- Metrics --- #
+def test_metrics_and_traces(client):
+    client.post("/cache_invalidate")
+    response = client.get("/search_body?query=delta", headers={"X-Trace": "1"})
+    trace = json.loads(response.headers["X-Trace"])
+    assert "score_body" in trace["stages"] and trace["counts"]["postings_decoded_total"] > 0
+    assert "X-Trace" not in client.get("/search_body?query=delta").headers
+    lines = client.get("/metrics").get_data(as_text=True).splitlines()
+    assert any(line.startswith('http_request_seconds_count{endpoint="search_body",status="200"}') for line in lines)
+    assert any(line.startswith('cache_hits_total{cache="results"}') for line in lines)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from backend_calculations import RRF_K, fuse_results, merge_results
+from doc_store import build_doc_store
+
+FIELDS = {"title": [(1, 2.0), (2, 1.0)], "body": (np.array([2, 3]), np.array([0.5, 0.25]))}
+WEIGHTS = {"title": 0.6, "body": 0.3, "page_rank": 0.1}
+
+
+def _page_rank():
+    return build_doc_store({"1": 0.2, "3": 0.8}, {}, {}).column('pagerank')
+
+
+def test_weighted_sum_adds_the_max_normalized_signals():
+    res = dict(fuse_results(FIELDS, {"page_rank": _page_rank()}, WEIGHTS))
+    expected = {1: 0.6 * 1 + 0.1 * 0.25,
+                2: 0.6 * 0.5 + 0.3 * 1,
+                3: 0.3 * 0.5 + 0.1 * 1}
+    assert res == pytest.approx(expected)
+
+
+def test_rrf_adds_the_weighted_reciprocal_ranks():
+    res = fuse_results(FIELDS, {"page_rank": _page_rank()}, WEIGHTS, strategy="rrf")
+    expected = {1: 0.6 / (RRF_K + 1) + 0.1 / (RRF_K + 2),
+                2: 0.6 / (RRF_K + 2) + 0.3 / (RRF_K + 1),
+                3: 0.3 / (RRF_K + 2) + 0.1 / (RRF_K + 1)}
+    assert dict(res) == pytest.approx(expected)
+    assert [doc_id for doc_id, _ in res] == sorted(expected, key=expected.get, reverse=True)
+
+
+@pytest.mark.parametrize("strategy", ["weighted_sum", "rrf"])
+def test_fusion_returns_the_best_n(strategy):
+    rng = np.random.default_rng(0)
+    fields = {"title": (np.arange(1, 501), rng.random(500)), "body": (np.arange(250, 751), rng.random(501))}
+    full = fuse_results(fields, {}, {"title": 0.5, "body": 0.5}, n=1000, strategy=strategy)
+    assert len(full) == 750 and all(a[1] >= b[1] for a, b in zip(full, full[1:]))
+    assert fuse_results(fields, {}, {"title": 0.5, "body": 0.5}, n=10, strategy=strategy) == full[:10]
+
+
+def test_no_candidates():
+    timings = {}
+    pr = _page_rank()
+    assert merge_results([], [], [], pr, pr, n=10, timings=timings) == [] and "fusion" in timings
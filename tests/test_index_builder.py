@@ -0,0 +1,78 @@
+import math
+import subprocess
+import sys
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from backend_calculations import get_body_bm25_scores
+from conftest import COMP, NAME, random_postings, write_index
+from index_builder import build_impact_index
+from inverted_index_gcp import POSTING_FORMAT_IMPACT, InvertedIndex, MmapBackend
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _run(*args):
+    return subprocess.run([sys.executable, str(ROOT / "index_builder.py"), *args], capture_output=True, text=True,
+                          cwd=ROOT)
+
+
+@pytest.mark.parametrize("size", ["0", "-5"])
+def test_compact_rejects_champion_lists_below_one_document(tmp_path, size):
+    result = _run("compact", "body", "body_index", str(tmp_path), "--champions", size)
+    assert result.returncode == 2 and "--champions R needs R >= 1" in result.stderr
+
+
+# --- Quantized BM25 impacts --- #
+def _bm25_reference(postings, doc_lengths, query, k1=1.2, b=0.75):
+    n_docs, avg_dl = len(doc_lengths), sum(doc_lengths.values()) / len(doc_lengths)
+    scores = {}
+    for term, count in Counter(query).items():
+        pl = postings.get(term, [])
+        idf = math.log(1 + (n_docs - len(pl) + 0.5) / (len(pl) + 0.5))
+        for doc_id, tf in pl:
+            norm = k1 * (1 - b + b * doc_lengths[doc_id] / avg_dl)
+            scores[doc_id] = scores.get(doc_id, 0) + count * idf * tf * (k1 + 1) / (tf + norm)
+    return scores
+
+
+@pytest.fixture
+def impact_index(tmp_path):
+    postings, doc_lengths = random_postings(20, n_docs=2000, dfs=(3, 40, 300, 1000, 1900))
+    (tmp_path / COMP).mkdir()
+    index = write_index(tmp_path / COMP, NAME, postings, doc_lengths)
+    index.backend = MmapBackend(str(tmp_path))
+    build_impact_index(index, COMP, tmp_path / "body_bm25", "body_bm25_index")
+    return postings, doc_lengths, InvertedIndex.read_index(None, "body_bm25", "body_bm25_index", index.backend)
+
+
+def test_bm25_scores_of_the_impacts_are_within_the_quantization_error(impact_index):
+    postings, doc_lengths, index = impact_index
+    assert index.posting_format == POSTING_FORMAT_IMPACT and index.impact_params == {'k1': 1.2, 'b': 0.75}
+    for query in [["t0"], ["t1", "t3"], ["t2", "t2", "t4", "missing"], list(postings)]:
+        expected = _bm25_reference(postings, doc_lengths, query)
+        doc_ids, scores = get_body_bm25_scores(query, index, "body_bm25")
+        assert doc_ids.tolist() == sorted(expected)
+        # every impact is rounded to the nearest unit, or raised to 1
+        max_error = sum(count for t, count in Counter(query).items() if t in postings) * index.impact_scale
+        np.testing.assert_allclose(scores, [expected[d] for d in doc_ids.tolist()], atol=max_error)
+
+
+def test_impact_index_only_gets_a_term_dictionary(impact_index, tmp_path):
+    _, _, index = impact_index
+    with pytest.raises(ValueError):
+        index.write_compact(tmp_path / "body_bm25", "body_bm25_index", "body_bm25", champion_size=10)
+    index.write_compact(tmp_path / "body_bm25", "body_bm25_index")
+    compact = InvertedIndex.read_compact_index(None, "body_bm25", "body_bm25_index", index.backend)
+    assert compact.impact_scale == index.impact_scale
+    np.testing.assert_array_equal(get_body_bm25_scores(["t1", "t2"], compact, "body_bm25")[1],
+                                  get_body_bm25_scores(["t1", "t2"], index, "body_bm25")[1])
+
+
+def test_bm25_scoring_needs_an_impact_index(impact_index):
+    index = InvertedIndex.read_index(None, COMP, NAME, impact_index[2].backend)
+    with pytest.raises(ValueError):
+        get_body_bm25_scores(["t0"], index, COMP)
@@ -0,0 +1,45 @@
+from contextlib import closing
+
+import metrics
+from inverted_index_gcp import InMemoryBackend, MultiFileReader
+
+
+def _read(backend, n_bytes, start=0):
+    trace = metrics.start_trace(True)
+    with closing(MultiFileReader(backend)) as reader:
+        b = reader.read([("0_000.bin", 10)], n_bytes, "body", start=start)
+    metrics.start_trace(False)
+    return bytes(b), trace.counts
+
+
+def test_bytes_are_counted_as_read_from_storage_or_served_by_the_cache():
+    backend = InMemoryBackend({"body/0_000.bin": bytes(range(100))})
+    b, counts = _read(backend, 30)
+    assert b == bytes(range(10, 40))
+    assert counts == {"posting_blocks_read_total": 1, "posting_bytes_read_total": 30,
+                      "posting_bytes_cached_total": 0}
+    _, counts = _read(backend, 30)
+    assert counts["posting_bytes_read_total"] == 0 and counts["posting_bytes_cached_total"] == 30
+    assert backend.bytes_read == 30
+
+
+def test_trace_keeps_stage_latencies():
+    trace = metrics.start_trace(True)
+    with metrics.stage("score_body"):
+        pass
+    with metrics.stage("score_body"):
+        pass
+    metrics.start_trace(False)
+    assert trace.to_dict()["stages"]["score_body"]["calls"] == 2
+
+
+def test_registry_renders_the_prometheus_text_format():
+    registry = metrics.Registry()
+    counter = registry.counter("requests_total", "Requests", ["endpoint"])
+    counter.inc(endpoint="/search")
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    histogram.observe(0.5)
+    lines = registry.render().splitlines()
+    assert 'requests_total{endpoint="/search"} 1' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 0' in lines and 'latency_seconds_bucket{le="+Inf"} 1' in lines
+    assert "latency_seconds_sum 0.5" in lines and "latency_seconds_count 1" in lines
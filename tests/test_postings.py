@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from inverted_index_gcp import (POSTING_FORMAT_IMPACT, POSTING_FORMAT_RAW, POSTING_FORMAT_VARINT,
+                                decode_posting_block, decode_postings, encode_postings, posting_offsets)
+
+
+def _random_list(seed, n, max_tf):
+    rng = np.random.default_rng(seed)
+    doc_ids = np.sort(rng.choice(np.arange(1, 10 * n + 2 ** 20), n, replace=False))
+    return doc_ids, rng.integers(1, max_tf + 1, n)
+
+
+# the raw format truncates tfs to 16 bits
+@pytest.mark.parametrize("posting_format, max_tf", [(POSTING_FORMAT_RAW, 65535), (POSTING_FORMAT_VARINT, 10 ** 6)])
+@pytest.mark.parametrize("n", [0, 1, 127, 1000])
+def test_encode_decode_round_trip(posting_format, max_tf, n):
+    doc_ids, tfs = _random_list(n, n, max_tf)
+    decoded_doc_ids, decoded_tfs = decode_postings(encode_postings(doc_ids, tfs, posting_format), n, posting_format)
+    assert decoded_doc_ids.dtype == np.int64 and decoded_tfs.dtype == np.int64
+    np.testing.assert_array_equal(decoded_doc_ids, doc_ids)
+    np.testing.assert_array_equal(decoded_tfs, tfs)
+
+
+# the impact format stores 8 bit impacts in place of the tfs
+@pytest.mark.parametrize("n", [0, 1, 1000])
+def test_impact_round_trip(n):
+    doc_ids, impacts = _random_list(n, n, 255)
+    b = encode_postings(doc_ids, impacts, POSTING_FORMAT_IMPACT)
+    assert b[0] == POSTING_FORMAT_IMPACT and b[1:n + 1] == impacts.astype(np.uint8).tobytes()
+    decoded_doc_ids, decoded_impacts = decode_postings(b, n, POSTING_FORMAT_IMPACT)
+    np.testing.assert_array_equal(decoded_doc_ids, doc_ids)
+    np.testing.assert_array_equal(decoded_impacts, impacts)
+
+
+def test_impact_lists_have_no_block_offsets():
+    with pytest.raises(ValueError):
+        posting_offsets([1, 2], [3, 4], POSTING_FORMAT_IMPACT)
+
+
+def test_raw_format_truncates_tfs_to_16_bits():
+    _, tfs = decode_postings(encode_postings([1, 2], [65536 + 5, 7], POSTING_FORMAT_RAW), 2, POSTING_FORMAT_RAW)
+    assert tfs.tolist() == [5, 7]
+
+
+def test_unknown_format_version():
+    with pytest.raises(ValueError):
+        decode_postings(bytes([9, 1, 1]), 1, POSTING_FORMAT_VARINT)
+
+
+@pytest.mark.parametrize("posting_format", [POSTING_FORMAT_RAW, POSTING_FORMAT_VARINT])
+def test_decode_block_from_posting_offsets(posting_format):
+    doc_ids, tfs = _random_list(2, 1000, 5000)
+    b = encode_postings(doc_ids, tfs, posting_format)
+    offsets = posting_offsets(doc_ids, tfs, posting_format)
+    # the varint lists start with the format version
+    assert offsets[0] == (0 if posting_format == POSTING_FORMAT_RAW else 1)
+    assert offsets[-1] == len(b)
+    for start, end in [(0, 128), (128, 256), (300, 301), (872, 1000)]:
+        base_doc_id = int(doc_ids[start - 1]) if start > 0 else 0
+        block_doc_ids, block_tfs = decode_posting_block(b[offsets[start]:offsets[end]], end - start, posting_format,
+                                                        base_doc_id)
+        np.testing.assert_array_equal(block_doc_ids, doc_ids[start:end])
+        np.testing.assert_array_equal(block_tfs, tfs[start:end])
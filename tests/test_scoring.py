@@ -0,0 +1,177 @@
+import contextvars
+import math
+import time
+
+import numpy as np
+import pytest
+
+from backend_calculations import (body_mode_report, generate_query_tfidf_vector, get_body_champion_scores,
+                                  get_body_tfidf_scores, get_body_top_k_scores, get_top_n_arrays,
+                                  sorting_results_using_ranking)
+from conftest import COMP, random_postings
+from inverted_index_gcp import (BLOCK_CACHE, POSTING_FORMAT_RAW, POSTING_FORMAT_VARINT, SCORE_BLOCK_SIZE,
+                                DeadlineExceeded, set_deadline)
+
+FORMATS = [POSTING_FORMAT_RAW, POSTING_FORMAT_VARINT]
+
+
+def _queries(seed, terms, n=60, max_len=6):
+    rng = np.random.default_rng(seed)
+    vocabulary = list(terms) + ["missing"]
+    return [[vocabulary[i] for i in rng.integers(0, len(vocabulary), rng.integers(1, max_len + 1))]
+            for _ in range(n)]
+
+
+# --- Dict based scorers the vectorized ones replaced --- #
+def dict_binary_ranking(index, tokens, comp):
+    scores = {}
+    for token in tokens:
+        for doc_id, tf in index.read_posting_list(token, comp):
+            scores[doc_id] = scores.get(doc_id, 0) + 1 / len(tokens)
+    return sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
+
+
+def dict_body_scores(query_to_search, index, comp):
+    candidates = {}
+    for item in query_to_search:
+        if item in index.term_total.keys():
+            for doc_id, freq in index.read_posting_list(item, comp):
+                tfidf = (freq / index.DL[doc_id]) * math.log(len(index.DL) / index.df[item], 10)
+                if tfidf > 0.1:
+                    candidates[(doc_id, item)] = candidates.get((doc_id, item), 0) + tfidf
+    # the dot product with the query vector, whose weight of a term sits at its first position in the query
+    query_vec = generate_query_tfidf_vector(query_to_search, index)
+    scores = {}
+    for (doc_id, term), tfidf in candidates.items():
+        scores[doc_id] = scores.get(doc_id, 0) + tfidf * query_vec[query_to_search.index(term)]
+    norm = np.linalg.norm(query_vec)
+    return {doc_id: score / (norm * norm) for doc_id, score in scores.items()}
+
+
+# --- Tests --- #
+@pytest.mark.parametrize("posting_format", FORMATS)
+def test_binary_ranking_matches_dict_scorer(make_index, posting_format):
+    postings, doc_lengths = random_postings(0)
+    index = make_index(postings, doc_lengths, posting_format)
+    # query lengths that are powers of two keep the summed 1 / len(tokens) exact
+    for tokens in _queries(1, postings, max_len=4):
+        tokens = tokens[:1 << (len(tokens).bit_length() - 1)]
+        assert sorting_results_using_ranking(index, tokens, COMP) == dict_binary_ranking(index, tokens, COMP)
+
+
+@pytest.mark.parametrize("posting_format", FORMATS)
+def test_body_scores_match_dict_scorer(make_index, posting_format):
+    postings, doc_lengths = random_postings(2)
+    index = make_index(postings, doc_lengths, posting_format)
+    for query in _queries(3, postings):
+        doc_ids, scores = get_body_tfidf_scores(query, index, COMP)
+        expected = dict_body_scores(query, index, COMP)
+        assert doc_ids.tolist() == sorted(expected)
+        np.testing.assert_allclose(scores, [expected[doc_id] for doc_id in doc_ids.tolist()], rtol=1e-9)
+
+
+@pytest.mark.parametrize("posting_format", FORMATS)
+@pytest.mark.parametrize("norms", [False, True])
+def test_max_score_top_k_matches_exhaustive_scoring(make_index, posting_format, norms):
+    postings, doc_lengths = random_postings(4)
+    index = make_index(postings, doc_lengths, posting_format, norms=norms)
+    assert index.has_score_bounds()
+    n_scored, n_candidates = 0, 0
+    for query in _queries(5, postings):
+        all_doc_ids, all_scores = get_body_tfidf_scores(query, index, COMP)
+        for k in (1, 10, 100):
+            doc_ids, scores = get_body_top_k_scores(query, index, COMP, k)
+            assert get_top_n_arrays(doc_ids, scores, k) == get_top_n_arrays(all_doc_ids, all_scores, k)
+            if k == 10:
+                n_scored += len(doc_ids)
+                n_candidates += len(all_doc_ids)
+    # pruning dropped documents
+    assert n_scored < n_candidates
+
+
+@pytest.mark.parametrize("norms", [False, True])
+def test_fast_mode_matches_exhaustive_scoring_with_whole_champion_lists(make_index, norms):
+    # documents holding many of the terms, so that the cosine scores do not tie
+    postings, doc_lengths = random_postings(9, n_docs=2000, dfs=(3, 40, 300, 1000, 1900) * 6)
+    index = make_index(postings, doc_lengths, POSTING_FORMAT_VARINT, champion_size=2000, norms=norms)
+    assert index.has_champions()
+    report = body_mode_report(_queries(10, postings), index, COMP, n=10)
+    assert report["recall"] == 1.0 and report["same_top_10"] == 1.0
+
+
+@pytest.mark.parametrize("norms", [False, True])
+def test_fast_mode_scores_every_champion(make_index, norms):
+    # a single term query ranks by the champion order, the top of the list has to be returned whole
+    postings, doc_lengths = random_postings(11, n_docs=2000, dfs=(3, 40, 300, 1000, 1900) * 6)
+    index = make_index(postings, doc_lengths, POSTING_FORMAT_VARINT, champion_size=50, norms=norms)
+    for term in ["t3", "t4", "t8"]:
+        doc_ids, scores = get_body_champion_scores([term], index, COMP, 10)
+        expected = get_top_n_arrays(*get_body_top_k_scores([term], index, COMP, 10), 10)
+        assert get_top_n_arrays(doc_ids, scores, 10) == expected
+
+
+def test_champion_lists_hold_the_top_documents_of_every_term(make_index):
+    postings, doc_lengths = random_postings(12)
+    index = make_index(postings, doc_lengths, POSTING_FORMAT_RAW, champion_size=50)
+    for term, pl in postings.items():
+        # decreasing tf/DL, ties by doc id
+        expected = sorted(pl, key=lambda posting: (-posting[1] / doc_lengths[posting[0]], posting[0]))[:50]
+        doc_ids, tfs = index.champion_list(term)
+        assert list(zip(doc_ids.tolist(), tfs.tolist())) == expected
+    assert index.champion_list("missing") is None
+
+
+def test_fast_mode_without_champion_lists_scores_the_postings(make_index):
+    postings, doc_lengths = random_postings(13)
+    index = make_index(postings, doc_lengths, POSTING_FORMAT_RAW)
+    assert not index.has_champions()
+    for query in _queries(14, postings, n=10):
+        fast = get_top_n_arrays(*get_body_champion_scores(query, index, COMP, 10), 10)
+        assert fast == get_top_n_arrays(*get_body_top_k_scores(query, index, COMP, 10), 10)
+
+
+@pytest.mark.parametrize("posting_format", FORMATS)
+def test_partial_block_reads(make_index, posting_format):
+    postings, doc_lengths = random_postings(6)
+    index = make_index(postings, doc_lengths, posting_format)
+    rng = np.random.default_rng(7)
+    for term in postings:
+        doc_ids, tfs = index.read_posting_arrays(term, COMP)
+        n_blocks = -(-len(doc_ids) // SCORE_BLOCK_SIZE)
+        for n in {1, n_blocks // 4, n_blocks}:
+            blocks = np.sort(rng.choice(n_blocks, n, replace=False)) if n else np.empty(0, dtype=np.int64)
+            BLOCK_CACHE.clear()
+            bytes_read = index.backend.bytes_read
+            block_doc_ids, block_tfs = index.read_posting_blocks(term, COMP, blocks)
+            bytes_read = index.backend.bytes_read - bytes_read
+            if 2 * len(blocks) > n_blocks:
+                # most of the list is requested, it is read whole
+                np.testing.assert_array_equal(block_doc_ids, doc_ids)
+                np.testing.assert_array_equal(block_tfs, tfs)
+                continue
+            rows = np.concatenate([np.arange(b * SCORE_BLOCK_SIZE, min((b + 1) * SCORE_BLOCK_SIZE, len(doc_ids)))
+                                   for b in blocks.tolist()] + [np.empty(0, dtype=np.int64)])
+            np.testing.assert_array_equal(block_doc_ids, doc_ids[rows])
+            np.testing.assert_array_equal(block_tfs, tfs[rows])
+            assert bytes_read < index.posting_size(term)
+
+
+# --- Deadlines --- #
+def test_scoring_stops_once_the_deadline_passed(make_index):
+    postings, doc_lengths = random_postings(5)
+    index = make_index(postings, doc_lengths, POSTING_FORMAT_RAW, champion_size=100)
+    query = list(postings)
+
+    def score(deadline, func, *args):
+        set_deadline(deadline)
+        return func(*args)
+
+    # the deadline only applies to the context it was set in
+    context = contextvars.copy_context()
+    for func, args in [(get_body_tfidf_scores, (query, index, COMP)),
+                       (get_body_top_k_scores, (query, index, COMP, 10)),
+                       (get_body_champion_scores, (query, index, COMP, 10))]:
+        with pytest.raises(DeadlineExceeded):
+            context.run(score, time.monotonic() - 1, func, *args)
+        assert len(context.run(score, None, func, *args)[0]) > 0
+        assert len(func(*args)[0]) > 0
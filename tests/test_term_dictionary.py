@@ -0,0 +1,53 @@
+import pickle
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from inverted_index_gcp import InvertedIndex, TermDictionary
+
+
+def _index():
+    index = InvertedIndex()
+    for term, df in [("apple", 3), ("banana", 1), ("cherry", 2)]:
+        index.df[term] = df
+        index.term_total[term] = 2 * df
+        index.posting_locs[term] = [("body_index_000.bin", 6 * df)]
+    return index
+
+
+def test_saved_dictionary_loads_back(tmp_path):
+    TermDictionary.build(_index()).save(tmp_path)
+    terms = TermDictionary.load(tmp_path)
+    assert list(terms.terms()) == ["apple", "banana", "cherry"]
+    assert terms.row("banana") == 1 and terms.row("date") is None
+    assert terms.columns['df'].tolist() == [3, 1, 2]
+    assert terms.locs(2) == [("body_index_000.bin", 12)]
+    for name, dtype in TermDictionary.COLUMN_DTYPES.items():
+        if name in terms.columns:
+            assert terms.columns[name].dtype == dtype
+
+
+def test_column_with_another_dtype_is_rejected(tmp_path):
+    TermDictionary.build(_index()).save(tmp_path)
+    np.save(tmp_path / "df.npy", np.array([3, 1, 2], dtype=np.int64))
+    with pytest.raises(ValueError, match="df"):
+        TermDictionary.load(tmp_path)
+
+
+def test_memory_usage_of_a_pickled_index_is_estimated():
+    index = InvertedIndex()
+    for i in range(20000):
+        term = f"term{i}"
+        index.df[term] = i % 100 + 1
+        index.term_total[term] = 3 * index.df[term]
+        index.posting_locs[term] = [(f"body_index_{i % 50:03}.bin", 6 * i)]
+    index.DL = {doc_id: doc_id % 1000 + 1 for doc_id in range(50000)}
+    b = pickle.dumps(index)
+    tracemalloc.start()
+    try:
+        loaded = pickle.loads(b)
+        actual = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert 0.5 * actual < loaded.memory_usage() < 2 * actual